@@ -18,8 +18,12 @@
 import time
 import argparse
 import os
+import threading
 from datetime import timedelta
+from prometheus_client import start_http_server
+from prometheus_client.core import REGISTRY
 from cleaner.scripts.clean_docker import DockerCleaner
+from cleaner.scripts.check_deleted_files import DeletedFileReclaimer, ReclaimPolicy
 from cleaner.worker import Worker
 from cleaner.utils.logger import LoggerMixin
 from cleaner.utils import common
@@ -85,11 +89,25 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--threshold", help="the disk usage precent to start cleaner")
     parser.add_argument("-i", "--interval", help="the base interval to check disk usage")
+    parser.add_argument("--docker-root", help="root dir of docker, writable layers of containers are walked under it", default="/var/lib/docker")
+    parser.add_argument("--cache-file", help="file to persist size of writable layers across restarts", default=None)
+    parser.add_argument("--poll", help="check disk usage every interval instead of watching write activity", action="store_true")
+    parser.add_argument("-p", "--port", help="port to expose metrics", type=int, default=9103)
+    parser.add_argument("--reclaim-deleted-files", help="truncate large log files which are deleted but still opened by job containers", action="store_true")
     args = parser.parse_args()
 
     common.setup_logging()
 
-    cleaner = DockerCleaner(args.threshold, args.interval, timedelta(minutes=10))
+    policy = ReclaimPolicy() if args.reclaim_deleted_files else None
+    reclaimer = DeletedFileReclaimer(int(args.interval), policy, docker_root=args.docker_root)
+    REGISTRY.register(reclaimer)
+    start_http_server(args.port)
+    t = threading.Thread(target=reclaimer.run, name="deleted_file_reclaimer")
+    t.daemon = True
+    t.start()
+
+    watch_paths = [] if args.poll else ["/logs"]
+    cleaner = DockerCleaner(args.threshold, args.interval, timedelta(minutes=10), args.docker_root, args.cache_file, watch_paths)
     cleaner.run()
 
 
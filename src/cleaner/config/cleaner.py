@@ -52,6 +52,18 @@ def validation_post(self, conf):
             msg = "expect interval in cleaner to be int but get %s with type %s" % \
                     (interval, type(interval))
             return False, msg
-        
+
+        port = conf["cleaner"].get("port")
+        if type(port) != int:
+            msg = "expect port in cleaner to be int but get %s with type %s" % \
+                    (port, type(port))
+            return False, msg
+
+        reclaim = conf["cleaner"].get("reclaim-deleted-files")
+        if type(reclaim) != bool:
+            msg = "expect reclaim-deleted-files in cleaner to be bool but get %s with type %s" % \
+                    (reclaim, type(reclaim))
+            return False, msg
+
         return True, None
 
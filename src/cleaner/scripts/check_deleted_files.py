@@ -14,34 +14,247 @@
 # NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
-
+import collections
+import json
 import multiprocessing
+import os
+import re
+import stat
+import threading
+import time
 from cleaner.utils import common
+from cleaner.scripts.clean_docker import is_job_container
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
 
 logger = multiprocessing.get_logger()
 
-# This command  will output the deleted files which has been opened by a process.
-# The output of the deleted file list is like:
-# COMMAND    PID USER   FD   TYPE DEVICE SIZE/OFF NLINK     NODE NAME
-# dhclient  1008 root  txt    REG    8,1   487248     0 12320783 /sbin/dhclient (deleted)
-# python   31848 root    3w   REG    8,1        0     0 29362883 /tmp/tmp_out.txt (deleted)
-#
-# We only retrieve the PID (second column) and NAME (10th column).
-DELETED_FILES_CMD = "lsof +L1 2>/dev/null | awk '{print $2, $10}'"
+# Find files which are deleted but still opened by some process by reading the
+# links under /proc/<pid>/fd, the same as what `lsof +L1` reports but without
+# running lsof. The space of such a file is only freed when the last fd to it
+# is closed, e.g. a log file deleted by logrotate while the job still writes it.
+# In reclaim mode, the file is truncated through the fd link, which frees the
+# space without killing the process.
+
+DeletedFile = collections.namedtuple("DeletedFile", ["pid", "fd", "command", "container_id", "container_name", "path", "size", "inode", "writable"])
+
+DELETED_SUFFIX = " (deleted)"
+
+# container id in cgroup path of a process, e.g. /kubepods/besteffort/pod<uid>/<id> or /docker/<id>
+CONTAINER_ID_PATTERN = re.compile(r"/(?:docker-)?([0-9a-f]{64})(?:\.scope)?$")
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def get_container_id(pid, proc_root="/proc"):
+    """ returns the docker container id of the process, or None if it is not in a container """
+    try:
+        for line in read_file(os.path.join(proc_root, pid, "cgroup")).splitlines():
+            m = CONTAINER_ID_PATTERN.search(line)
+            if m is not None:
+                return m.group(1)
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def get_container_name(container_id, docker_root="/var/lib/docker"):
+    """ returns name of the container from its config under docker root, or None if it can not be read """
+    try:
+        config = json.loads(read_file(os.path.join(docker_root, "containers", container_id, "config.v2.json")))
+        return config.get("Name", "").lstrip("/")
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+def is_writable(pid, fd, proc_root="/proc"):
+    """ returns True if the fd is opened with write access """
+    try:
+        for line in read_file(os.path.join(proc_root, pid, "fdinfo", fd)).splitlines():
+            if line.startswith("flags:"):
+                return int(line.split()[1], 8) & (os.O_WRONLY | os.O_RDWR) != 0
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return False
+
+
+def scan_deleted_files(proc_root="/proc", docker_root="/var/lib/docker"):
+    """ returns list of DeletedFile for every fd to a deleted regular file """
+    files = []
+    names = {} # key is container id, value is container name
+    try:
+        pids = [p for p in os.listdir(proc_root) if p.isdigit()]
+    except OSError:
+        logger.error("failed to list processes under %s", proc_root)
+        return files
+
+    for pid in pids:
+        fd_dir = os.path.join(proc_root, pid, "fd")
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # process exited or no permission
+            continue
+
+        command = None
+        container_id = None
+        for fd in fds:
+            link = os.path.join(fd_dir, fd)
+            try:
+                target = os.readlink(link)
+                if not target.endswith(DELETED_SUFFIX):
+                    continue
+                # stat follows the link to the opened file even if it is deleted
+                st = os.stat(link)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or st.st_nlink != 0:
+                continue
+
+            if command is None:
+                try:
+                    command = read_file(os.path.join(proc_root, pid, "comm")).strip()
+                except (IOError, OSError):
+                    command = ""
+                container_id = get_container_id(pid, proc_root)
+                if container_id is not None and container_id not in names:
+                    names[container_id] = get_container_name(container_id, docker_root)
+            files.append(DeletedFile(int(pid), int(fd), command, container_id, names.get(container_id),
+                target[:-len(DELETED_SUFFIX)], st.st_blocks * 512, (st.st_dev, st.st_ino),
+                is_writable(pid, fd, proc_root)))
+    return files
+
+
+class ReclaimPolicy(object):
+    """ decides which deleted files can be truncated """
+
+    def __init__(self, min_size=100 * 1024**2, path_pattern=r"\.(log|out|err)(\.\d+)?$", jobs_only=True):
+        self.min_size = min_size
+        self.path_pattern = re.compile(path_pattern) if path_pattern else None
+        self.jobs_only = jobs_only
+
+    def accept(self, f):
+        if f.size < self.min_size:
+            return False
+        # only truncate files being written, a reader may fail on a shrunk file
+        if not f.writable:
+            return False
+        # files of PAI services and processes on host are never touched
+        if self.jobs_only and (f.container_name is None or not is_job_container(f.container_name)):
+            return False
+        if self.path_pattern is not None and self.path_pattern.search(f.path) is None:
+            return False
+        return True
+
+
+def truncate(f, proc_root="/proc"):
+    """ truncates the deleted file through the fd link of its process, returns True on success """
+    link = os.path.join(proc_root, str(f.pid), "fd", str(f.fd))
+    try:
+        fd = os.open(link, os.O_WRONLY)
+        try:
+            # make sure the fd still points to the same file, it may be reused after close
+            st = os.fstat(fd)
+            if (st.st_dev, st.st_ino) != f.inode or st.st_nlink != 0:
+                return False
+            os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.error("failed to truncate %s of process %s: %s", f.path, f.pid, e)
+        return False
+    return True
+
+
+class DeletedFileReclaimer(object):
+    """
+    Scans deleted but opened files periodically, truncates them if a policy is given, and exports
+    the result as prometheus metrics.
+    """
+
+    def __init__(self, interval=60, policy=None, proc_root="/proc", docker_root="/var/lib/docker"):
+        self.interval = interval
+        self.policy = policy
+        self.proc_root = proc_root
+        self.docker_root = docker_root
+        self.files = []
+        self.reclaimed_bytes = 0
+        self.reclaimed_count = 0
+        self.lock = threading.Lock()
+
+    def run_once(self):
+        files = scan_deleted_files(self.proc_root, self.docker_root)
+        held = {}
+        for f in files:
+            held[f.inode] = f.size
+        logger.info("%d deleted files are still opened, holding %d bytes", len(held), sum(held.values()))
+
+        if self.policy is not None:
+            done = set()
+            for f in files:
+                if f.inode in done or not self.policy.accept(f):
+                    continue
+                logger.warning("truncate deleted file %s of process %s (%s) in container %s, size %d",
+                        f.path, f.pid, f.command, f.container_name, f.size)
+                if truncate(f, self.proc_root):
+                    done.add(f.inode)
+                    with self.lock:
+                        self.reclaimed_bytes += f.size
+                        self.reclaimed_count += 1
+            if done:
+                # sizes are changed after truncating
+                files = scan_deleted_files(self.proc_root, self.docker_root)
+
+        with self.lock:
+            self.files = files
+        return files
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("failed to check deleted files")
+            time.sleep(self.interval)
+
+    def collect(self):
+        with self.lock:
+            files = self.files
+            reclaimed_bytes = self.reclaimed_bytes
+            reclaimed_count = self.reclaimed_count
+
+        labels = ["pid", "command", "container_id"]
+        size = GaugeMetricFamily("cleaner_deleted_file_bytes",
+                "space held by files which are deleted but still opened by the process", labels=labels)
+        count = GaugeMetricFamily("cleaner_deleted_file_count",
+                "number of files which are deleted but still opened by the process", labels=labels)
+
+        # a file opened by several fds of a process is counted once
+        processes = collections.defaultdict(dict)
+        for f in files:
+            processes[(str(f.pid), f.command, f.container_id or "")][f.inode] = f.size
+        for key, inodes in processes.items():
+            size.add_metric(list(key), sum(inodes.values()))
+            count.add_metric(list(key), len(inodes))
+        yield size
+        yield count
+
+        yield CounterMetricFamily("cleaner_deleted_file_reclaimed_bytes",
+                "space freed by truncating deleted files", value=reclaimed_bytes)
+        yield CounterMetricFamily("cleaner_deleted_file_reclaimed_count",
+                "number of deleted files truncated", value=reclaimed_count)
 
 
 def list_and_check_files(arg, log=logger):
-    files = common.run_cmd(DELETED_FILES_CMD, log)
-    if len(files) <= 1:
+    files = scan_deleted_files()
+    if len(files) == 0:
         log.info("no deleted files found.")
         return
-    else:
-        # skip the field names from the command
-        files = files[1:]
 
     for f in files:
-        f_fields = f.split(" ")
-        log.warning("process [%s] opened file [%s] but the file has been deleted.", f_fields[0], f_fields[1])
+        log.warning("process [%s] opened file [%s] but the file has been deleted.", f.pid, f.path)
 
 
 def main():
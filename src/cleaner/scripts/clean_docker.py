@@ -14,28 +14,88 @@
 # NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
-
 from cleaner.utils.logger import LoggerMixin
 from cleaner.utils.timer import CountdownTimer, Timeout
 from cleaner.utils import common
+from cleaner.utils import disk
+from cleaner.utils.watcher import create_watcher
 from datetime import timedelta
+import collections
 import subprocess
 import multiprocessing
 import re
 import time
 import os
 
+# containers of PAI services and user created containers are never touched
+white_list = ["k8s_POD", "k8s_kube", "k8s_pylon", "k8s_zookeeper", "k8s_rest-server", "k8s_yarn", "k8s_hadoop", "k8s_job-exporter", "k8s_watchdog", "k8s_grafana", "k8s_node-exporter", "k8s_webportal", "k8s_prometheus", "k8s_nvidia-drivers", "k8s_etcd-container", "k8s_apiserver-container", "k8s_docker-cleaner", "kubelet", "dev-box"]
+
+
+def is_job_container(name):
+    for prefix in white_list:
+        if name.startswith(prefix):
+            return False
+    return re.search(r"container(_\w+)?_\d+_\d+_\d+_\d+$", name) is not None
+
+
+JobContainer = collections.namedtuple("JobContainer", ["id", "image", "name", "size", "rate"])
+
+
+def plan_eviction(containers, need, horizon, min_size=1024**3):
+    """
+    Picks as few containers as possible to free the needed bytes. A container is expected to free its
+    current size plus what it would write in the horizon, so a fast growing container is preferred to a
+    larger but static one.
+
+    :param containers: list of JobContainer, rate is growth in bytes per second
+    :param need: bytes to free
+    :param horizon: seconds before the next check
+    :param min_size: containers expected to free less than this are never picked
+    :return list of JobContainer, which may free less than needed if all candidates together cannot
+    """
+    def freed(c):
+        return c.size + c.rate * horizon
+
+    victims = []
+    for c in sorted(containers, key=freed, reverse=True):
+        if need <= 0 or freed(c) < min_size:
+            break
+        victims.append(c)
+        need -= freed(c)
+    return victims
+
+
 class DockerCleaner(LoggerMixin):
-    def __init__(self, threshold, interval, timeout=timedelta(hours=1)):
+    # seconds allowed to walk writable layers of containers in one check
+    walk_budget = 20
+
+    # interval to recheck while disk usage is above threshold
+    min_interval = 5
+
+    # killed containers are expected to free their space within this time, and are not picked again
+    kill_grace_period = 300
+
+    # disk usage is sampled at most once in this many seconds while there are write events. The
+    # kernel merges repeated writes to the same file, so the number of events says little about how
+    # much is written and any event triggers a sample
+    sample_window = 1
+
+    def __init__(self, threshold, interval, timeout=timedelta(hours=1), docker_root="/var/lib/docker", cache_file=None, watch_paths=None):
         self.__threshold = int(threshold)
         self.__interval = int(interval)
         self.__timeout = timeout
+        self.__tracker = disk.LayerSizeTracker(docker_root, cache_file)
+        self.__killed = {} # key is container id, value is (kill time, size)
+        self.__docker_root = docker_root
+        # directories watched for writes besides writable layers of running containers
+        self.__watch_paths = watch_paths or []
 
     def _exec(self):
         exc = None
+        delay = self.__interval
         try:
             with CountdownTimer(duration=self.__timeout):
-                self.check_and_clean()
+                delay = self.check_and_clean()
         except Timeout as e:
             self.logger.error("Cleaner timeout.")
             exc = e
@@ -45,96 +105,209 @@ def _exec(self):
 
         if exc is not None:
             self.logger.exception(exc)
+        return delay
+
+    def watch_dirs(self):
+        """ directories where writes are expected, watched when the whole file system cannot be """
+        if not self.__tracker.is_supported():
+            return [self.__docker_root] + self.__watch_paths
+        return [self.__tracker.upper_dir(c.mount_id) for c in self.__tracker.list_containers() if c.running] \
+                + self.__watch_paths
 
     def run(self):
+        watcher = None
+        if self.__watch_paths:
+            watcher = create_watcher([self.__docker_root] + self.__watch_paths, self.watch_dirs())
+        if watcher is None:
+            self.logger.info("check disk usage every {0} seconds".format(self.__interval))
+
+        delay = self.__interval
         while True:
             # allow a delay before the cleaning
-            time.sleep(self.__interval)
-            self._exec()
+            try:
+                self.wait(watcher, delay)
+            except (OSError, IOError) as e:
+                self.logger.error("Failed to watch write activity, fall back to polling.")
+                self.logger.exception(e)
+                watcher.close()
+                watcher = None
+            delay = self._exec()
+            if watcher is not None:
+                # containers started or stopped since last check
+                watcher.update(self.watch_dirs())
+
+    def wait(self, watcher, delay):
+        """
+        Waits for delay seconds before next check. With a watcher, disk usage is sampled at most once
+        per sample window while something is written, and the wait ends early if usage is above
+        threshold, or will reach it before the delay ends at the growth seen between samples. When the
+        disk is idle, nothing is sampled.
+        """
+        if watcher is None:
+            time.sleep(delay)
+            return
+
+        deadline = time.time() + delay
+        last_sample = None # (time, used bytes)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            events = watcher.wait(remaining)
+            if events == 0:
+                continue
+
+            # events until the end of the window are covered by this sample
+            if last_sample is not None:
+                time.sleep(max(0, min(last_sample[0] + self.sample_window, deadline) - time.time()))
+            events += watcher.read_events()
+
+            try:
+                usage = disk.get_partition_usage("/")
+            except OSError:
+                continue
+            now = time.time()
+            if usage.percent >= self.__threshold:
+                self.logger.info("Disk usage {0}% reached threshold with {1} write events".format(usage.percent, events))
+                return
+            if last_sample is not None and now > last_sample[0]:
+                growth = (usage.used - last_sample[1]) / (now - last_sample[0])
+                if growth > 0 and -self.bytes_over_threshold(usage) / growth < deadline - now:
+                    self.logger.info("Disk is filling at {0}/s, check before it reaches threshold".format(disk.format_size(growth)))
+                    return
+            last_sample = (now, usage.used)
 
 
     def check_disk_usage(self, partition):
-        df = subprocess.Popen(["df","-h", partition], stdout=subprocess.PIPE)
-        sized = 0
         try:
-            for line in df.stdout:
-                splitline = line.decode().split()
-                if splitline[5] == partition:
-                    sized = splitline[1]
-                    used = splitline[2]
-                    usep = int(splitline[4][:-1])
-        except ValueError:
+            usage = disk.get_partition_usage(partition)
+        except OSError:
             self.logger.error("cannot get disk size, reset size to 0")
-            sized = 0
-            used = 0
-            usep = 0
-        self.logger.info("Checking disk, disk usage = {0}%".format(usep))
-        return sized, used, usep
+            usage = disk.PartitionUsage(0, 0, 0, 0)
+        self.logger.info("Checking disk, disk usage = {0}%".format(usage.percent))
+        return usage
+
+
+    def bytes_over_threshold(self, usage):
+        """ bytes to free to bring disk usage below threshold, negative if it is already below """
+        # usage percent is rounded up, so it is below threshold only if used is within threshold - 1 percent
+        allowed = (usage.used + usage.free) * (self.__threshold - 1) / 100.0
+        return usage.used - allowed
 
+    def next_delay(self, usage, growth):
+        """ recheck soon while above threshold, or before disk usage may reach threshold at current growth """
+        if usage.percent >= self.__threshold:
+            return self.min_interval
+        if growth <= 0:
+            return self.__interval
+        time_to_threshold = -self.bytes_over_threshold(usage) / growth
+        return int(max(self.min_interval, min(self.__interval, time_to_threshold / 2)))
 
     def check_and_clean(self):
-        sized, used, usep = self.check_disk_usage("/") 
-        if usep >= self.__threshold:
+        """ returns seconds to wait before next check """
+        usage = self.check_disk_usage("/")
+        if self.__tracker.is_supported():
+            # keep layer sizes fresh even without disk pressure, so that little has to be
+            # walked again when a victim must be picked
+            self.__tracker.refresh(self.__tracker.list_containers(), self.walk_budget)
+
+        now = time.time()
+        for container_id in list(self.__killed.keys()):
+            if now - self.__killed[container_id][0] > self.kill_grace_period:
+                self.__killed.pop(container_id)
+
+        containers = self.list_job_containers()
+        growth = sum(c.rate for c in containers)
+        if usage.percent >= self.__threshold:
             self.logger.info("Disk usage is above {0}%, Try to remove containers".format(self.__threshold))
-            self.kill_largest_container(sized, used, usep)
+            self.evict_containers(usage, containers)
+        return self.next_delay(usage, growth)
 
 
-    # Clean logic v1: kill largest container
-    white_list = ["k8s_POD", "k8s_kube", "k8s_pylon", "k8s_zookeeper", "k8s_rest-server", "k8s_yarn", "k8s_hadoop", "k8s_job-exporter", "k8s_watchdog", "k8s_grafana", "k8s_node-exporter", "k8s_webportal", "k8s_prometheus", "k8s_nvidia-drivers", "k8s_etcd-container", "k8s_apiserver-container", "k8s_docker-cleaner", "kubelet", "dev-box"]
-    def kill_largest_container(self, sized, used, usep):
-        containers = []
-        # Only try to stop PAI jobs and user created containers
-        containers_source = subprocess.Popen(["docker", "ps", "-a", "--format", r'{{.ID}}\t{{.Image}}\t{{.Size}}\t{{.Names}}\t'], stdout=subprocess.PIPE)
-        for line in containers_source.stdout:
-            splitline = line.split("\t")
-            for prefix in self.white_list:
-                if (splitline[3].startswith(prefix)):
-                    break
-            else:
-                # Only check job containers
-                if re.search(r"container(_\w+)?_\d+_\d+_\d+_\d+$", splitline[3]) is not None:
-                    size_str = splitline[2].split()[0]
-                    size = common.calculate_size(size_str)
-                    containers.append([size, splitline[0], splitline[1], splitline[3], size_str])
-
-        containers.sort(key=lambda x:x[0], reverse=True)
-
-        if containers.count > 0 and containers[0][0] > 1024**3:
-            self.logger.warning("Kill container {0} due to disk pressure. Container size: {1}".format(containers[0][3], containers[0][4]))
-            
-            # Write error log
-            container_name = re.search(r"container(_\w+)?_\d+_\d+_\d+_\d+$", containers[0][3]).group()
-            application_name = "application{0}".format(re.search(r"^_\d+_\d+", re.search(r"_\d+_\d+_\d+_\d+$", container_name).group()).group())            
-            full_path = "/logs/{0}/{1}".format(application_name, container_name)
-
-            if not os.path.isdir(full_path):
-                self.logger.error("Cannot find job log dir, creating path. Log may not be collected.")
-                try:
-                    os.makedirs(full_path)
-                except OSError as exc:
-                    self.logger.error("Failed to create path {0}.".format(full_path))
-
-            if os.path.isdir(full_path):
-                error_filename = "{0}/diskCleaner.pai.error".format(full_path)
-                timestamp = int(time.time())
-                try:
-                    fp = open(error_filename, "w")
-                except IOError:
-                    self.logger.error("Failed to write error log, skipped")
-                else:
-                    fp.writelines([
-                        "{0} ERROR ACTION \"KILL\"\n".format(timestamp),
-                        "{0} ERROR REASON \"{1} killed due to disk pressure. Disk size: {2}, Used: {3}, Cleaner threshold: {4}, Container cost: {5} \"\n".format(timestamp, container_name, sized, "{0}({1}%)".format(used, usep), "{0}%".format(self.__threshold), containers[0][4]),
-                        "{0} ERROR SOLUTION \"Node disk is full, please try another time. If your job needs large space, please use NAS to store data.\"\n".format(timestamp)
-                        ])
-                    fp.close()
-
-            subprocess.Popen(["docker", "kill", "--signal=10", containers[0][1]])
-
-            # Because docker stop will not immedicately stop container, we can not remove docker image right after stop container
-            #container_image = subprocess.Popen(["docker", "inspect", containers[0][1], r"--format='{{.Image}}'"], stdout=subprocess.PIPE).stdout.readline()
-            #subprocess.Popen(["docker", "image", "rmi", container_image])
-            return True
+    # Clean logic v2: kill as few containers as possible to bring disk usage below threshold
+    def list_job_containers(self):
+        """ returns list of JobContainer, excluding the ones killed recently """
+        if self.__tracker.is_supported():
+            sizes = self.__tracker.sizes
+            rates = self.__tracker.rates
+            containers = [JobContainer(c.id, c.image, c.name, sizes[c.id].size, rates.get(c.id, 0.0))
+                    for c in self.__tracker.list_containers()
+                    if c.running and c.id in sizes and is_job_container(c.name)]
+            existing = sizes
         else:
-            return False
+            # fall back to let docker walk all the layers, which may be slow, growth rate is unknown
+            self.logger.warning("overlay2 layers not found under docker root, fall back to docker ps")
+            containers = []
+            existing = set()
+            containers_source = subprocess.Popen(["docker", "ps", "-a", "--format", r'{{.ID}}\t{{.Image}}\t{{.Size}}\t{{.Names}}\t'], stdout=subprocess.PIPE)
+            for line in containers_source.stdout:
+                splitline = line.split("\t")
+                existing.add(splitline[0])
+                if is_job_container(splitline[3]):
+                    size = common.calculate_size(splitline[2].split()[0])
+                    containers.append(JobContainer(splitline[0], splitline[1], splitline[3], size, 0.0))
 
+        # space of killed containers which are removed is already freed
+        for container_id in list(self.__killed.keys()):
+            if container_id not in existing:
+                self.__killed.pop(container_id)
+        return [c for c in containers if c.id not in self.__killed]
+
+    def evict_containers(self, usage, containers):
+        """ returns list of killed JobContainer """
+        horizon = self.min_interval
+        # growth of all containers before next check, and space of containers killed but not freed yet
+        need = self.bytes_over_threshold(usage) + sum(c.rate for c in containers) * horizon \
+                - sum(size for _, size in self.__killed.values())
+        if need <= 0:
+            self.logger.info("Space of killed containers is yet to be freed, skip killing")
+            return []
+
+        # Only try to stop PAI jobs and user created containers
+        victims = plan_eviction(containers, need, horizon)
+        if len(victims) == 0:
+            self.logger.warning("No container to kill, need to free {0}".format(disk.format_size(need)))
+            return victims
+
+        self.logger.warning("Kill {0} containers to free {1} due to disk pressure".format(len(victims), disk.format_size(need)))
+        for c in victims:
+            self.logger.warning("Kill container {0} due to disk pressure. Container size: {1}, growth: {2}/s".format(
+                c.name, disk.format_size(c.size), disk.format_size(c.rate)))
+            self.write_error_log(c, usage, need, len(victims))
+            subprocess.Popen(["docker", "kill", "--signal=10", c.id])
+            self.__killed[c.id] = (time.time(), c.size)
+
+        # Because docker stop will not immedicately stop container, we can not remove docker image right after stop container
+        #container_image = subprocess.Popen(["docker", "inspect", containers[0][1], r"--format='{{.Image}}'"], stdout=subprocess.PIPE).stdout.readline()
+        #subprocess.Popen(["docker", "image", "rmi", container_image])
+        return victims
+
+    def write_error_log(self, container, usage, need, victim_count):
+        container_name = re.search(r"container(_\w+)?_\d+_\d+_\d+_\d+$", container.name).group()
+        application_name = "application{0}".format(re.search(r"^_\d+_\d+", re.search(r"_\d+_\d+_\d+_\d+$", container_name).group()).group())
+        full_path = "/logs/{0}/{1}".format(application_name, container_name)
+
+        if not os.path.isdir(full_path):
+            self.logger.error("Cannot find job log dir, creating path. Log may not be collected.")
+            try:
+                os.makedirs(full_path)
+            except OSError as exc:
+                self.logger.error("Failed to create path {0}.".format(full_path))
+
+        if os.path.isdir(full_path):
+            error_filename = "{0}/diskCleaner.pai.error".format(full_path)
+            timestamp = int(time.time())
+            try:
+                fp = open(error_filename, "w")
+            except IOError:
+                self.logger.error("Failed to write error log, skipped")
+            else:
+                fp.writelines([
+                    "{0} ERROR ACTION \"KILL\"\n".format(timestamp),
+                    "{0} ERROR REASON \"{1} killed due to disk pressure. Disk size: {2}, Used: {3}, Cleaner threshold: {4}, Container cost: {5}, Container growth: {6}/s, Need to free: {7}, Containers killed: {8} \"\n".format(
+                        timestamp, container_name, disk.format_size(usage.total),
+                        "{0}({1}%)".format(disk.format_size(usage.used), usage.percent), "{0}%".format(self.__threshold),
+                        disk.format_size(container.size), disk.format_size(container.rate), disk.format_size(need), victim_count),
+                    "{0} ERROR SOLUTION \"Node disk is full, please try another time. If your job needs large space, please use NAS to store data.\"\n".format(timestamp)
+                    ])
+                fp.close()
@@ -14,31 +14,161 @@
 # NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
-
 from cleaner.utils import common
+from cleaner.utils.docker_api import DockerClient, DockerApiError
+import collections
 import multiprocessing
+import time
 
 logger = multiprocessing.get_logger()
 
+GB = 1024**3
+
+# Estimate the space reclaimable from docker by /system/df of docker api, and
+# remove only as many unused images and stopped containers as needed to bring
+# it below the threshold, least recently used ones first. Images which are
+# still hot are kept, so that the next job on the node does not pull them again.
+#
+# Like `docker system prune` without --volumes, local volumes are never counted
+# nor removed. Build cache is ignored since nothing is built on worker nodes.
+
+# kind is "image" or "container", containers are the stopped containers to remove before the image
+Removal = collections.namedtuple("Removal", ["kind", "id", "names", "containers", "size", "last_used"])
+
+
+class DockerCacheEstimator(object):
+    """ not thread safe """
+
+    # /system/df walks the writable layers of all containers, so its result is reused for a while
+    ttl = 600
+
+    # objects used within this time are not removed, to avoid racing with jobs being started
+    min_idle = 3600
+
+    def __init__(self, client=None):
+        self.client = client or DockerClient()
+        self.df = None
+        self.df_time = 0
+        self.last_used = {} # key is image id, value is the last time it is seen used by a running container
+
+    def get_df(self, now):
+        if self.df is None or now - self.df_time > self.ttl:
+            self.df = self.client.system_df()
+            self.df_time = now
+            for c in self.df.get("Containers") or []:
+                if c.get("State") == "running":
+                    self.last_used[c.get("ImageID")] = now
+        return self.df
+
+    def invalidate(self):
+        self.df = None
+
+    def candidates(self, now=None, min_idle=None):
+        """ returns list of Removal which are not used by running containers, least recently used first """
+        now = now or time.time()
+        min_idle = self.min_idle if min_idle is None else min_idle
+        df = self.get_df(now)
+
+        running_images = set()
+        stopped = collections.defaultdict(list) # key is image id, value is list of stopped containers
+        for c in df.get("Containers") or []:
+            if c.get("State") == "running":
+                running_images.add(c.get("ImageID"))
+            else:
+                stopped[c.get("ImageID")].append(c)
+
+        def container_removal(c):
+            return Removal("container", c["Id"], c.get("Names") or [], [], c.get("SizeRw") or 0, c.get("Created", 0))
+
+        removals = []
+        for image in df.get("Images") or []:
+            image_id = image["Id"]
+            containers = stopped.pop(image_id, [])
+            if image_id in running_images:
+                # stopped containers of an image in use only free their own writable layers
+                removals.extend(container_removal(c) for c in containers)
+                continue
+            # space of layers shared with other images is not freed by removing this one
+            size = image.get("Size", 0) - max(image.get("SharedSize", 0), 0) + sum(c.get("SizeRw") or 0 for c in containers)
+            last_used = max([self.last_used.get(image_id, 0), image.get("Created", 0)] + [c.get("Created", 0) for c in containers])
+            names = [t for t in image.get("RepoTags") or [] if t != "<none>:<none>"]
+            removals.append(Removal("image", image_id, names, [c["Id"] for c in containers], size, last_used))
+
+        # stopped containers whose images are already removed
+        for containers in stopped.values():
+            removals.extend(container_removal(c) for c in containers)
+
+        removals = [r for r in removals if now - r.last_used >= min_idle]
+        removals.sort(key=lambda r: r.last_used)
+        return removals
+
+    def plan(self, target, now=None):
+        """ returns the least recently used Removals which free at least target bytes together, or all of them if they cannot """
+        planned = []
+        freed = 0
+        for r in self.candidates(now):
+            if freed >= target:
+                break
+            planned.append(r)
+            freed += r.size
+        return planned
+
+    def remove(self, removals):
+        """ returns bytes freed, estimated by docker before removing """
+        freed = 0
+        for r in removals:
+            try:
+                for container_id in r.containers:
+                    self.client.remove_container(container_id)
+                if r.kind == "container":
+                    self.client.remove_container(r.id)
+                else:
+                    # removing the last tag of an image removes it, an untagged image is removed by id
+                    for name in r.names or [r.id]:
+                        self.client.remove_image(name)
+            except DockerApiError as e:
+                # e.g. a new container is created from the image since /system/df
+                logger.warning("failed to remove %s %s: %s", r.kind, r.names or r.id, e)
+                continue
+            logger.info("removed %s %s, freed %.2f GB", r.kind, r.names or r.id, r.size / float(GB))
+            freed += r.size
+        self.invalidate()
+        return freed
+
+
+_estimator = None
+
+
+def get_estimator():
+    global _estimator
+    if _estimator is None:
+        _estimator = DockerCacheEstimator()
+    return _estimator
+
 
 def get_cache_size():
-    out = common.run_cmd("source ./scripts/reclaimable_docker_cache.sh 2> /dev/null", logger)
-    size = 0
-    if len(out) == 0:
-        logger.error("cannot retrieve cache size.")
-        return size
+    """ returns space reclaimable from docker in GB """
     try:
-        size = float(out[0])
-    except ValueError:
-        logger.error("cannot convert cache size, reset size to 0")
-        size = 0
-    return size
+        removals = get_estimator().candidates(min_idle=0)
+    except Exception:
+        logger.exception("cannot retrieve cache size.")
+        return 0
+    return sum(r.size for r in removals) / float(GB)
 
 
 def check_and_clean(threshold):
-    if get_cache_size() > threshold:
-        # to avoid possible race condition, only clean the containers, images and networks created 1h ago
-        common.run_cmd("docker system prune -af --filter until=1h", logger)
+    """ removes least recently used images and stopped containers until reclaimable space is below threshold GB """
+    size = get_cache_size()
+    if size > threshold:
+        estimator = get_estimator()
+        try:
+            removals = estimator.plan((size - threshold) * GB)
+            logger.info("reclaimable docker cache is %.2f GB, remove %d least recently used objects", size, len(removals))
+            freed = estimator.remove(removals)
+        except Exception:
+            logger.exception("failed to clean docker cache.")
+            return
+        logger.info("freed %.2f GB of docker cache", freed / float(GB))
 
 
 if __name__ == "__main__":
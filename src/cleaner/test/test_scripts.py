@@ -23,78 +23,370 @@
 import multiprocessing
 from cleaner.utils.common import setup_logging, run_cmd
 from cleaner.scripts import clean_docker_cache, check_deleted_files
+from cleaner.scripts.clean_docker import DockerCleaner, JobContainer, plan_eviction
+from cleaner.utils.docker_api import DockerApiError
+from cleaner.utils import disk, watcher
+from cleaner.test.test_utils import make_container, write_file
+import itertools
+import shutil
+import tempfile
+import threading
 
-CALLED_CMD = "docker system prune -af"
 LOGGER = multiprocessing.get_logger()
+GB = 1024**3
+NOW = 100000
+
+SYSTEM_DF = {
+    "Images": [
+        {"Id": "sha256:hot", "RepoTags": ["hot:latest"], "Created": 0, "Size": 5 * GB, "SharedSize": 0},
+        {"Id": "sha256:old", "RepoTags": ["old:v1", "old:v2"], "Created": 0, "Size": 3 * GB, "SharedSize": 1 * GB},
+        {"Id": "sha256:new", "RepoTags": ["new:latest"], "Created": NOW - 7200, "Size": 4 * GB, "SharedSize": 0},
+        {"Id": "sha256:recent", "RepoTags": ["recent:latest"], "Created": NOW - 60, "Size": 4 * GB, "SharedSize": 0},
+        {"Id": "sha256:dangling", "RepoTags": ["<none>:<none>"], "Created": 50, "Size": 1 * GB, "SharedSize": -1},
+    ],
+    "Containers": [
+        {"Id": "running", "ImageID": "sha256:hot", "State": "running", "Created": 0, "SizeRw": 1 * GB},
+        {"Id": "exited_hot", "ImageID": "sha256:hot", "State": "exited", "Created": 100, "SizeRw": 1 * GB},
+        {"Id": "exited_new", "ImageID": "sha256:new", "State": "exited", "Created": NOW - 3600, "SizeRw": 1 * GB},
+    ],
+    "Volumes": [{"Name": "v", "UsageData": {"Size": 10 * GB, "RefCount": 0}}],
+}
 
 
 class TestCacheClean(TestCase):
 
     def setUp(self):
         setup_logging()
+        self.client = mock.Mock()
+        self.client.system_df.return_value = SYSTEM_DF
+        self.estimator = clean_docker_cache.DockerCacheEstimator(self.client)
 
-    @mock.patch("cleaner.utils.common.run_cmd", return_value=[])
-    def testCacheEmpty(self, mock_cmd):
-        self.assertEqual(clean_docker_cache.get_cache_size(), 0)
+    def testCandidates(self):
+        removals = self.estimator.candidates(NOW)
+        self.assertEqual(["sha256:old", "sha256:dangling", "exited_hot", "sha256:new"], [r.id for r in removals])
+        self.assertEqual(2 * GB, removals[0].size)
+        self.assertEqual(["exited_new"], removals[3].containers)
+        self.assertEqual(5 * GB, removals[3].size)
 
-    @mock.patch("cleaner.utils.common.run_cmd", return_value=["0"])
-    def testCacheZero(self, mock_cmd):
-        self.assertEqual(clean_docker_cache.get_cache_size(), 0)
+        # the recently pulled image is reclaimable but not removed
+        self.assertEqual(13 * GB, sum(r.size for r in self.estimator.candidates(NOW, min_idle=0)))
+
+    def testDfCached(self):
+        self.estimator.candidates(NOW)
+        self.estimator.candidates(NOW + 10)
+        self.client.system_df.assert_called_once()
+        self.estimator.candidates(NOW + clean_docker_cache.DockerCacheEstimator.ttl + 1)
+        self.assertEqual(2, self.client.system_df.call_count)
+
+    def testLastUsed(self):
+        self.estimator.candidates(NOW)
+        # hot image is no longer used by running containers, but was used lately
+        df = dict(SYSTEM_DF, Containers=[])
+        self.client.system_df.return_value = df
+        self.estimator.invalidate()
+        self.assertFalse("sha256:hot" in [r.id for r in self.estimator.candidates(NOW + 60)])
+        self.assertEqual("sha256:hot", self.estimator.candidates(NOW + 3600)[-1].id)
+
+    def testPlan(self):
+        self.assertEqual(["sha256:old"], [r.id for r in self.estimator.plan(2 * GB, NOW)])
+        self.assertEqual(["sha256:old", "sha256:dangling"], [r.id for r in self.estimator.plan(2 * GB + 1, NOW)])
+        self.assertEqual(4, len(self.estimator.plan(100 * GB, NOW)))
+        self.assertEqual([], self.estimator.plan(0, NOW))
 
-    @mock.patch("cleaner.utils.common.run_cmd", return_value=["error"])
-    def testCacheError(self, mock_cmd):
+    def testRemove(self):
+        removals = self.estimator.candidates(NOW)
+        self.client.remove_image.side_effect = [None, None, None, DockerApiError("DELETE", "/images/new:latest", 409, "conflict")]
+        self.assertEqual(4 * GB, self.estimator.remove(removals))
+        self.assertEqual([mock.call("old:v1"), mock.call("old:v2"), mock.call("sha256:dangling"), mock.call("new:latest")],
+                self.client.remove_image.call_args_list)
+        self.assertEqual([mock.call("exited_hot"), mock.call("exited_new")], self.client.remove_container.call_args_list)
+
+    @mock.patch("cleaner.scripts.clean_docker_cache.get_estimator")
+    def testCacheError(self, mock_estimator):
+        mock_estimator.return_value.candidates.side_effect = IOError()
         self.assertEqual(clean_docker_cache.get_cache_size(), 0)
 
-    @mock.patch("cleaner.scripts.clean_docker_cache.get_cache_size", return_value=1)
-    @mock.patch("cleaner.utils.common.run_cmd", return_value=["0"])
-    def testCleanTrue(self, mock_cmd, mock_size):
-        clean_docker_cache.check_and_clean(0)
-        mock_cmd.assert_called_once_with(CALLED_CMD, LOGGER)
+    @mock.patch("cleaner.scripts.clean_docker_cache.get_estimator")
+    @mock.patch("cleaner.scripts.clean_docker_cache.get_cache_size", return_value=12)
+    def testCleanTrue(self, mock_size, mock_estimator):
+        clean_docker_cache.check_and_clean(10)
+        mock_estimator.return_value.plan.assert_called_once_with(2 * GB)
+        mock_estimator.return_value.remove.assert_called_once()
 
+    @mock.patch("cleaner.scripts.clean_docker_cache.get_estimator")
     @mock.patch("cleaner.scripts.clean_docker_cache.get_cache_size", return_value=0)
-    @mock.patch("cleaner.utils.common.run_cmd", return_value=["0"])
-    def testCleanFalse(self, mock_cmd, mock_size):
+    def testCleanFalse(self, mock_size, mock_estimator):
         clean_docker_cache.check_and_clean(0)
-        mock_cmd.assert_not_called()
+        mock_estimator.return_value.plan.assert_not_called()
 
 
 class TestDeletedFiles(TestCase):
 
-    def testDeletedCmd(self):
-        test_file = "/tmp/deleted_test.txt"
+    def setUp(self):
+        setup_logging()
+
+    def testScanDeletedFiles(self):
+        test_file = "/tmp/deleted_test.log"
 
         def open_and_loop():
-            with open(test_file, "w"):
+            with open(test_file, "w") as f:
+                f.write("x" * 1024 * 1024)
+                f.flush()
                 while True:
                     pass
 
         proc = multiprocessing.Process(target=open_and_loop)
         proc.start()
         time.sleep(1)
-        os.remove("/tmp/deleted_test.txt")
+        os.remove(test_file)
         time.sleep(1)
 
-        mock_logger = mock.Mock()
-        cmd_out = run_cmd(check_deleted_files.DELETED_FILES_CMD, mock_logger)
-        files = [f.split(" ")[1] for f in cmd_out[1:]]
-        self.assertTrue(test_file in files)
+        try:
+            files = [f for f in check_deleted_files.scan_deleted_files() if f.pid == proc.pid and f.path == test_file]
+            self.assertEqual(1, len(files))
+            self.assertTrue(files[0].size >= 1024 * 1024)
+            self.assertTrue(files[0].writable)
 
-        proc.terminate()
-        proc.join()
+            # process running on host is not reclaimed by default
+            self.assertFalse(check_deleted_files.ReclaimPolicy(min_size=0).accept(files[0]))
+            self.assertTrue(check_deleted_files.ReclaimPolicy(min_size=0, jobs_only=False).accept(files[0]))
 
-    @mock.patch("cleaner.utils.common.run_cmd", return_value=["PID NAME"])
-    def testDeletedCheckEmpty(self, mock_cmd):
+            self.assertTrue(check_deleted_files.truncate(files[0]))
+            files = [f for f in check_deleted_files.scan_deleted_files() if f.pid == proc.pid and f.path == test_file]
+            self.assertEqual(0, files[0].size)
+        finally:
+            proc.terminate()
+            proc.join()
+
+    def testReclaimPolicy(self):
+        f = check_deleted_files.DeletedFile(1, 3, "python", "a" * 64, "container_e01_1_2_3_4", "/var/log/job.log.1", 1024**3, (1, 2), True)
+        policy = check_deleted_files.ReclaimPolicy()
+        self.assertTrue(policy.accept(f))
+        self.assertFalse(policy.accept(f._replace(size=1024)))
+        self.assertFalse(policy.accept(f._replace(writable=False)))
+        self.assertFalse(policy.accept(f._replace(container_id=None, container_name=None)))
+        self.assertFalse(policy.accept(f._replace(path="/data/model.bin")))
+        self.assertFalse(policy.accept(f._replace(path="/tmp/scratch.txt")))
+        # PAI services are never touched
+        self.assertFalse(policy.accept(f._replace(container_name="k8s_prometheus_prometheus-abc_default_1")))
+        self.assertFalse(policy.accept(f._replace(container_name="k8s_hadoop-node-manager_nm-abc_default_1")))
+
+    def testGetContainerId(self):
+        container_id = "0123456789abcdef" * 4
+        proc_root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(proc_root, "1"))
+            with open(os.path.join(proc_root, "1", "cgroup"), "w") as f:
+                f.write("12:memory:/kubepods/besteffort/pod1234/{0}\n".format(container_id))
+            self.assertEqual(container_id, check_deleted_files.get_container_id("1", proc_root))
+            self.assertEqual(None, check_deleted_files.get_container_id("2", proc_root))
+        finally:
+            shutil.rmtree(proc_root)
+
+    def testGetContainerName(self):
+        docker_root = tempfile.mkdtemp()
+        try:
+            make_container(docker_root, "c1", "container_e01_1_2_3_4")
+            self.assertEqual("container_e01_1_2_3_4", check_deleted_files.get_container_name("c1", docker_root))
+            self.assertEqual(None, check_deleted_files.get_container_name("c2", docker_root))
+        finally:
+            shutil.rmtree(docker_root)
+
+    @mock.patch("cleaner.scripts.check_deleted_files.truncate", return_value=True)
+    @mock.patch("cleaner.scripts.check_deleted_files.scan_deleted_files")
+    def testReclaimer(self, mock_scan, mock_truncate):
+        f = check_deleted_files.DeletedFile(1, 3, "python", "a" * 64, "container_e01_1_2_3_4", "/var/log/job.log", 1024**3, (1, 2), True)
+        # the same file opened by two fds
+        mock_scan.return_value = [f, f._replace(fd=4)]
+
+        reclaimer = check_deleted_files.DeletedFileReclaimer()
+        reclaimer.run_once()
+        mock_truncate.assert_not_called()
+
+        metrics = dict((m.name, m) for m in reclaimer.collect())
+        self.assertEqual(1024**3, metrics["cleaner_deleted_file_bytes"].samples[0].value)
+        self.assertEqual(1, metrics["cleaner_deleted_file_count"].samples[0].value)
+
+        reclaimer = check_deleted_files.DeletedFileReclaimer(policy=check_deleted_files.ReclaimPolicy())
+        reclaimer.run_once()
+        mock_truncate.assert_called_once()
+        self.assertEqual(1024**3, reclaimer.reclaimed_bytes)
+
+    @mock.patch("cleaner.scripts.check_deleted_files.scan_deleted_files", return_value=[])
+    def testDeletedCheckEmpty(self, mock_scan):
         mock_log = mock.Mock()
         check_deleted_files.list_and_check_files(None, mock_log)
         mock_log.info.assert_called_once()
 
-    @mock.patch("cleaner.utils.common.run_cmd", return_value=["PID NAME", "1, /test"])
-    def testDeletedCheckNonEmpty(self, mock_cmd):
+    @mock.patch("cleaner.scripts.check_deleted_files.scan_deleted_files",
+            return_value=[check_deleted_files.DeletedFile(1, 3, "python", None, None, "/test", 0, (1, 2), True)])
+    def testDeletedCheckNonEmpty(self, mock_scan):
         mock_log = mock.Mock()
         check_deleted_files.list_and_check_files(None, mock_log)
         mock_log.info.assert_not_called()
         mock_log.warning.assert_called_once()
 
 
+class TestDockerCleaner(TestCase):
+
+    def setUp(self):
+        setup_logging()
+        self.docker_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.docker_root)
+
+    def testListJobContainers(self):
+        write_file(os.path.join(make_container(self.docker_root, "c1", "k8s_POD_container_1_2_3_4"), "f"), 4096)
+        write_file(os.path.join(make_container(self.docker_root, "c2", "container_1_2_3_4"), "f"), 4096)
+        write_file(os.path.join(make_container(self.docker_root, "c3", "container_1_2_3_5", running=False), "f"), 4096)
+
+        cleaner = DockerCleaner(90, 60, docker_root=self.docker_root)
+        cleaner.check_and_clean()
+        containers = cleaner.list_job_containers()
+        self.assertEqual(1, len(containers))
+        self.assertEqual(("c2", "test", "container_1_2_3_4"), containers[0][:3])
+        self.assertTrue(containers[0].size >= 4096)
+
+    def testPlanEviction(self):
+        GB = 1024**3
+        containers = [
+                JobContainer("large", "test", "container_1_2_3_1", 10 * GB, 0.0),
+                JobContainer("medium", "test", "container_1_2_3_2", 5 * GB, 0.0),
+                JobContainer("growing", "test", "container_1_2_3_3", 1 * GB, 1.0 * GB),
+                JobContainer("small", "test", "container_1_2_3_4", 0.5 * GB, 0.0),
+                ]
+        self.assertEqual(["large"], [c.id for c in plan_eviction(containers, 8 * GB, 5)])
+        self.assertEqual(["large", "growing"], [c.id for c in plan_eviction(containers, 12 * GB, 5)])
+        self.assertEqual(["growing", "large"], [c.id for c in plan_eviction(containers, 12 * GB, 10)])
+        # small containers are never picked even if not enough can be freed
+        self.assertEqual(["large", "growing", "medium"], [c.id for c in plan_eviction(containers, 100 * GB, 5)])
+        self.assertEqual([], plan_eviction(containers, 0, 5))
+
+    def testNextDelay(self):
+        GB = 1024**3
+        cleaner = DockerCleaner(90, 60, docker_root=self.docker_root)
+        self.assertEqual(DockerCleaner.min_interval, cleaner.next_delay(disk.PartitionUsage(100 * GB, 95 * GB, 5 * GB, 95), 0))
+        self.assertEqual(60, cleaner.next_delay(disk.PartitionUsage(100 * GB, 50 * GB, 50 * GB, 50), 0))
+        self.assertEqual(60, cleaner.next_delay(disk.PartitionUsage(100 * GB, 50 * GB, 50 * GB, 50), 0.1 * GB))
+        self.assertEqual(19, cleaner.next_delay(disk.PartitionUsage(100 * GB, 50 * GB, 50 * GB, 50), 1.0 * GB))
+
+    @mock.patch("subprocess.Popen")
+    def testEvictContainers(self, mock_popen):
+        GB = 1024**3
+        cleaner = DockerCleaner(90, 60, docker_root=self.docker_root)
+        containers = [
+                JobContainer("c1", "test", "container_1_2_3_4", 10 * GB, 0.0),
+                JobContainer("c2", "test", "container_1_2_3_5", 5 * GB, 0.0),
+                ]
+        usage = disk.PartitionUsage(100 * GB, 95 * GB, 5 * GB, 95)
+        with mock.patch.object(cleaner, "write_error_log") as mock_log:
+            victims = cleaner.evict_containers(usage, containers)
+            self.assertEqual(["c1"], [c.id for c in victims])
+            mock_log.assert_called_once()
+        mock_popen.assert_called_once_with(["docker", "kill", "--signal=10", "c1"])
+
+        # space of the killed container is not freed yet
+        mock_popen.reset_mock()
+        self.assertEqual([], cleaner.evict_containers(usage, containers[1:]))
+        mock_popen.assert_not_called()
+
+    def testWriteErrorLog(self):
+        cleaner = DockerCleaner(90, 60, docker_root=self.docker_root)
+        container = JobContainer("c1", "test", "k8s_container_e01_1_2_3_4", 2 * 1024**3, 0.0)
+        m = mock.mock_open()
+        with mock.patch("os.path.isdir", return_value=True):
+            with mock.patch("cleaner.scripts.clean_docker.open", m, create=True):
+                cleaner.write_error_log(container, disk.PartitionUsage(100, 95, 5, 95), 1024**3, 1)
+        m.assert_called_once_with("/logs/application_1_2/container_e01_1_2_3_4/diskCleaner.pai.error", "w")
+        reason = m().writelines.call_args[0][0][1]
+        self.assertTrue("Container cost: 2.0G" in reason)
+        self.assertTrue("Need to free: 1.0G" in reason)
+
+    def testEvictNothing(self):
+        write_file(os.path.join(make_container(self.docker_root, "c1", "container_1_2_3_4"), "f"), 4096)
+        cleaner = DockerCleaner(0, 60, docker_root=self.docker_root)
+        self.assertEqual(DockerCleaner.min_interval, cleaner.check_and_clean())
+
+
+    def testWatchDirs(self):
+        upper = make_container(self.docker_root, "c1", "container_1_2_3_4")
+        make_container(self.docker_root, "c2", "container_1_2_3_5", running=False)
+        cleaner = DockerCleaner(90, 60, docker_root=self.docker_root, watch_paths=["/logs"])
+        self.assertEqual([upper, "/logs"], cleaner.watch_dirs())
+
+        shutil.rmtree(os.path.join(self.docker_root, "containers"))
+        self.assertEqual([self.docker_root, "/logs"], cleaner.watch_dirs())
+
+    def testWaitIdle(self):
+        cleaner = DockerCleaner(90, 60, docker_root=self.docker_root)
+        mock_watcher = mock.Mock()
+        mock_watcher.wait.return_value = 0
+        with mock.patch("cleaner.utils.disk.get_partition_usage") as mock_usage:
+            start = time.time()
+            cleaner.wait(mock_watcher, 0.5)
+            self.assertTrue(time.time() - start >= 0.5)
+            mock_usage.assert_not_called()
+
+    @mock.patch("time.sleep")
+    def testWaitActivity(self, mock_sleep):
+        GB = 1024**3
+        cleaner = DockerCleaner(90, 60, docker_root=self.docker_root)
+        mock_watcher = mock.Mock()
+        mock_watcher.wait.return_value = 1
+        mock_watcher.read_events.return_value = 1000
+
+        # clock ticks a second at every call, disk fills at 10G per sample and reaches threshold within the delay
+        usages = [disk.PartitionUsage(100 * GB, 50 * GB, 50 * GB, 50), disk.PartitionUsage(100 * GB, 60 * GB, 40 * GB, 60)]
+        with mock.patch("cleaner.utils.disk.get_partition_usage", side_effect=usages) as mock_usage:
+            with mock.patch("time.time", side_effect=itertools.count()):
+                cleaner.wait(mock_watcher, 60)
+            self.assertEqual(2, mock_usage.call_count)
+
+        with mock.patch("cleaner.utils.disk.get_partition_usage", return_value=disk.PartitionUsage(100 * GB, 95 * GB, 5 * GB, 95)) as mock_usage:
+            with mock.patch("time.time", side_effect=itertools.count()):
+                cleaner.wait(mock_watcher, 60)
+            self.assertEqual(1, mock_usage.call_count)
+
+        # a single event is enough, repeated writes to one file are merged by the kernel
+        mock_watcher.read_events.return_value = 0
+        with mock.patch("cleaner.utils.disk.get_partition_usage", return_value=disk.PartitionUsage(100 * GB, 95 * GB, 5 * GB, 95)) as mock_usage:
+            with mock.patch("time.time", side_effect=itertools.count()):
+                cleaner.wait(mock_watcher, 60)
+            self.assertEqual(1, mock_usage.call_count)
+
+    def testWaitOneLargeFile(self):
+        cleaner = DockerCleaner(90, 60, docker_root=self.docker_root)
+        root = tempfile.mkdtemp()
+        w = watcher.InotifyWatcher([root])
+        stop = threading.Event()
+
+        def fill():
+            with open(os.path.join(root, "f"), "wb") as f:
+                while not stop.is_set():
+                    f.write(b"\0" * 1024 * 1024)
+                    f.flush()
+                    f.seek(0)
+
+        # disk grows 10G every sample and reaches threshold before the delay ends
+        used = itertools.count(50 * GB, 10 * GB)
+        def usage(path):
+            u = next(used)
+            return disk.PartitionUsage(100 * GB, u, 100 * GB - u, u * 100 // (100 * GB))
+
+        t = threading.Thread(target=fill)
+        t.start()
+        try:
+            with mock.patch("cleaner.utils.disk.get_partition_usage", side_effect=usage) as mock_usage:
+                start = time.time()
+                cleaner.wait(w, 60)
+                self.assertTrue(time.time() - start < 10)
+                self.assertTrue(mock_usage.call_count >= 2)
+        finally:
+            stop.set()
+            t.join()
+            w.close()
+            shutil.rmtree(root)
+
 if __name__ == "__main__":
     main()
@@ -18,6 +18,8 @@
 from cleaner.utils.logger import LoggerMixin
 from cleaner.utils.timer import CountdownTimer, Timeout
 from cleaner.utils.common import *
+from cleaner.utils import disk
+from cleaner.utils import watcher
 from datetime import timedelta
 from unittest import TestCase, main
 import time
@@ -26,6 +28,9 @@
 import signal
 import os
 import psutil
+import json
+import shutil
+import tempfile
 
 
 def ps_raise(procs, timeout, callback):
@@ -144,5 +149,208 @@ def testKillProcessTreeError(self, mock_kill):
         self.assertTrue(proc.poll() is not None)
 
 
+def make_container(docker_root, container_id, name, running=True):
+    mount_id = "mount_" + container_id
+    os.makedirs(os.path.join(docker_root, "containers", container_id))
+    with open(os.path.join(docker_root, "containers", container_id, "config.v2.json"), "w") as f:
+        json.dump({"Name": "/" + name, "Config": {"Image": "test"}, "State": {"Running": running}}, f)
+    mount_dir = os.path.join(docker_root, "image", "overlay2", "layerdb", "mounts", container_id)
+    os.makedirs(mount_dir)
+    with open(os.path.join(mount_dir, "mount-id"), "w") as f:
+        f.write(mount_id)
+    upper_dir = os.path.join(docker_root, "overlay2", mount_id, "diff")
+    os.makedirs(upper_dir)
+    return upper_dir
+
+
+def write_file(path, size):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+
+class DiskTest(TestCase):
+
+    def setUp(self):
+        setup_logging()
+        self.docker_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.docker_root)
+
+    def testPartitionUsage(self):
+        usage = disk.get_partition_usage("/")
+        self.assertTrue(usage.total > 0)
+        self.assertTrue(usage.used <= usage.total)
+        self.assertTrue(0 <= usage.percent <= 100)
+
+    def testFormatSize(self):
+        self.assertEqual(disk.format_size(512), "512B")
+        self.assertEqual(disk.format_size(1536), "1.5K")
+        self.assertEqual(disk.format_size(3 * 1024**3), "3.0G")
+
+    def testListContainers(self):
+        make_container(self.docker_root, "c1", "k8s_POD_test")
+        make_container(self.docker_root, "c2", "container_1_2_3_4", running=False)
+        # container being created has no mount yet
+        os.makedirs(os.path.join(self.docker_root, "containers", "c3"))
+
+        tracker = disk.LayerSizeTracker(self.docker_root)
+        self.assertTrue(tracker.is_supported())
+        containers = sorted(tracker.list_containers())
+        self.assertEqual(2, len(containers))
+        self.assertEqual(disk.Container("c1", "k8s_POD_test", "test", True, "mount_c1"), containers[0])
+        self.assertFalse(containers[1].running)
+
+    def testRefresh(self):
+        upper_dir = make_container(self.docker_root, "c1", "container_1_2_3_4")
+        os.makedirs(os.path.join(upper_dir, "a", "b"))
+        write_file(os.path.join(upper_dir, "a", "b", "f1"), 64 * 1024)
+
+        tracker = disk.LayerSizeTracker(self.docker_root)
+        containers = tracker.list_containers()
+        size = tracker.refresh(containers)["c1"].size
+        self.assertTrue(size >= 64 * 1024)
+
+        # file grows in place, mtime of its dir does not change
+        with open(os.path.join(upper_dir, "a", "b", "f1"), "ab") as f:
+            f.write(b"x" * 1024 * 1024)
+        grown = tracker.refresh(containers)["c1"].size
+        self.assertTrue(grown >= size + 1024 * 1024)
+
+        self.assertTrue(tracker.rates["c1"] > 0)
+
+        shutil.rmtree(os.path.join(upper_dir, "a"))
+        self.assertTrue(tracker.refresh(containers)["c1"].size < size)
+        self.assertEqual(1, len(tracker.walk_cache["mount_c1"]))
+
+    def testRefreshSkipUnchangedDir(self):
+        upper_dir = make_container(self.docker_root, "c1", "container_1_2_3_4")
+        write_file(os.path.join(upper_dir, "f1"), 4096)
+
+        tracker = disk.LayerSizeTracker(self.docker_root)
+        containers = tracker.list_containers()
+        tracker.refresh(containers)
+        with mock.patch("os.listdir", side_effect=OSError) as mock_listdir:
+            tracker.refresh(containers)
+            mock_listdir.assert_not_called()
+
+    def testRefreshCacheLimit(self):
+        upper_dir = make_container(self.docker_root, "c1", "container_1_2_3_4")
+        for d in ["a", "b"]:
+            os.makedirs(os.path.join(upper_dir, d))
+            for i in range(3):
+                write_file(os.path.join(upper_dir, d, str(i)), 4096)
+
+        tracker = disk.LayerSizeTracker(self.docker_root)
+        containers = tracker.list_containers()
+        expected = tracker.refresh(containers)["c1"].size
+        self.assertEqual(8, tracker.cached_entries)
+        self.assertEqual(["0", "1", "2"], sorted(tracker.walk_cache["mount_c1"][os.path.join(upper_dir, "a")].files))
+
+        # directories beyond the limit are walked without the cache
+        limited = disk.LayerSizeTracker(self.docker_root)
+        with mock.patch.object(disk.LayerSizeTracker, "max_cached_entries", 5):
+            self.assertEqual(expected, limited.refresh(containers)["c1"].size)
+            self.assertTrue(limited.cached_entries <= 5)
+            write_file(os.path.join(upper_dir, "b", "3"), 4096)
+            self.assertTrue(limited.refresh(containers)["c1"].size > expected)
+            self.assertTrue(limited.cached_entries <= 5)
+
+        tracker.refresh([])
+        self.assertEqual(0, tracker.cached_entries)
+
+    def testRefreshBudget(self):
+        make_container(self.docker_root, "c1", "container_1_2_3_4")
+        tracker = disk.LayerSizeTracker(self.docker_root)
+        self.assertEqual({}, tracker.refresh(tracker.list_containers(), budget=-1))
+
+    def testCacheFile(self):
+        upper_dir = make_container(self.docker_root, "c1", "container_1_2_3_4")
+        write_file(os.path.join(upper_dir, "f1"), 4096)
+        cache_file = os.path.join(self.docker_root, "cache.json")
+
+        tracker = disk.LayerSizeTracker(self.docker_root, cache_file)
+        sizes = tracker.refresh(tracker.list_containers())
+        self.assertEqual(sizes, disk.LayerSizeTracker(self.docker_root, cache_file).sizes)
+
+        with open(cache_file, "w") as f:
+            f.write("broken")
+        self.assertEqual({}, disk.LayerSizeTracker(self.docker_root, cache_file).sizes)
+
+
+class WatcherTest(TestCase):
+
+    def setUp(self):
+        setup_logging()
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testInotify(self):
+        w = watcher.InotifyWatcher([self.root])
+        try:
+            self.assertEqual(0, w.wait(0.1))
+            os.makedirs(os.path.join(self.root, "a"))
+            self.assertTrue(w.wait(1) > 0)
+            self.assertEqual(2, len(w.dirs))
+
+            # new directory is watched as well
+            write_file(os.path.join(self.root, "a", "f"), 4096)
+            self.assertTrue(w.wait(1) > 0)
+        finally:
+            w.close()
+
+    def testInotifyMaxWatches(self):
+        for i in range(3):
+            os.makedirs(os.path.join(self.root, str(i)))
+        with mock.patch.object(watcher.InotifyWatcher, "max_watches", 2):
+            w = watcher.InotifyWatcher([self.root])
+        self.assertEqual(2, len(w.dirs))
+        w.close()
+
+    def testInotifyUpdate(self):
+        for name in ["a/x/y", "b/z", "c"]:
+            os.makedirs(os.path.join(self.root, name))
+        w = watcher.InotifyWatcher([os.path.join(self.root, "a")])
+        try:
+            self.assertEqual(3, len(w.dirs))
+
+            # trees no longer wanted are not watched, new ones are
+            w.update([os.path.join(self.root, "b"), os.path.join(self.root, "c")])
+            self.assertEqual({os.path.join(self.root, p) for p in ["b", "b/z", "c"]}, set(w.dirs.values()))
+            write_file(os.path.join(self.root, "a", "x", "f"), 4096)
+            self.assertEqual(0, w.wait(0.1))
+            write_file(os.path.join(self.root, "b", "z", "f"), 4096)
+            self.assertTrue(w.wait(1) > 0)
+
+            # watch of a removed directory is released
+            shutil.rmtree(os.path.join(self.root, "c"))
+            w.wait(1)
+            self.assertEqual({os.path.join(self.root, p) for p in ["b", "b/z"]}, set(w.dirs.values()))
+        finally:
+            w.close()
+
+    def testFanotify(self):
+        try:
+            w = watcher.FanotifyWatcher([self.root])
+        except OSError:
+            # requires CAP_SYS_ADMIN
+            return
+        try:
+            write_file(os.path.join(self.root, "f"), 4096)
+            self.assertTrue(w.wait(1) > 0)
+        finally:
+            w.close()
+
+    def testCreateWatcher(self):
+        self.assertTrue(watcher.create_watcher(["/not/exist"]) is None)
+
+        with mock.patch.object(watcher.FanotifyWatcher, "__init__", side_effect=OSError(1, "not permitted")):
+            w = watcher.create_watcher([self.root])
+        self.assertTrue(isinstance(w, watcher.InotifyWatcher))
+        w.close()
+
+
 if __name__ == "__main__":
     main()
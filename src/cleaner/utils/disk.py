@@ -0,0 +1,285 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import collections
+import json
+import math
+import os
+import stat
+import time
+from cleaner.utils.logger import LoggerMixin
+
+# Account disk usage without asking docker. `docker ps --size` walks the
+# writable layer of every container inside the docker daemon and can take
+# minutes on a full disk, exactly when a quick decision is needed. Instead the
+# partition usage is read by statvfs, and the writable layer (the overlay2
+# upperdir) of every container is walked by ourselves. Directories whose mtime
+# is unchanged since last walk are not listed again, and the size of every
+# layer is persisted so that a restarted cleaner can rank containers before its
+# first walk completes.
+
+PartitionUsage = collections.namedtuple("PartitionUsage", ["total", "used", "free", "percent"])
+
+Container = collections.namedtuple("Container", ["id", "name", "image", "running", "mount_id"])
+
+LayerSize = collections.namedtuple("LayerSize", ["mount_id", "size", "time"])
+
+
+def get_partition_usage(path):
+    """
+    Gets usage of the partition which the path is on, the same as what `df` reports.
+
+    :param path: any path on the partition
+    :return PartitionUsage in bytes, percent is rounded up like the Use% of `df`
+    """
+    st = os.statvfs(path)
+    total = st.f_blocks * st.f_frsize
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    # blocks reserved for root are not available to containers
+    free = st.f_bavail * st.f_frsize
+    if used + free > 0:
+        percent = int(math.ceil(used * 100.0 / (used + free)))
+    else:
+        percent = 0
+    return PartitionUsage(total, used, free, percent)
+
+
+def format_size(size):
+    """ formats size in bytes to the human readable form of `df -h`, e.g. 1.5G """
+    for unit in ["B", "K", "M", "G", "T"]:
+        if abs(size) < 1024 or unit == "T":
+            break
+        size /= 1024.0
+    if unit == "B":
+        return "{0}{1}".format(int(size), unit)
+    return "{0:.1f}{1}".format(size, unit)
+
+
+class DirEntry(object):
+    """
+    Names of children of a directory seen in last walk, valid as long as mtime of the directory is unchanged.
+    Names are relative to the directory, so that paths of files are not kept in memory.
+    """
+    __slots__ = ["mtime", "files", "dirs"]
+
+    def __init__(self, mtime, files, dirs):
+        self.mtime = mtime
+        self.files = files
+        self.dirs = dirs
+
+    def __len__(self):
+        return len(self.files) + len(self.dirs)
+
+
+class LayerSizeTracker(LoggerMixin):
+    """
+    Tracks size of the writable layer of containers using overlay2 storage driver.
+    Not thread safe.
+    """
+
+    # upper bound of names cached for all layers, about 100 bytes each in memory. A layer with millions
+    # of files, e.g. a dataset extracted into the container, is partly walked without the cache.
+    max_cached_entries = 1000000
+
+    def __init__(self, docker_root="/var/lib/docker", cache_file=None):
+        self.docker_root = docker_root
+        self.containers_dir = os.path.join(docker_root, "containers")
+        self.mounts_dir = os.path.join(docker_root, "image", "overlay2", "layerdb", "mounts")
+        self.layers_dir = os.path.join(docker_root, "overlay2")
+        self.cache_file = cache_file
+        self.sizes = {} # key is container id, value is LayerSize
+        self.rates = {} # key is container id, value is growth in bytes per second between last two walks
+        self.walk_cache = {} # key is mount id, value is dict of dir path to DirEntry
+        self.cached_entries = 0 # number of names in walk_cache
+        self.load()
+
+    def is_supported(self):
+        return os.path.isdir(self.containers_dir) and os.path.isdir(self.mounts_dir)
+
+    def upper_dir(self, mount_id):
+        return os.path.join(self.layers_dir, mount_id, "diff")
+
+    def list_containers(self):
+        """ lists containers by reading metadata under docker root, the docker daemon is not involved """
+        containers = []
+        try:
+            ids = os.listdir(self.containers_dir)
+        except OSError:
+            self.logger.error("failed to list containers under %s", self.containers_dir)
+            return containers
+
+        for container_id in ids:
+            try:
+                with open(os.path.join(self.containers_dir, container_id, "config.v2.json")) as f:
+                    config = json.load(f)
+                with open(os.path.join(self.mounts_dir, container_id, "mount-id")) as f:
+                    mount_id = f.read().strip()
+            except (IOError, OSError, ValueError):
+                # container is being created or removed
+                self.logger.debug("failed to read metadata of container %s", container_id, exc_info=True)
+                continue
+
+            containers.append(Container(
+                container_id,
+                config.get("Name", "").lstrip("/"),
+                config.get("Config", {}).get("Image", ""),
+                config.get("State", {}).get("Running", False),
+                mount_id))
+        return containers
+
+    def walk(self, root, cache, deadline=None):
+        """
+        Walks the directory tree and sums up space used by files in it.
+
+        :param root: the directory to walk
+        :param cache: dict of dir path to DirEntry from last walk, updated in place
+        :param deadline: give up walking after this time
+        :return size in bytes, or None if deadline is reached
+        """
+        size = 0
+        visited = set()
+        inodes = set() # hard links are only counted once
+        stack = [root]
+        while stack:
+            if deadline is not None and time.time() > deadline:
+                return None
+
+            path = stack.pop()
+            try:
+                st = os.lstat(path)
+            except OSError:
+                # removed after listed
+                continue
+            visited.add(path)
+            size += st.st_blocks * 512
+
+            entry = cache.get(path)
+            if entry is not None and entry.mtime == st.st_mtime:
+                # entries are unchanged, but files may have grown in place
+                dirs = entry.dirs
+                for name in entry.files:
+                    try:
+                        size += self._file_size(os.lstat(os.path.join(path, name)), inodes)
+                    except OSError:
+                        continue
+            else:
+                if entry is not None:
+                    self._drop(cache, path)
+                try:
+                    names = os.listdir(path)
+                except OSError:
+                    continue
+                files = []
+                dirs = []
+                for name in names:
+                    try:
+                        child_st = os.lstat(os.path.join(path, name))
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(child_st.st_mode):
+                        dirs.append(name)
+                    else:
+                        files.append(name)
+                        size += self._file_size(child_st, inodes)
+                if self.cached_entries + len(files) + len(dirs) <= self.max_cached_entries:
+                    cache[path] = DirEntry(st.st_mtime, files, dirs)
+                    self.cached_entries += len(files) + len(dirs)
+
+            stack.extend(os.path.join(path, name) for name in dirs)
+
+        for path in list(cache.keys()):
+            if path not in visited:
+                self._drop(cache, path)
+        return size
+
+    def _drop(self, cache, path):
+        self.cached_entries -= len(cache.pop(path))
+
+    @staticmethod
+    def _file_size(st, inodes):
+        if st.st_nlink > 1:
+            if st.st_ino in inodes:
+                return 0
+            inodes.add(st.st_ino)
+        return st.st_blocks * 512
+
+    def refresh(self, containers, budget=None):
+        """
+        Updates size of the writable layer of containers. Layers are walked from the largest
+        one in last refresh, so if the budget runs out, sizes of the smaller ones are left stale.
+
+        :param containers: list of Container
+        :param budget: seconds allowed for walking, None means no limit
+        :return dict of container id to LayerSize
+        """
+        deadline = time.time() + budget if budget is not None else None
+
+        current = dict((c.id, c) for c in containers)
+        for container_id in list(self.sizes.keys()):
+            if container_id not in current or self.sizes[container_id].mount_id != current[container_id].mount_id:
+                self.sizes.pop(container_id)
+                self.rates.pop(container_id, None)
+        mount_ids = set(c.mount_id for c in containers)
+        for mount_id in list(self.walk_cache.keys()):
+            if mount_id not in mount_ids:
+                self.cached_entries -= sum(len(entry) for entry in self.walk_cache.pop(mount_id).values())
+
+        def last_size(c):
+            # never walked layers go first since they can be of any size
+            last = self.sizes.get(c.id)
+            return last.size if last is not None else float("inf")
+
+        walked = 0
+        for c in sorted(containers, key=last_size, reverse=True):
+            size = self.walk(self.upper_dir(c.mount_id), self.walk_cache.setdefault(c.mount_id, {}), deadline)
+            if size is None:
+                self.logger.warning("budget of %s seconds ran out, %d of %d layers walked",
+                        budget, walked, len(containers))
+                break
+            last = self.sizes.get(c.id)
+            layer = self.sizes[c.id] = LayerSize(c.mount_id, size, time.time())
+            if last is not None and layer.time > last.time:
+                self.rates[c.id] = max(0.0, float(layer.size - last.size) / (layer.time - last.time))
+            walked += 1
+
+        self.save()
+        return self.sizes
+
+    def load(self):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as f:
+                content = json.load(f)
+            for container_id, layer in content.items():
+                self.sizes[container_id] = LayerSize(layer["mount_id"], layer["size"], layer["time"])
+            self.logger.info("loaded size of %d layers from %s", len(self.sizes), self.cache_file)
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+            self.logger.exception("failed to load layer sizes from %s, ignore it", self.cache_file)
+            self.sizes = {}
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        content = dict((k, v._asdict()) for k, v in self.sizes.items())
+        tmp_file = self.cache_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(content, f)
+            # rename is atomic, so the cache file is never half written
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError):
+            self.logger.exception("failed to save layer sizes to %s", self.cache_file)
@@ -0,0 +1,87 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import json
+import socket
+
+try:
+    import httplib
+    from urllib import quote, urlencode
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import quote, urlencode
+
+# A minimal client of docker engine api through its unix socket, so that the
+# cleaner does not need to fork docker cli and parse its human readable output.
+
+
+class DockerApiError(Exception):
+    def __init__(self, method, path, status, body):
+        Exception.__init__(self, "%s %s returns %d: %s" % (method, path, status, body))
+        self.path = path
+        self.status = status
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """ HTTPConnection that connects to an unix domain socket """
+
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class DockerClient(object):
+
+    def __init__(self, socket_path="/var/run/docker.sock", timeout=300):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, method, path, params=None):
+        """ returns decoded json body, raises DockerApiError if docker returns non 2xx status code """
+        if params:
+            path = path + "?" + urlencode(params)
+        conn = UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            conn.request(method, path)
+            resp = conn.getresponse()
+            status, body = resp.status, resp.read()
+        finally:
+            conn.close()
+
+        body = body.decode("utf-8", "replace")
+        if status // 100 != 2:
+            raise DockerApiError(method, path, status, body.strip())
+        return json.loads(body) if body.strip() else None
+
+    def system_df(self):
+        return self.request("GET", "/system/df")
+
+    def remove_container(self, container_id):
+        return self.request("DELETE", "/containers/" + quote(container_id, safe=""))
+
+    def remove_image(self, image):
+        """ image is either an image id or a repo tag, removing the last tag of an image removes the image """
+        return self.request("DELETE", "/images/" + quote(image, safe=""))
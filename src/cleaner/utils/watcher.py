@@ -0,0 +1,260 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import ctypes
+import ctypes.util
+import errno
+import multiprocessing
+import os
+import select
+import struct
+from cleaner.utils.logger import LoggerMixin
+
+# Watch write activity on the file system, so that disk usage is only sampled
+# when something is being written. fanotify marks the whole file system with a
+# single mark, but requires CAP_SYS_ADMIN and linux 4.20. inotify is not
+# recursive, so a watch is added to every directory under the given
+# directories up to a limit, the caller picks directories where writes are
+# expected and updates them when they change. Both are called through ctypes
+# since python 2 has no binding.
+
+FAN_CLOEXEC = 0x00000001
+FAN_NONBLOCK = 0x00000002
+FAN_CLASS_NOTIF = 0x00000000
+FAN_REPORT_FID = 0x00000200
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_FILESYSTEM = 0x00000100
+FAN_MODIFY = 0x00000002
+FAN_CLOSE_WRITE = 0x00000008
+FAN_Q_OVERFLOW = 0x00004000
+AT_FDCWD = -100
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# struct fanotify_event_metadata
+FAN_EVENT = struct.Struct("=IBBHQii")
+# struct inotify_event without the trailing name
+IN_EVENT = struct.Struct("=iIII")
+
+# an overflowed queue means a lot of events are dropped
+OVERFLOW_EVENTS = 16384
+
+_libc = None
+
+
+def get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+
+def raise_errno(name):
+    err = ctypes.get_errno()
+    raise OSError(err, "{0}: {1}".format(name, os.strerror(err)))
+
+
+class Watcher(LoggerMixin):
+    """ base class of watchers, subclasses parse events from fd """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.poller = select.poll()
+        self.poller.register(fd, select.POLLIN)
+
+    def fileno(self):
+        return self.fd
+
+    def wait(self, timeout):
+        """ blocks until there are events or timeout in seconds, returns number of events read """
+        try:
+            if not self.poller.poll(max(0, int(timeout * 1000))):
+                return 0
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return 0
+            raise
+        return self.read_events()
+
+    def read_events(self):
+        """ reads all pending events without blocking, returns number of them """
+        count = 0
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return count
+                raise
+            if not data:
+                return count
+            count += self.parse(data)
+
+    def parse(self, data):
+        raise NotImplementedError()
+
+    def update(self, dirs):
+        """ replaces directories where writes are expected, ignored if the whole file system is watched """
+        pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FanotifyWatcher(Watcher):
+
+    def __init__(self, paths):
+        libc = get_libc()
+        libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+        flags = FAN_CLASS_NOTIF | FAN_CLOEXEC | FAN_NONBLOCK
+        # with FAN_REPORT_FID no fd is opened for every event, which is much cheaper
+        fd = libc.fanotify_init(flags | FAN_REPORT_FID, os.O_RDONLY)
+        if fd < 0:
+            fd = libc.fanotify_init(flags, os.O_RDONLY | getattr(os, "O_LARGEFILE", 0))
+        if fd < 0:
+            raise_errno("fanotify_init")
+
+        try:
+            for path in paths:
+                if libc.fanotify_mark(fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM, FAN_MODIFY | FAN_CLOSE_WRITE,
+                        AT_FDCWD, path.encode("utf-8")) < 0:
+                    raise_errno("fanotify_mark")
+        except OSError:
+            os.close(fd)
+            raise
+        super(FanotifyWatcher, self).__init__(fd)
+
+    def parse(self, data):
+        count = 0
+        offset = 0
+        while offset + FAN_EVENT.size <= len(data):
+            event_len, _, _, _, mask, fd, _ = FAN_EVENT.unpack_from(data, offset)
+            if fd >= 0:
+                os.close(fd)
+            count += OVERFLOW_EVENTS if mask & FAN_Q_OVERFLOW else 1
+            offset += event_len
+        return count
+
+
+class InotifyWatcher(Watcher):
+    # upper bound of directories watched, fs.inotify.max_user_watches is shared by the whole node
+    max_watches = 8192
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+
+    def __init__(self, dirs):
+        libc = get_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise_errno("inotify_init1")
+        super(InotifyWatcher, self).__init__(fd)
+        self.dirs = {} # key is watch descriptor, value is dir path
+        self.roots = set() # directories whose trees are watched
+
+        try:
+            self.update(dirs)
+        except Exception:
+            self.close()
+            raise
+
+    def update(self, dirs):
+        """ watches trees of dirs, and stops watching trees not in dirs any more """
+        dirs = set(dirs)
+        removed = self.roots - dirs
+        added = dirs - self.roots
+        if not removed and not added:
+            return
+
+        for wd, path in list(self.dirs.items()):
+            if any(path == root or path.startswith(root + os.sep) for root in removed):
+                # fails if the directory is already gone, which removes the watch as well
+                get_libc().inotify_rm_watch(self.fd, wd)
+                self.dirs.pop(wd)
+
+        # walk breadth first so that shallow directories are watched when the limit is reached
+        queue = sorted(added)
+        while queue and len(self.dirs) < self.max_watches:
+            path = queue.pop(0)
+            if not self.add_watch(path):
+                continue
+            try:
+                queue.extend(os.path.join(path, name) for name in os.listdir(path)
+                        if os.path.isdir(os.path.join(path, name)) and not os.path.islink(os.path.join(path, name)))
+            except OSError:
+                continue
+        self.roots = dirs
+        self.logger.info("watching %d directories under %d trees by inotify", len(self.dirs), len(self.roots))
+
+    def add_watch(self, path):
+        if len(self.dirs) >= self.max_watches:
+            return False
+        wd = get_libc().inotify_add_watch(self.fd, path.encode("utf-8"), self.mask)
+        if wd < 0:
+            self.logger.debug("failed to watch %s: %s", path, os.strerror(ctypes.get_errno()))
+            return False
+        self.dirs[wd] = path
+        return True
+
+    def parse(self, data):
+        count = 0
+        offset = 0
+        while offset + IN_EVENT.size <= len(data):
+            wd, mask, _, length = IN_EVENT.unpack_from(data, offset)
+            name_start = offset + IN_EVENT.size
+            offset = name_start + length
+            if mask & IN_Q_OVERFLOW:
+                count += OVERFLOW_EVENTS
+                continue
+            if mask & IN_IGNORED:
+                # directory is removed, its watch is gone
+                self.dirs.pop(wd, None)
+                continue
+            count += 1
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self.dirs:
+                name = data[name_start:offset].rstrip(b"\0").decode("utf-8", "replace")
+                self.add_watch(os.path.join(self.dirs[wd], name))
+        return count
+
+
+def create_watcher(paths, dirs=None):
+    """
+    returns a watcher of write activity, or None if neither fanotify nor inotify works. fanotify watches
+    the file systems of paths, inotify falls back to watch trees of dirs, which defaults to paths
+    """
+    paths = [p for p in paths if os.path.isdir(p)]
+    if not paths:
+        return None
+    if dirs is None:
+        dirs = paths
+    for cls, args in [(FanotifyWatcher, paths), (InotifyWatcher, dirs)]:
+        try:
+            watcher = cls(args)
+            watcher.logger.info("watching write activity under %s by %s", args, cls.__name__)
+            return watcher
+        except (OSError, AttributeError) as e:
+            # AttributeError is raised if libc has no such function
+            multiprocessing.get_logger().warning("cannot watch %s by %s: %s", paths, cls.__name__, e)
+    return None
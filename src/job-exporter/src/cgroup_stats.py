@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import re
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# `docker stats --no-stream` is slow because dockerd samples every container
+# twice with an interval of one second. Counters it reports are read from
+# cgroup files, so we can read them ourselves and compute cpu percent from
+# deltas between two iterations. Both cgroup v1 and v2 (unified) are supported.
+
+# docker uses <id> as cgroup name under cgroupfs driver and docker-<id>.scope
+# under systemd driver
+container_cgroup_reg = re.compile(r"^(?:docker-)?([0-9a-f]{64})(?:\.scope)?$")
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def read_int(path):
+    return int(read_file(path).strip())
+
+
+def read_kv(path):
+    """ read file in format of `key value` per line, e.g. memory.stat """
+    result = {}
+    for line in read_file(path).splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            result[parts[0]] = int(parts[1])
+    return result
+
+
+def parse_blkio_service_bytes(content):
+    """ parse v1 blkio.*io_service_bytes*, return read, write in byte """
+    read = write = 0
+    for line in content.splitlines():
+        parts = line.split()
+        if len(parts) != 3:
+            continue
+        if parts[1] == "Read":
+            read += int(parts[2])
+        elif parts[1] == "Write":
+            write += int(parts[2])
+    return read, write
+
+
+def parse_io_stat(content):
+    """ parse v2 io.stat, return read, write in byte """
+    read = write = 0
+    for line in content.splitlines():
+        for field in line.split()[1:]:
+            k, _, v = field.partition("=")
+            if k == "rbytes":
+                read += int(v)
+            elif k == "wbytes":
+                write += int(v)
+    return read, write
+
+
+def parse_net_dev(content):
+    """ parse /proc/<pid>/net/dev, return received, transmitted bytes of all
+    interfaces except loopback """
+    rx = tx = 0
+    for line in content.splitlines()[2:]:
+        name, _, data = line.partition(":")
+        if name.strip() == "lo":
+            continue
+        fields = data.split()
+        if len(fields) >= 9:
+            rx += int(fields[0])
+            tx += int(fields[8])
+    return rx, tx
+
+
+class CgroupStatsReader(object):
+    """ read stats of all running containers from cgroup files, output has
+    same format as docker_stats.parse_docker_stats. Not thread safe. """
+    def __init__(self, client, cgroup_root="/sys/fs/cgroup", proc_root="/proc"):
+        self.client = client
+        self.cgroup_root = cgroup_root
+        self.proc_root = proc_root
+
+        self.unified = os.path.isfile(os.path.join(cgroup_root, "cgroup.controllers"))
+
+        self.paths = {} # key is full container id, value is relative cgroup path
+        self.last_cpu = {} # key is full container id, value is (cpu usage ns, time)
+        self.host_mem = None
+
+    def index_cgroups(self):
+        """ walk cgroup hierarchy to find cgroups of all containers, including those
+        created by kubelet """
+        if self.unified:
+            base = self.cgroup_root
+        else:
+            base = os.path.join(self.cgroup_root, "memory")
+
+        paths = {}
+        for path, dirs, _ in os.walk(base):
+            remaining = []
+            for d in dirs:
+                m = container_cgroup_reg.match(d)
+                if m is None:
+                    remaining.append(d)
+                else:
+                    paths[m.group(1)] = os.path.relpath(os.path.join(path, d), base)
+            dirs[:] = remaining # no need to walk into container cgroup
+
+        self.paths = paths
+
+    def get_host_mem(self):
+        if self.host_mem is None:
+            for line in read_file(os.path.join(self.proc_root, "meminfo")).splitlines():
+                if line.startswith("MemTotal:"):
+                    self.host_mem = int(line.split()[1]) * 1024
+                    break
+        return self.host_mem
+
+    def controller_path(self, controller, rel_path, name):
+        if self.unified:
+            return os.path.join(self.cgroup_root, rel_path, name)
+        return os.path.join(self.cgroup_root, controller, rel_path, name)
+
+    def read_cpu(self, rel_path):
+        """ return cpu usage in ns """
+        if self.unified:
+            stat = read_kv(self.controller_path("cpu", rel_path, "cpu.stat"))
+            return stat["usage_usec"] * 1000
+        return read_int(self.controller_path("cpuacct", rel_path, "cpuacct.usage"))
+
+    def read_mem(self, rel_path):
+        """ return usage and limit in byte, page cache that can be reclaimed is
+        not counted as usage, this is the same as docker cli """
+        if self.unified:
+            usage = read_int(self.controller_path("memory", rel_path, "memory.current"))
+            limit = read_file(self.controller_path("memory", rel_path, "memory.max")).strip()
+            limit = None if limit == "max" else int(limit)
+            inactive = read_kv(self.controller_path("memory", rel_path,
+                "memory.stat")).get("inactive_file", 0)
+        else:
+            usage = read_int(self.controller_path("memory", rel_path, "memory.usage_in_bytes"))
+            limit = read_int(self.controller_path("memory", rel_path, "memory.limit_in_bytes"))
+            inactive = read_kv(self.controller_path("memory", rel_path,
+                "memory.stat")).get("total_inactive_file", 0)
+
+        host_mem = self.get_host_mem()
+        if limit is None or (host_mem is not None and limit > host_mem):
+            limit = host_mem
+
+        if inactive < usage:
+            usage -= inactive
+
+        return usage, limit
+
+    def read_blkio(self, rel_path):
+        if self.unified:
+            return parse_io_stat(read_file(self.controller_path("io", rel_path, "io.stat")))
+
+        for name in ["blkio.io_service_bytes_recursive", "blkio.throttle.io_service_bytes"]:
+            path = self.controller_path("blkio", rel_path, name)
+            if os.path.isfile(path):
+                read, write = parse_blkio_service_bytes(read_file(path))
+                if read != 0 or write != 0:
+                    return read, write
+        return 0, 0
+
+    def read_net(self, rel_path):
+        """ read network counters in container's network namespace, return 0
+        if container is using host network, this is the same as docker cli """
+        procs = self.controller_path("memory", rel_path, "cgroup.procs")
+        pids = read_file(procs).split()
+        if len(pids) == 0:
+            return 0, 0
+
+        pid = pids[0]
+        try:
+            host_ns = os.readlink(os.path.join(self.proc_root, "1", "ns", "net"))
+            container_ns = os.readlink(os.path.join(self.proc_root, pid, "ns", "net"))
+            if host_ns == container_ns:
+                return 0, 0
+        except OSError:
+            pass
+
+        return parse_net_dev(read_file(os.path.join(self.proc_root, pid, "net", "dev")))
+
+    def read_container(self, container_id, name, now):
+        rel_path = self.paths[container_id]
+
+        cpu = self.read_cpu(rel_path)
+        mem_usage, mem_limit = self.read_mem(rel_path)
+        block_in, block_out = self.read_blkio(rel_path)
+        net_in, net_out = self.read_net(rel_path)
+
+        cpu_percent = 0.0
+        if container_id in self.last_cpu:
+            last_cpu, last_time = self.last_cpu[container_id]
+            if now > last_time and cpu >= last_cpu:
+                cpu_percent = (cpu - last_cpu) / ((now - last_time) * 10 ** 9) * 100
+        self.last_cpu[container_id] = (cpu, now)
+
+        mem_percent = 0.0
+        if mem_limit:
+            mem_percent = mem_usage / mem_limit * 100
+
+        return {
+            "id": container_id[:12],
+            "name": name,
+            "CPUPerc": cpu_percent,
+            "MemUsage_Limit": {"usage": mem_usage, "limit": mem_limit},
+            "NetIO": {"in": net_in, "out": net_out},
+            "BlockIO": {"in": block_in, "out": block_out},
+            "MemPerc": mem_percent,
+            }
+
+    def list_containers(self, histogram, timeout):
+        """ return map with full container id as key and name as value """
+        result = {}
+        for container in self.client.get("/containers/json",
+                histogram=histogram, timeout=timeout):
+            names = container.get("Names") or [container["Id"]]
+            result[container["Id"]] = names[0].lstrip("/")
+        return result
+
+    def read_stats(self, containers):
+        if any(map(lambda c_id: c_id not in self.paths, containers)):
+            self.index_cgroups()
+
+        now = time.monotonic()
+        result = {}
+
+        for container_id, name in containers.items():
+            if container_id not in self.paths:
+                logger.warning("can not find cgroup of container %s %s", container_id, name)
+                continue
+            try:
+                stats = self.read_container(container_id, name, now)
+                result[stats["id"]] = stats
+            except (IOError, OSError, KeyError, ValueError):
+                # container may exited after we list it
+                logger.warning("failed to read cgroup stats of container %s %s",
+                        container_id, name, exc_info=True)
+
+        for container_id in list(self.last_cpu.keys()):
+            if container_id not in containers:
+                self.last_cpu.pop(container_id)
+
+        return result
+
+    def stats(self, histogram, api_histogram, timeout):
+        """ return None on error, so caller can fall back to docker cli """
+        try:
+            containers = self.list_containers(api_histogram, timeout)
+            with histogram.time():
+                return self.read_stats(containers)
+        except Exception:
+            logger.exception("failed to read container stats from cgroup")
+        return None
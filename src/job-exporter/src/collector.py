@@ -25,15 +25,20 @@
 import copy
 import os
 import collections
+import concurrent.futures
+import functools
 
 from prometheus_client import make_wsgi_app, Counter, Gauge, Histogram
 from prometheus_client.core import GaugeMetricFamily
 
+from pai_exporter_runtime import executor, instrument, utils
+from pai_exporter_runtime.ref import AtomicRef
+
 import network
-import utils
-import docker_inspect
+import net_accounting
 import docker_stats
 import nvidia
+import nvml
 import ps
 
 logger = logging.getLogger(__name__)
@@ -42,8 +47,6 @@
 ##### collector will generate following metrics
 # Document about these metrics is in `` # TODO
 
-iteration_counter = Counter("collector_iteration_count", "total number of iteration",
-        ["name"])
 
 def gen_docker_daemon_counter():
     return GaugeMetricFamily("docker_daemon_count",
@@ -95,6 +98,11 @@ def gen_process_mem_usage_gauge():
             "memory usage of process, to save space in prometheus, we only expose those who consume more than 500Mb of memory",
             labels=["pid", "cmd"])
 
+def gen_container_stale_gauge():
+    return GaugeMetricFamily("container_metrics_stale",
+            "metrics of this container are carried forward from previous iteration since processing missed the deadline",
+            labels=["container_id"])
+
 class ResourceGauges(object):
     def __init__(self):
         self.task_labels = [
@@ -181,30 +189,21 @@ def add_value(self, metric_name, labels, val):
     def as_array(self):
         return self.gauges.values()
 
-#####
 
-class AtomicRef(object):
-    """ a thread safe way to store and get object,
-    should not modify data get from this ref,
-    each get and set method should provide a time obj,
-    so this ref decide whether the data is out of date or not,
-    return None on expired """
-    def __init__(self, decay_time):
-        self.data = None
-        self.date_in_produced = datetime.datetime.now()
-        self.decay_time = decay_time
-        self.lock = threading.RLock()
-
-    def set(self, data, now):
-        with self.lock:
-            self.data, self.date_in_produced = data, now
-
-    def get(self, now):
-        with self.lock:
-            if self.date_in_produced + self.decay_time < now:
-                return None
-            return self.data
+class GaugeValues(object):
+    """ record values to be added to ResourceGauges later, this is used to
+    collect values of one container in worker thread """
+    def __init__(self):
+        self.values = []
 
+    def add_value(self, metric_name, labels, val):
+        self.values.append((metric_name, labels, val))
+
+    def add_to(self, gauges):
+        for metric_name, labels, val in self.values:
+            gauges.add_value(metric_name, labels, val)
+
+#####
 
 class Collector(object):
     """ collector is a model running in thread and responsible for collecting
@@ -212,36 +211,38 @@ class Collector(object):
     collector can not have impact on other collectors. This is base class,
     real collector should inhernit this class and implement collect_impl,
     metrics are returned as an array."""
-    def __init__(self, name, sleep_time, atomic_ref, iteration_counter):
+    def __init__(self, name, sleep_time, atomic_ref, tracker):
         self.name = name
         self.sleep_time = sleep_time
         self.atomic_ref = atomic_ref
-        self.iteration_counter = iteration_counter
-
-        histogram_key = "collector_%s_iteration_lantecy_seconds" % self.name
-        histogram_desc = "latency for execute one interation of %s collector (seconds)" % \
-                self.name
-        self.collector_histogram = Histogram(histogram_key, histogram_desc,
-                buckets=(.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0,
-                    7.5, 10.0, 12.5, 15.0, 17.5, 20.0, float("inf")))
+        self.tracker = tracker # instrument.IterationTracker recording iterations
+        self.scheduler = None # if set, use scheduler to decide when to collect instead of sleep
 
         logger.debug("init %s with sleep_time %d", self.name, self.sleep_time)
 
     def collect(self):
         while True:
+            deadline = None
+            if self.scheduler is not None:
+                deadline = self.scheduler.wait_turn(self.name)
+
             logger.debug("collecting metrics from %s", self.name)
 
-            with self.collector_histogram.time():
-                self.iteration_counter.labels(name=self.name).inc()
-                try:
+            start = time.time()
+            try:
+                with self.tracker.iteration(self.name):
                     self.atomic_ref.set(self.collect_impl(), datetime.datetime.now())
-                except Exception as e:
-                    logger.exception("%s collector get an exception", self.name)
+            except Exception as e:
+                logger.exception("%s collector get an exception", self.name)
 
+            if self.scheduler is not None:
+                self.scheduler.finish(self.name, deadline, time.time() - start)
+                logger.debug("finished collect metrcis from %s for deadline %s",
+                        self.name, deadline)
+            else:
                 logger.debug("finished collect metrcis from %s, will sleep for %s",
                         self.name, self.sleep_time)
-
-            time.sleep(self.sleep_time)
+                time.sleep(self.sleep_time)
 
     def collect_impl(self):
         """ implementations are expected to return an array of
@@ -252,15 +253,19 @@ def collect_impl(self):
 def instantiate_collector(name, sleep_time, decay_time, collector_class, *args):
     """ test cases helper fn to instantiate a collector """
     atomic_ref = AtomicRef(decay_time)
-    return atomic_ref, collector_class(name, sleep_time, atomic_ref, iteration_counter, *args)
+    return atomic_ref, collector_class(name, sleep_time, atomic_ref, instrument.TRACKER, *args)
 
 
-def make_collector(name, sleep_time, decay_time, collector_class, *args):
+def make_collector(name, sleep_time, decay_time, collector_class, *args, scheduler=None):
     """ other module should use this fn to init a collector, this fn start a thread
     to run the collector and return an atomic_ref so outside world can get metrics
-    collected by this collector """
+    collected by this collector. If scheduler is provided, sleep_time is ignored """
     atomic_ref, instance = instantiate_collector(name, sleep_time, decay_time, collector_class, *args)
 
+    if scheduler is not None:
+        scheduler.register(name)
+        instance.scheduler = scheduler
+
     t = threading.Thread(
             target=instance.collect,
             name=name,
@@ -310,12 +315,16 @@ class GpuCollector(Collector):
 
     cmd_timeout = 60 # 99th latency is 0.97s
 
-    def __init__(self, name, sleep_time, atomic_ref, iteration_counter,
-            gpu_info_ref, zombie_info_ref, mem_leak_thrashold):
-        Collector.__init__(self, name, sleep_time, atomic_ref, iteration_counter)
+    nvml_histogram = Histogram("nvml_query_latency_seconds",
+            "Latency for querying gpu status from nvml (seconds)")
+
+    def __init__(self, name, sleep_time, atomic_ref, tracker,
+            gpu_info_ref, zombie_info_ref, mem_leak_thrashold, nvml_handle=None):
+        Collector.__init__(self, name, sleep_time, atomic_ref, tracker)
         self.gpu_info_ref = gpu_info_ref
         self.zombie_info_ref = zombie_info_ref
         self.mem_leak_thrashold = mem_leak_thrashold
+        self.nvml_handle = nvml_handle # None means using nvidia-smi
 
     @staticmethod
     def get_container_id(pid):
@@ -401,8 +410,13 @@ def convert_to_metrics(gpu_info, zombie_info, pid_to_cid_fn, mem_leak_thrashold)
             external_process, zombie_container, gpu_temp]
 
     def collect_impl(self):
-        gpu_info = nvidia.nvidia_smi(GpuCollector.cmd_histogram,
-                GpuCollector.cmd_timeout)
+        gpu_info = None
+        if self.nvml_handle is not None:
+            gpu_info = nvml.nvml_query(self.nvml_handle, GpuCollector.nvml_histogram)
+
+        if gpu_info is None:
+            gpu_info = nvidia.nvidia_smi(GpuCollector.cmd_histogram,
+                    GpuCollector.cmd_timeout)
 
         logger.debug("get gpu_info %s", gpu_info)
 
@@ -424,10 +438,19 @@ class ContainerCollector(Collector):
     # Because prometheus's largest bucket for recording histogram is 10s,
     # we can not get value higher than 10s.
 
+    cgroup_stats_histogram = Histogram("cgroup_stats_latency_seconds",
+            "Latency for reading container stats from cgroup (seconds)")
+    list_api_histogram = Histogram("docker_api_list_latency_seconds",
+            "Docker api call latency for listing containers (seconds)")
+    list_timeout = 2
+
     inspect_histogram = Histogram("cmd_docker_inspect_latency_seconds",
             "Command call latency for docker inspect (seconds)")
     inspect_timeout = 1 # 99th latency is 0.042s
 
+    inspect_api_histogram = Histogram("docker_api_inspect_latency_seconds",
+            "Docker api call latency for inspecting container (seconds)")
+
     iftop_histogram = Histogram("cmd_iftop_latency_seconds",
             "Command call latency for iftop (seconds)")
     iftop_timeout = 10 # 99th latency is 7.4s
@@ -436,6 +459,10 @@ class ContainerCollector(Collector):
             "Command call latency for lsof (seconds)")
     lsof_timeout = 2 # 99th latency is 0.5s
 
+    ss_histogram = Histogram("cmd_ss_latency_seconds",
+            "Command call latency for ss (seconds)")
+    ss_timeout = 5
+
     pai_services = list(map(lambda s: "k8s_" + s, [
         "rest-server",
         "pylon",
@@ -468,11 +495,23 @@ class ContainerCollector(Collector):
         "jobmanager",
         ]))
 
-    def __init__(self, name, sleep_time, atomic_ref, iteration_counter, gpu_info_ref,
-            stats_info_ref, interface):
-        Collector.__init__(self, name, sleep_time, atomic_ref, iteration_counter)
+    def __init__(self, name, sleep_time, atomic_ref, tracker, gpu_info_ref,
+            stats_info_ref, interface, inspect_cache, stats_reader,
+            concurrency=8, deadline=5, net_accounting=None):
+        Collector.__init__(self, name, sleep_time, atomic_ref, tracker)
         self.gpu_info_ref = gpu_info_ref
         self.stats_info_ref = stats_info_ref
+        self.inspect_cache = inspect_cache
+        self.stats_reader = stats_reader # None means using docker cli
+        self.net_accounting = net_accounting # None means using iftop & lsof
+
+        # containers are processed concurrently, those can not be finished
+        # before deadline will use values from previous iteration
+        self.pool = executor.Executor(name, max_workers=concurrency)
+        self.deadline = deadline
+        self.values_lock = threading.Lock()
+        self.container_values = {} # key is container id, value is GaugeValues
+        self.in_flight = {} # key is container id, value is future
 
         self.network_interface = network.try_to_get_right_interface(interface)
         logger.info("found %s as potential network interface to listen network traffic",
@@ -484,12 +523,26 @@ def __init__(self, name, sleep_time, atomic_ref, iteration_counter, gpu_info_ref
         # with "k8s_POD" consume nothing.
 
     def collect_impl(self):
-        all_conns = network.iftop(self.network_interface,
-                ContainerCollector.iftop_histogram,
-                ContainerCollector.iftop_timeout)
+        net_usage = all_conns = None
+        if self.net_accounting is not None:
+            net_usage = self.net_accounting.sample(ContainerCollector.ss_histogram,
+                    ContainerCollector.ss_timeout)
+
+        if net_usage is None:
+            all_conns = network.iftop(self.network_interface,
+                    ContainerCollector.iftop_histogram,
+                    ContainerCollector.iftop_timeout)
+
+        stats_obj = None
+        if self.stats_reader is not None:
+            stats_obj = self.stats_reader.stats(
+                    ContainerCollector.cgroup_stats_histogram,
+                    ContainerCollector.list_api_histogram,
+                    ContainerCollector.list_timeout)
 
-        stats_obj = docker_stats.stats(ContainerCollector.stats_histogram,
-                ContainerCollector.stats_timeout)
+        if stats_obj is None:
+            stats_obj = docker_stats.stats(ContainerCollector.stats_histogram,
+                    ContainerCollector.stats_timeout)
 
         now = datetime.datetime.now()
         gpu_infos = self.gpu_info_ref.get(now)
@@ -499,7 +552,7 @@ def collect_impl(self):
         logger.debug("gpu_info is %s", gpu_infos)
         logger.debug("stats_obj is %s", stats_obj)
 
-        return self.collect_container_metrics(stats_obj, gpu_infos, all_conns)
+        return self.collect_container_metrics(stats_obj, gpu_infos, all_conns, net_usage)
 
     @staticmethod
     def parse_from_labels(inspect_info, gpu_infos):
@@ -552,12 +605,14 @@ def infer_service_name(cls, container_name):
 
         return None
 
-    def process_one_container(self, container_id, stats, gpu_infos, all_conns, gauges):
+    def process_one_container(self, container_id, stats, gpu_infos, all_conns, gauges,
+            net_usage=None):
         container_name = utils.walk_json_field_safe(stats, "name")
         pai_service_name = ContainerCollector.infer_service_name(container_name)
 
-        inspect_info = docker_inspect.inspect(container_id,
+        inspect_info = self.inspect_cache.inspect(container_id,
                 ContainerCollector.inspect_histogram,
+                ContainerCollector.inspect_api_histogram,
                 ContainerCollector.inspect_timeout)
 
         pid = inspect_info.pid
@@ -573,13 +628,17 @@ def process_one_container(self, container_id, stats, gpu_infos, all_conns, gauge
         # get network consumption, since all our services/jobs running in host
         # network, and network statistic from docker is not specific to that
         # container. We have to get network statistic by ourselves.
-        lsof_result = network.lsof(pid,
-                ContainerCollector.lsof_histogram,
-                ContainerCollector.lsof_timeout)
+        if net_usage is not None:
+            net_in, net_out = net_usage.container_usage(pid)
+            logger.debug("pid %s has network in %d, out %d", pid, net_in, net_out)
+        else:
+            lsof_result = network.lsof(pid,
+                    ContainerCollector.lsof_histogram,
+                    ContainerCollector.lsof_timeout)
 
-        net_in, net_out = network.get_container_network_metrics(all_conns,
-                lsof_result)
-        if logger.isEnabledFor(logging.DEBUG):
+            net_in, net_out = network.get_container_network_metrics(all_conns,
+                    lsof_result)
+        if net_usage is None and logger.isEnabledFor(logging.DEBUG):
             debug_info = utils.exec_cmd(
                     "ps -o cmd fp {0} | tail -n 1".format(pid),
                     shell=True)
@@ -623,21 +682,77 @@ def process_one_container(self, container_id, stats, gpu_infos, all_conns, gauge
             gauges.add_value("service_block_in_byte", labels, stats["BlockIO"]["in"])
             gauges.add_value("service_block_out_byte", labels, stats["BlockIO"]["out"])
 
-    def collect_container_metrics(self, stats_obj, gpu_infos, all_conns):
+    def process_container_values(self, container_id, stats, gpu_infos, all_conns,
+            net_usage):
+        values = GaugeValues()
+        self.process_one_container(container_id, stats, gpu_infos, all_conns, values,
+                net_usage)
+        return values
+
+    def finish_container(self, container_id, container_name, future):
+        """ called both in worker thread as done callback and in collector thread,
+        only the first call of one future takes effect """
+        with self.values_lock:
+            if self.in_flight.get(container_id) is not future:
+                return
+            self.in_flight.pop(container_id)
+
+            try:
+                self.container_values[container_id] = future.result()
+            except Exception:
+                self.container_values.pop(container_id, None)
+                logger.exception("error when trying to process container %s with name %s",
+                        container_id, container_name)
+
+    def collect_container_metrics(self, stats_obj, gpu_infos, all_conns, net_usage=None):
         if stats_obj is None:
             logger.warning("docker stats returns None")
             return None
 
         gauges = ResourceGauges()
+        stale = gen_container_stale_gauge()
+
+        # drop inspect result of containers that have gone
+        self.inspect_cache.retain(stats_obj)
 
+        futures = {}
         for container_id, stats in stats_obj.items():
-            try:
-                self.process_one_container(container_id, stats, gpu_infos, all_conns, gauges)
-            except Exception:
-                logger.exception("error when trying to process container %s with name %s",
-                        container_id, utils.walk_json_field_safe(stats, "name"))
+            with self.values_lock:
+                if container_id in self.in_flight:
+                    # still processing from previous iteration, do not pile up
+                    continue
+
+                future = self.pool.submit(self.process_container_values,
+                        container_id, stats, gpu_infos, all_conns, net_usage)
+                self.in_flight[container_id] = future
+
+            finish = functools.partial(self.finish_container, container_id,
+                    utils.walk_json_field_safe(stats, "name"))
+            future.add_done_callback(finish)
+            futures[future] = finish
+
+        done, _ = concurrent.futures.wait(futures.keys(), timeout=self.deadline)
+        for future in done:
+            futures[future](future)
+
+        with self.values_lock:
+            for container_id in list(self.container_values.keys()):
+                if container_id not in stats_obj:
+                    self.container_values.pop(container_id)
+
+            for container_id in stats_obj.keys():
+                if container_id in self.in_flight:
+                    logger.warning("container %s missed deadline, use previous values",
+                            container_id)
+                    stale.add_metric([container_id], 1)
+
+                values = self.container_values.get(container_id)
+                if values is not None:
+                    values.add_to(gauges)
 
-        return gauges.as_array()
+        result = list(gauges.as_array())
+        result.append(stale)
+        return result
 
 
 class ZombieCollector(Collector):
@@ -684,11 +799,17 @@ def update(self, zombie_ids, now):
         def __len__(self):
             return len(self.zombies)
 
-    def __init__(self, name, sleep_time, atomic_ref, iteration_counter, stats_info_ref, zombie_ids_ref):
-        Collector.__init__(self, name, sleep_time, atomic_ref, iteration_counter)
+    def __init__(self, name, sleep_time, atomic_ref, tracker, stats_info_ref,
+            zombie_ids_ref, log_detector=None):
+        Collector.__init__(self, name, sleep_time, atomic_ref, tracker)
         self.stats_info_ref = stats_info_ref
         self.zombie_ids_ref = zombie_ids_ref
 
+        # container_logs.LogMarkerDetector, follow json log files of containers
+        # incrementally, fall back to docker logs if it is None or log can not
+        # be read
+        self.log_detector = log_detector
+
         self.type1_zombies = ZombieCollector.ZombieRecorder("job_exit_hangs")
         self.type2_zombies = ZombieCollector.ZombieRecorder("residual_job")
 
@@ -749,6 +870,11 @@ def docker_logs(self, container_id, tail="all"):
         return ""
 
     def is_container_exited(self, container_id):
+        if self.log_detector is not None:
+            exited = self.log_detector.is_marked(container_id)
+            if exited is not None:
+                return exited
+
         logs = self.docker_logs(container_id, tail=50)
         if re.search(u"USER COMMAND END", logs):
             return True
@@ -765,6 +891,9 @@ def update_zombie_count(self, stats):
             logger.warning("docker stats is None")
             return
 
+        if self.log_detector is not None:
+            self.log_detector.retain(stats)
+
         exited_containers = set(filter(self.is_container_exited, stats.keys()))
 
         now = datetime.datetime.now()
@@ -786,14 +915,34 @@ class ProcessCollector(Collector):
 
     cmd_timeout = 10 # TODO 99th latency is xxx
 
-    def __init__(self, name, sleep_time, atomic_ref, iteration_counter):
-        Collector.__init__(self, name, sleep_time, atomic_ref, iteration_counter)
+    proc_histogram = Histogram("proc_scan_latency_seconds",
+            "Latency for reading process info from /proc (seconds)")
+
+    # only record large memory consumption to save space in prometheus
+    mem_threshold = 500 * 1024 * 1024
+
+    def __init__(self, name, sleep_time, atomic_ref, tracker, proc_reader=None):
+        Collector.__init__(self, name, sleep_time, atomic_ref, tracker)
+        # ps.ProcReader, call ps if it is None or failed
+        self.proc_reader = proc_reader
+
+    def get_process_info(self):
+        if self.proc_reader is not None:
+            process_info = self.proc_reader.get_process_info(
+                    ProcessCollector.proc_histogram, ProcessCollector.mem_threshold)
+            if process_info is not None:
+                return process_info
 
-    def collect_impl(self):
         process_info = ps.get_process_info(ProcessCollector.cmd_histogram,
                 ProcessCollector.cmd_timeout)
-
         if len(process_info) > 0:
+            return process_info
+        return None
+
+    def collect_impl(self):
+        process_info = self.get_process_info()
+
+        if process_info is not None:
             zombie_metrics = gen_zombie_process_counter()
             process_mem_metrics = gen_process_mem_usage_gauge()
             zombie_count = collections.defaultdict(lambda : 0)
@@ -807,8 +956,7 @@ def collect_impl(self):
                         cmd = info.cmd.split()[0] # remove args
                         zombie_count[cmd] += 1
 
-                if info.rss > 500 * 1024 * 1024:
-                    # only record large memory consumption to save space in prometheus
+                if info.rss > ProcessCollector.mem_threshold:
                     cmd = info.cmd.split()[0] # remove args
                     process_mem_metrics.add_metric([str(info.pid), cmd], info.rss)
 
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Follow json-file logs written by docker under <docker root>/containers/<id>/
+# to find out whether a container has printed a marker line, instead of
+# running `docker logs --tail` for every container in every iteration.
+# Only bytes appended since last read are scanned, and once the marker is
+# found, the container is remembered and its log is never read again.
+
+
+class LogState(object):
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.offset = None # None means never read
+        self.found = False
+
+
+class LogMarkerDetector(object):
+    """ not thread safe """
+    # when we first see a container, only scan the tail of its log, this is
+    # similar to `docker logs --tail 50`
+    initial_window = 64 * 1024
+
+    # upper bound of bytes read in one call, the rest is read next time
+    max_read = 16 * 1024 * 1024
+
+    def __init__(self, docker_root="/var/lib/docker", marker="USER COMMAND END"):
+        self.containers_dir = os.path.join(docker_root, "containers")
+        self.marker = marker.encode("utf-8")
+        self.states = {} # key is container id as in docker stats
+
+    def find_log(self, container_id):
+        """ container_id may be short id, return path of its json log or None """
+        try:
+            for name in os.listdir(self.containers_dir):
+                if name.startswith(container_id):
+                    path = os.path.join(self.containers_dir, name, name + "-json.log")
+                    if os.path.isfile(path):
+                        return path
+                    return None
+        except OSError:
+            logger.debug("failed to list %s", self.containers_dir, exc_info=True)
+        return None
+
+    def scan(self, state):
+        with open(state.path, "rb") as f:
+            st = os.fstat(f.fileno())
+
+            if state.offset is None:
+                offset = max(0, st.st_size - LogMarkerDetector.initial_window)
+            elif st.st_ino != state.inode or st.st_size < state.offset:
+                # log rotated by docker, new file should be read from beginning
+                offset = 0
+            else:
+                offset = state.offset
+
+            f.seek(offset)
+            data = f.read(LogMarkerDetector.max_read)
+
+        if state.offset is None and offset > 0:
+            # skip partial line in the middle of file
+            start = data.find(b"\n") + 1
+        else:
+            start = 0
+
+        # only scan complete lines, partial line at the end is scanned next time
+        end = data.rfind(b"\n") + 1
+
+        state.inode = st.st_ino
+        state.offset = offset + max(start, end)
+
+        if end > start and data.find(self.marker, start, end) != -1:
+            state.found = True
+
+    def is_marked(self, container_id):
+        """ return True if marker appeared in log of container, None if log of
+        the container can not be read, e.g. it is not using json-file driver """
+        state = self.states.get(container_id)
+        if state is None:
+            path = self.find_log(container_id)
+            if path is None:
+                return None
+            state = self.states[container_id] = LogState(path)
+
+        if state.found:
+            return True
+
+        try:
+            self.scan(state)
+        except OSError:
+            logger.debug("failed to read log %s", state.path, exc_info=True)
+            self.states.pop(container_id)
+            return None
+
+        return state.found
+
+    def retain(self, container_ids):
+        """ drop states of containers not in container_ids """
+        for container_id in list(self.states.keys()):
+            if container_id not in container_ids:
+                self.states.pop(container_id)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import http.client
+import json
+import logging
+import socket
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# We talk to docker daemon through its unix socket instead of forking docker
+# cli for every call. Connections are kept alive and reused between calls, so
+# one call only costs a round trip to dockerd.
+
+
+class DockerApiError(Exception):
+    def __init__(self, path, status, body):
+        Exception.__init__(self, "requesting %s returns %d: %s" % (path, status, body))
+        self.path = path
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTPConnection that connects to an unix domain socket """
+    def __init__(self, socket_path, timeout=None):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class DockerClient(object):
+    """ a thread safe docker engine api client with a pool of keep-alive
+    connections """
+    def __init__(self, socket_path="/var/run/docker.sock", pool_size=4):
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self.pool = []
+        self.lock = threading.Lock()
+
+    def _acquire(self, timeout):
+        with self.lock:
+            conn = self.pool.pop() if self.pool else None
+        if conn is None:
+            conn = UnixHTTPConnection(self.socket_path)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def _release(self, conn):
+        with self.lock:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(conn)
+                return
+        conn.close()
+
+    def _request(self, conn, path):
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+
+    def get(self, path, histogram=None, timeout=None):
+        """ GET path and return decoded json object, raise DockerApiError if
+        docker returns non 2xx status code """
+        logger.debug("about to request docker api %s", path)
+
+        if histogram is not None:
+            with histogram.time():
+                return self._get(path, timeout)
+        return self._get(path, timeout)
+
+    def _get(self, path, timeout):
+        conn = self._acquire(timeout)
+        try:
+            try:
+                status, body = self._request(conn, path)
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+                # pooled connection may have been closed by dockerd, retry once
+                # with a fresh connection
+                conn.close()
+                status, body = self._request(conn, path)
+        except Exception:
+            conn.close()
+            raise
+
+        self._release(conn)
+
+        if status // 100 != 2:
+            raise DockerApiError(path, status, body.decode("utf-8", "replace").strip())
+
+        return json.loads(body.decode("utf-8"))
+
+    def inspect_container(self, container_id, histogram=None, timeout=None):
+        return self.get("/containers/%s/json" % urllib.parse.quote(container_id),
+                histogram=histogram, timeout=timeout)
+
+    def events(self, filters):
+        """ subscribe to docker events and return a generator of event objects,
+        the generator will block until next event arrives and stops when
+        connection to dockerd broken """
+        path = "/events?filters=" + urllib.parse.quote(json.dumps(filters))
+
+        conn = UnixHTTPConnection(self.socket_path)
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            if resp.status // 100 != 2:
+                raise DockerApiError(path, resp.status,
+                        resp.read().decode("utf-8", "replace").strip())
+        except Exception:
+            conn.close()
+            raise
+
+        def gen():
+            try:
+                while True:
+                    line = resp.readline()
+                    if not line:
+                        return
+                    line = line.strip()
+                    if line:
+                        yield json.loads(line.decode("utf-8"))
+            finally:
+                conn.close()
+
+        return gen()
+
+
+class EventWatcher(object):
+    """ follow docker events stream in a thread and dispatch container events
+    to listeners. Listeners must be fast since they are called in watcher's
+    thread. Because events may have been lost while we are disconnected from
+    dockerd, listeners' reset fn is called every time connection is
+    (re)established, listeners should drop all states derived from events. """
+    filters = {"type": ["container"],
+            "event": ["start", "die", "destroy", "rename", "update"]}
+
+    def __init__(self, client, retry_interval=5):
+        self.client = client
+        self.retry_interval = retry_interval
+        self.listeners = []
+        self.connected = False
+        self.lock = threading.RLock()
+
+    def add_listener(self, on_event, on_reset):
+        with self.lock:
+            self.listeners.append((on_event, on_reset))
+
+    def is_connected(self):
+        with self.lock:
+            return self.connected
+
+    def set_connected(self, connected):
+        with self.lock:
+            self.connected = connected
+            listeners = list(self.listeners)
+
+        for _, on_reset in listeners:
+            on_reset()
+
+    def dispatch(self, event):
+        with self.lock:
+            listeners = list(self.listeners)
+
+        for on_event, _ in listeners:
+            try:
+                on_event(event)
+            except Exception:
+                logger.exception("listener failed to process docker event %s", event)
+
+    def watch(self):
+        while True:
+            try:
+                events = self.client.events(EventWatcher.filters)
+                self.set_connected(True)
+                for event in events:
+                    self.dispatch(event)
+                logger.warning("docker events stream closed by dockerd")
+            except Exception:
+                logger.exception("failed to follow docker events")
+            finally:
+                self.set_connected(False)
+
+            time.sleep(self.retry_interval)
+
+    def start(self):
+        t = threading.Thread(target=self.watch, name="docker_event_watcher",
+                daemon=True)
+        t.start()
+        return t
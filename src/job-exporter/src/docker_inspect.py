@@ -20,8 +20,9 @@
 import json
 import sys
 import logging
+import threading
 
-import utils
+from pai_exporter_runtime import utils
 
 logger = logging.getLogger(__name__)
 
@@ -53,17 +54,22 @@ def __eq__(self, o):
 
 
 def parse_docker_inspect(inspect_output):
+    """ parse output of `docker inspect`, which is an array of inspect object """
     obj = json.loads(inspect_output)
+    return parse_inspect_object(utils.walk_json_field_safe(obj, 0))
 
+def parse_inspect_object(obj):
+    """ parse one inspect object, which is also the result of docker api
+    /containers/{id}/json """
     m = {}
 
-    obj_labels = utils.walk_json_field_safe(obj, 0, "Config", "Labels")
+    obj_labels = utils.walk_json_field_safe(obj, "Config", "Labels")
     if obj_labels is not None:
         for k, v in obj_labels.items():
             if k in keys:
                 m[k] = v
 
-    obj_env = utils.walk_json_field_safe(obj, 0, "Config", "Env")
+    obj_env = utils.walk_json_field_safe(obj, "Config", "Env")
     if obj_env:
         for env in obj_env:
             k, v = env.split("=", 1)
@@ -76,7 +82,7 @@ def parse_docker_inspect(inspect_output):
             elif k == "NVIDIA_VISIBLE_DEVICES" and v != "all" and v != "void":
                 m["GPU_ID"] = v
 
-    pid = utils.walk_json_field_safe(obj, 0, "State", "Pid")
+    pid = utils.walk_json_field_safe(obj, "State", "Pid")
 
     return InspectResult(
             m.get("PAI_USER_NAME") or m.get("DLWS_USER_NAME"),
@@ -100,3 +106,80 @@ def inspect(container_id, histogram, timeout):
         logger.warning("docker inspect timeout")
     except Exception:
         logger.exception("exec docker inspect error")
+
+
+class InspectCache(object):
+    """ cache inspect result using docker api. Labels, env and pid of a container
+    do not change during its life, so we only need to inspect a container once.
+    The cache is invalidated by docker events, and is bypassed when we are not
+    following events, since we may have missed some. If docker api is not
+    available, fall back to docker cli. Thread safe. """
+    def __init__(self, client, watcher):
+        self.client = client
+        self.watcher = watcher
+        self.cache = {} # key is container id, value is InspectResult
+        self.generation = 0 # increased every time cache may become outdated
+        self.lock = threading.RLock()
+
+        if watcher is not None:
+            watcher.add_listener(self.on_event, self.on_reset)
+
+    def on_event(self, event):
+        full_id = event.get("id") or utils.walk_json_field_safe(event, "Actor", "ID")
+        if full_id is None:
+            return
+
+        with self.lock:
+            self.generation += 1
+            # caller may use short id to inspect
+            for key in list(self.cache.keys()):
+                if full_id.startswith(key):
+                    logger.debug("invalidate inspect cache of %s due to event %s",
+                            key, event.get("status"))
+                    self.cache.pop(key)
+
+    def on_reset(self):
+        with self.lock:
+            self.generation += 1
+            self.cache = {}
+
+    def retain(self, container_ids):
+        """ remove all caches of containers not in container_ids """
+        with self.lock:
+            for key in list(self.cache.keys()):
+                if key not in container_ids:
+                    self.cache.pop(key)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.cache)
+
+    def inspect(self, container_id, cmd_histogram, api_histogram, timeout):
+        with self.lock:
+            result = self.cache.get(container_id)
+            generation = self.generation
+
+        if result is not None:
+            return result
+
+        if self.client is None:
+            return inspect(container_id, cmd_histogram, timeout)
+
+        try:
+            obj = self.client.inspect_container(container_id,
+                    histogram=api_histogram, timeout=timeout)
+        except Exception:
+            logger.exception("failed to inspect %s using docker api, fall back to docker cli",
+                    container_id)
+            return inspect(container_id, cmd_histogram, timeout)
+
+        result = parse_inspect_object(obj)
+
+        with self.lock:
+            # only cache it when no event arrived since we sent request, otherwise
+            # the result may be outdated already
+            if generation == self.generation and \
+                    self.watcher is not None and self.watcher.is_connected():
+                self.cache[container_id] = result
+
+        return result
@@ -18,10 +18,10 @@
 
 import subprocess
 import sys
-import re
 import logging
 
-import utils
+from pai_exporter_runtime import utils
+from pai_exporter_runtime.utils import convert_to_byte
 
 logger = logging.getLogger(__name__)
 
@@ -40,28 +40,6 @@ def parse_usage_limit(data):
     limitByte = convert_to_byte(usageLimit[1])
     return {"usage": usageByte, "limit": limitByte}
 
-def convert_to_byte(data):
-    data = data.lower()
-    number = float(re.findall(r"[0-9.]+", data)[0])
-    if "tb" in data:
-        return number * 10 ** 12
-    elif "gb" in data:
-        return number * 10 ** 9
-    elif "mb" in data:
-        return number * 10 ** 6
-    elif "kb" in data:
-        return number * 10 ** 3
-    elif "tib" in data:
-        return number * 2 ** 40
-    elif "gib" in data:
-        return number * 2 ** 30
-    elif "mib" in data:
-        return number * 2 ** 20
-    elif "kib" in data:
-        return number * 2 ** 10
-    else:
-        return number
-
 def parse_docker_stats(stats):
     data = [line.split(",") for line in stats.splitlines()]
     # pop the headers
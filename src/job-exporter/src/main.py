@@ -4,22 +4,22 @@
 import logging
 import os
 import json
-import threading
-import signal
-import faulthandler
-import gc
 import datetime
 
-import prometheus_client
 from prometheus_client import Gauge
 from prometheus_client.core import REGISTRY
-from prometheus_client.twisted import MetricsResource
 
-from twisted.web.server import Site
-from twisted.web.resource import Resource
-from twisted.internet import reactor
+from pai_exporter_runtime import bootstrap, cardinality, exposition, instrument, scheduler
+from pai_exporter_runtime.ref import AtomicRef
 
+import cgroup_stats
 import collector
+import container_logs
+import docker_api
+import docker_inspect
+import net_accounting
+import nvml
+import ps
 
 logger = logging.getLogger(__name__)
 
@@ -28,30 +28,6 @@
         "total number of gpu configured for this node")
 
 
-class CustomCollector(object):
-    def __init__(self, atomic_refs):
-        self.atomic_refs = atomic_refs
-
-    def collect(self):
-        data = []
-
-        now = datetime.datetime.now()
-
-        for ref in self.atomic_refs:
-            d = ref.get(now)
-            if d is not None:
-                data.extend(d)
-
-        if len(data) > 0:
-            for datum in data:
-                yield datum
-        else:
-            # https://stackoverflow.com/a/6266586
-            # yield nothing
-            return
-            yield
-
-
 def config_environ():
     """ since job-exporter needs to call nvidia-smi, we need to change
     LD_LIBRARY_PATH to correct value """
@@ -100,33 +76,9 @@ def get_gpu_count(path):
     return 0
 
 
-def register_stack_trace_dump():
-    faulthandler.register(signal.SIGTRAP, all_threads=True, chain=False)
-
-
-# https://github.com/prometheus/client_python/issues/322#issuecomment-428189291
-def burninate_gc_collector():
-    for callback in gc.callbacks[:]:
-        if callback.__qualname__.startswith("GCCollector."):
-            gc.callbacks.remove(callback)
-
-    for name, collector in list(prometheus_client.REGISTRY._names_to_collectors.items()):
-        if name.startswith("python_gc_"):
-            try:
-                prometheus_client.REGISTRY.unregister(collector)
-            except KeyError:  # probably gone already
-                pass
-
-
-class HealthResource(Resource):
-    def render_GET(self, request):
-        request.setHeader("Content-Type", "text/html; charset=utf-8")
-        return "<html>Ok</html>".encode("utf-8")
-
-
 def main(args):
-    register_stack_trace_dump()
-    burninate_gc_collector()
+    bootstrap.register_stack_trace_dump()
+    bootstrap.burninate_gc_collector()
     config_environ()
     try_remove_old_prom_file(args.log + "/gpu_exporter.prom")
     try_remove_old_prom_file(args.log + "/job_exporter.prom")
@@ -136,41 +88,99 @@ def main(args):
 
     configured_gpu_counter.set(get_gpu_count("/gpu-config/gpu-configuration.json"))
 
+    if os.path.exists(args.docker_socket):
+        docker_client = docker_api.DockerClient(args.docker_socket)
+        docker_watcher = docker_api.EventWatcher(docker_client)
+        docker_watcher.start()
+    else:
+        logger.warning("docker socket %s not found, will use docker cli instead",
+                args.docker_socket)
+        docker_client = docker_watcher = None
+
+    inspect_cache = docker_inspect.InspectCache(docker_client, docker_watcher)
+
+    stats_reader = None
+    if args.stats_backend == "cgroup":
+        if docker_client is None:
+            logger.warning("can not list containers without docker socket, will use docker stats instead")
+        elif not os.path.isdir(args.cgroup_root):
+            logger.warning("cgroup root %s not found, will use docker stats instead",
+                    args.cgroup_root)
+        else:
+            stats_reader = cgroup_stats.CgroupStatsReader(docker_client, args.cgroup_root)
+
+    net_accounting_engine = None
+    if args.network_backend == "proc":
+        net_accounting_engine = net_accounting.NetAccounting()
+
+    log_detector = None
+    containers_dir = os.path.join(args.docker_root, "containers")
+    if os.path.isdir(containers_dir):
+        log_detector = container_logs.LogMarkerDetector(args.docker_root)
+    else:
+        logger.warning("%s not found, will use docker logs to find exited containers",
+                containers_dir)
+
+    proc_reader = None
+    if args.process_backend == "proc":
+        proc_reader = ps.ProcReader()
+
+    nvml_handle = None
+    if args.gpu_backend == "nvml":
+        nvml_handle = nvml.Nvml()
+
     decay_time = datetime.timedelta(seconds=args.interval * 2)
 
     # used to exchange gpu info between GpuCollector and ContainerCollector
-    gpu_info_ref = collector.AtomicRef(decay_time)
+    gpu_info_ref = AtomicRef(decay_time)
 
     # used to exchange docker stats info between ContainerCollector and ZombieCollector
-    stats_info_ref = collector.AtomicRef(decay_time)
+    stats_info_ref = AtomicRef(decay_time)
 
     # used to exchange zombie info between GpuCollector and ZombieCollector
-    zombie_info_ref = collector.AtomicRef(decay_time)
+    zombie_info_ref = AtomicRef(decay_time)
 
     interval = args.interval
-    # Because all collector except container_collector will spent little time in calling
-    # external command to get metrics, so they need to sleep 30s to align with prometheus
-    # scrape interval. The 99th latency of container_collector loop is around 20s, so it
-    # should only sleep 10s to adapt to scrape interval
+
+    # Collectors are started by scheduler right before prometheus scrapes, with
+    # an estimated latency of their iterations, instead of sleeping fixed time.
+    # Container collector needs gpu info, and zombie collector needs docker
+    # stats from container collector.
+    collector_scheduler = scheduler.Scheduler(interval)
+    collector_scheduler.add_dependency("container_collector", "gpu_collector")
+    collector_scheduler.add_dependency("zombie_collector", "container_collector")
+
     collector_args = [
             ("docker_daemon_collector", interval, decay_time, collector.DockerCollector),
-            ("gpu_collector", interval, decay_time, collector.GpuCollector, gpu_info_ref, zombie_info_ref, args.threshold),
-            ("container_collector", max(0, interval - 18), decay_time, collector.ContainerCollector,
-                gpu_info_ref, stats_info_ref, args.interface),
-            ("zombie_collector", interval, decay_time, collector.ZombieCollector, stats_info_ref, zombie_info_ref),
-            ("process_collector", interval, decay_time, collector.ProcessCollector),
+            ("gpu_collector", interval, decay_time, collector.GpuCollector, gpu_info_ref, zombie_info_ref, args.threshold, nvml_handle),
+            ("container_collector", interval, decay_time, collector.ContainerCollector,
+                gpu_info_ref, stats_info_ref, args.interface, inspect_cache, stats_reader,
+                args.container_concurrency, args.container_deadline, net_accounting_engine),
+            ("zombie_collector", interval, decay_time, collector.ZombieCollector,
+                stats_info_ref, zombie_info_ref, log_detector),
+            ("process_collector", interval, decay_time, collector.ProcessCollector, proc_reader),
             ]
 
-    refs = list(map(lambda x: collector.make_collector(*x), collector_args))
+    refs = list(map(lambda x: collector.make_collector(*x, scheduler=collector_scheduler),
+        collector_args))
+
+    REGISTRY.register(instrument.TRACKER)
 
-    REGISTRY.register(CustomCollector(refs))
+    # metrics from collectors are rendered once every iteration and served to
+    # all scrapers, REGISTRY only contains metrics about job-exporter itself
+    if args.cardinality_config is not None:
+        limiter = cardinality.CardinalityLimiter.from_file(args.cardinality_config)
+    else:
+        limiter = cardinality.CardinalityLimiter()
+    if args.series_budget is not None:
+        limiter.budget = args.series_budget
 
-    root = Resource()
-    root.putChild(b"metrics", MetricsResource())
-    root.putChild(b"healthz", HealthResource())
-    factory = Site(root)
-    reactor.listenTCP(int(args.port), factory)
-    reactor.run()
+    exposition_cache = exposition.ExpositionCache(interval, limiter=limiter)
+    for ref in refs:
+        exposition_cache.add_source(ref)
+
+    exposition.serve(args.port, exposition_cache, collector_scheduler,
+            {b"cardinality": cardinality.CardinalityResource(limiter)})
 
 
 if __name__ == "__main__":
@@ -180,28 +190,19 @@ def main(args):
     parser.add_argument("--interval", "-i", help="prometheus scrape interval second", type=int, default=30)
     parser.add_argument("--interface", "-n", help="network interface for job-exporter to listen on", required=True)
     parser.add_argument("--threshold", "-t", help="memory threshold to consider gpu memory leak", type=int, default=20 * 1024 * 1024)
+    parser.add_argument("--docker-socket", help="unix socket of docker daemon", default="/var/run/docker.sock")
+    parser.add_argument("--container-concurrency", help="number of containers to be processed concurrently", type=int, default=8)
+    parser.add_argument("--container-deadline", help="seconds to wait for processing all containers in one iteration", type=float, default=5)
+    parser.add_argument("--network-backend", help="how to get network consumption of containers, proc will fall back to iftop on error", choices=["proc", "iftop"], default="proc")
+    parser.add_argument("--gpu-backend", help="where to get gpu status from, nvml will fall back to nvidia-smi on error", choices=["smi", "nvml"], default="smi")
+    parser.add_argument("--process-backend", help="where to get process info from, proc will fall back to ps on error", choices=["proc", "ps"], default="proc")
+    parser.add_argument("--stats-backend", help="where to get container stats from", choices=["cgroup", "docker"], default="cgroup")
+    parser.add_argument("--cgroup-root", help="mount point of host cgroup hierarchy", default="/sys/fs/cgroup")
+    parser.add_argument("--docker-root", help="root dir of docker, container logs are read from containers dir under it", default="/var/lib/docker")
+    parser.add_argument("--cardinality-config", help="json file of label allowlists, hashed labels and series budget of metrics")
+    parser.add_argument("--series-budget", help="max number of series exposed, overrides budget in cardinality config, 0 means no limit", type=int)
     args = parser.parse_args()
 
-    def get_logging_level():
-        mapping = {
-                "DEBUG": logging.DEBUG,
-                "INFO": logging.INFO,
-                "WARNING": logging.WARNING
-                }
-
-        result = logging.INFO
-
-        if os.environ.get("LOGGING_LEVEL") is not None:
-            level = os.environ["LOGGING_LEVEL"]
-            result = mapping.get(level.upper())
-            if result is None:
-                sys.stderr.write("unknown logging level " + level + \
-                        ", default to INFO\n")
-                result = logging.INFO
-
-        return result
-
-    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(threadName)s - %(filename)s:%(lineno)s - %(message)s",
-            level=get_logging_level())
+    bootstrap.config_logging()
 
     main(args)
@@ -25,7 +25,7 @@
 import struct
 import array
 
-import utils
+from pai_exporter_runtime import utils
 
 logger = logging.getLogger(__name__)
 
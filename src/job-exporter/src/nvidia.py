@@ -18,37 +18,17 @@
 
 import subprocess
 from xml.dom import minidom
+from xml.etree import ElementTree
+import io
 import os
 import logging
 import re
 
-import utils
+from pai_exporter_runtime import utils
+from pai_exporter_runtime.utils import convert_to_byte
 
 logger = logging.getLogger(__name__)
 
-def convert_to_byte(data):
-    data = data.lower()
-    number = float(re.findall(r"[0-9.]+", data)[0])
-    if "tb" in data:
-        return number * 10 ** 12
-    elif "gb" in data:
-        return number * 10 ** 9
-    elif "mb" in data:
-        return number * 10 ** 6
-    elif "kb" in data:
-        return number * 10 ** 3
-    elif "tib" in data:
-        return number * 2 ** 40
-    elif "gib" in data:
-        return number * 2 ** 30
-    elif "mib" in data:
-        return number * 2 ** 20
-    elif "kib" in data:
-        return number * 2 ** 10
-    else:
-        return number
-
-
 class EccError(object):
     """ EccError represents volatile count from one GPU card,
     see https://developer.download.nvidia.com/compute/DCGM/docs/nvidia-smi-367.38.pdf for more info """
@@ -174,12 +154,145 @@ def parse_smi_xml_result(smi):
 
     return result
 
+# fields used by parse_smi_xml_result_stream, value is tag path relative to
+# gpu element. Same as getElementsByTagName in parse_smi_xml_result, the first
+# tag in path matches the first descendant of gpu with that name, and the rest
+# of the path matches descendants of it.
+smi_fields = {
+        "minor": ("minor_number",),
+        "gpu_util": ("utilization", "gpu_util"),
+        "mem_used": ("fb_memory_usage", "used"),
+        "mem_total": ("fb_memory_usage", "total"),
+        "ecc_single": ("ecc_errors", "volatile", "single_bit", "total"),
+        "ecc_double": ("ecc_errors", "volatile", "double_bit", "total"),
+        "uuid": ("uuid",),
+        "temperature": ("temperature", "gpu_temp"),
+        }
+
+# key is the last tag of path, for fast lookup when element ends
+smi_fields_by_tag = {}
+for field, path in smi_fields.items():
+    smi_fields_by_tag.setdefault(path[-1], []).append((field, path))
+
+
+def match_smi_field(path, stack):
+    """ stack is a list of (tag, n) of ancestors of ended element, n means
+    the element is the nth element with that tag in gpu """
+    i = 0
+    for tag, n in stack:
+        if tag == path[i]:
+            if i == 0 and n != 1:
+                return False
+            i += 1
+            if i == len(path) - 1:
+                return True
+    return False
+
+
+def convert_smi_fields(fields, pids):
+    """ convert fields collected by parse_smi_xml_result_stream into NvidiaGpuStatus,
+    return None if the gpu is not supported """
+    minor = fields["minor"]
+    gpu_util = fields["gpu_util"].replace("%", "").strip()
+
+    gpu_mem_util = "N/A"
+    if fields.get("mem_used") is not None and fields.get("mem_total") is not None:
+        mem_used = convert_to_byte(fields["mem_used"])
+        mem_total = convert_to_byte(fields["mem_total"])
+        if mem_total != 0:
+            gpu_mem_util = mem_used / mem_total * 100
+
+    if gpu_util == "N/A" or gpu_mem_util == "N/A":
+        return None
+
+    ecc_single = ecc_double = 0
+    if fields.get("ecc_single") is not None and fields.get("ecc_double") is not None:
+        if fields["ecc_single"] != "N/A":
+            ecc_single = int(fields["ecc_single"])
+        if fields["ecc_double"] != "N/A":
+            ecc_double = int(fields["ecc_double"])
+
+    temperature = None
+    try:
+        temperature = float(re.findall(r"[0-9.]+", fields["temperature"])[0])
+    except Exception:
+        pass
+
+    return NvidiaGpuStatus(
+            float(gpu_util),
+            float(gpu_mem_util),
+            pids,
+            EccError(single=ecc_single, double=ecc_double),
+            str(minor),
+            fields["uuid"],
+            temperature)
+
+
+def parse_smi_xml_result_stream(smi):
+    """ same as parse_smi_xml_result, but parse output of nvidia-smi incrementally
+    and only keep text of fields we use, this is much faster than building the
+    whole dom tree """
+    result = {}
+
+    stack = None # None means not in gpu element
+    counts = fields = pids = process_pid = None
+
+    for event, elem in ElementTree.iterparse(io.BytesIO(smi.encode("utf-8")),
+            events=("start", "end")):
+        tag = elem.tag
+
+        if event == "start":
+            if tag == "gpu" and stack is None:
+                stack = []
+                counts = {}
+                fields = {}
+                pids = []
+            elif stack is not None:
+                counts[tag] = counts.get(tag, 0) + 1
+                stack.append((tag, counts[tag]))
+                if tag == "process_info":
+                    process_pid = None
+            continue
+
+        if stack is None:
+            continue
+
+        if tag == "gpu" and len(stack) == 0:
+            status = convert_smi_fields(fields, pids)
+            if status is not None:
+                result[status.minor] = result[status.uuid] = status
+            stack = None
+            elem.clear()
+            continue
+
+        stack.pop()
+
+        if tag == "pid" and process_pid is None and \
+                any(map(lambda e: e[0] == "process_info", stack)):
+            process_pid = int(elem.text)
+        elif tag == "process_info" and process_pid is not None:
+            pids.append(process_pid)
+            process_pid = None
+
+        for field, path in smi_fields_by_tag.get(tag, []):
+            if field in fields:
+                continue
+            if len(path) == 1:
+                if counts[tag] == 1:
+                    fields[field] = elem.text
+            elif match_smi_field(path, stack):
+                fields[field] = elem.text
+
+        elem.clear()
+
+    return result
+
 def nvidia_smi(histogram, timeout):
     try:
         smi_output = utils.exec_cmd(["nvidia-smi", "-q", "-x"],
                 histogram=histogram, timeout=timeout)
 
-        return parse_smi_xml_result(smi_output)
+        return parse_smi_xml_result_stream(smi_output)
     except subprocess.CalledProcessError as e:
         logger.exception("command '%s' return with error (code %d): %s",
                 e.cmd, e.returncode, e.output)
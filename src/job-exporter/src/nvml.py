@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import ctypes
+import logging
+import os
+
+import nvidia
+
+logger = logging.getLogger(__name__)
+
+# Query gpu status through NVML, the library nvidia-smi is built on, instead
+# of forking nvidia-smi and parsing its xml output. NVML is initialized once
+# and kept across iterations. We bind the few functions we need with ctypes
+# so no extra package is required in the image.
+#
+# All output parameters are passed with ctypes.pointer instead of byref, this
+# allows test to replace the library with a python object.
+
+NVML_SUCCESS = 0
+NVML_ERROR_NOT_SUPPORTED = 3
+NVML_ERROR_INSUFFICIENT_SIZE = 7
+
+NVML_TEMPERATURE_GPU = 0
+
+NVML_MEMORY_ERROR_TYPE_CORRECTED = 0
+NVML_MEMORY_ERROR_TYPE_UNCORRECTED = 1
+NVML_VOLATILE_ECC = 0
+
+NVML_DEVICE_UUID_BUFFER_SIZE = 80
+
+
+class NvmlUtilization(ctypes.Structure):
+    _fields_ = [("gpu", ctypes.c_uint), ("memory", ctypes.c_uint)]
+
+
+class NvmlMemory(ctypes.Structure):
+    _fields_ = [("total", ctypes.c_ulonglong),
+            ("free", ctypes.c_ulonglong),
+            ("used", ctypes.c_ulonglong)]
+
+
+class NvmlProcessInfo(ctypes.Structure):
+    _fields_ = [("pid", ctypes.c_uint), ("usedGpuMemory", ctypes.c_ulonglong)]
+
+
+class NvmlError(Exception):
+    def __init__(self, fn, code, message):
+        Exception.__init__(self, "%s returns %d: %s" % (fn, code, message))
+        self.code = code
+
+
+def load_library():
+    """ setting LD_LIBRARY_PATH in config_environ do not affect dlopen of
+    current process, so search driver dir explicitly """
+    candidates = []
+    driver_path = os.environ.get("NV_DRIVER")
+    if driver_path is not None:
+        for d in ["lib64", "lib"]:
+            candidates.append(os.path.join(driver_path, d, "libnvidia-ml.so.1"))
+    candidates.append("libnvidia-ml.so.1")
+
+    for candidate in candidates:
+        try:
+            lib = ctypes.CDLL(candidate)
+            lib.nvmlErrorString.restype = ctypes.c_char_p
+            return lib
+        except OSError:
+            pass
+
+    raise OSError("can not load libnvidia-ml.so.1 from %s" % candidates)
+
+
+class Nvml(object):
+    """ keep NVML initialized and device handles cached across calls, NVML is
+    re-initialized if any call failed. Not thread safe. """
+    def __init__(self, lib_loader=load_library):
+        self.lib_loader = lib_loader
+        self.lib = None
+        self.initialized = False
+        self.handles = None
+
+    def call(self, fn_name, *args):
+        ret = getattr(self.lib, fn_name)(*args)
+        if ret != NVML_SUCCESS:
+            message = self.lib.nvmlErrorString(ret)
+            if isinstance(message, bytes):
+                message = message.decode("utf-8", "replace")
+            raise NvmlError(fn_name, ret, message)
+
+    def call_optional(self, fn_name, *args):
+        """ return False if the query is not supported by the device """
+        try:
+            self.call(fn_name, *args)
+            return True
+        except NvmlError as e:
+            if e.code == NVML_ERROR_NOT_SUPPORTED:
+                return False
+            raise
+
+    def init(self):
+        if self.lib is None:
+            self.lib = self.lib_loader()
+
+        self.call("nvmlInit_v2")
+        self.initialized = True
+
+        count = ctypes.c_uint()
+        self.call("nvmlDeviceGetCount_v2", ctypes.pointer(count))
+
+        handles = []
+        for i in range(count.value):
+            handle = ctypes.c_void_p()
+            self.call("nvmlDeviceGetHandleByIndex_v2", ctypes.c_uint(i),
+                    ctypes.pointer(handle))
+            handles.append(handle)
+
+        self.handles = handles
+        logger.info("initialized nvml with %d gpus", len(handles))
+
+    def shutdown(self):
+        self.handles = None
+        if not self.initialized:
+            return
+        self.initialized = False
+        try:
+            self.call("nvmlShutdown")
+        except Exception:
+            logger.warning("failed to shutdown nvml", exc_info=True)
+
+    def get_pids(self, handle, fn_name):
+        count = ctypes.c_uint(0)
+        try:
+            self.call(fn_name, handle, ctypes.pointer(count), None)
+            return []
+        except NvmlError as e:
+            if e.code == NVML_ERROR_NOT_SUPPORTED:
+                return []
+            if e.code != NVML_ERROR_INSUFFICIENT_SIZE:
+                raise
+
+        # processes may start between two calls, leave some room for them
+        count.value += 4
+        infos = (NvmlProcessInfo * count.value)()
+        self.call(fn_name, handle, ctypes.pointer(count), infos)
+        return [infos[i].pid for i in range(count.value)]
+
+    def get_ecc_count(self, handle, error_type):
+        count = ctypes.c_ulonglong()
+        if self.call_optional("nvmlDeviceGetTotalEccErrors", handle,
+                ctypes.c_int(error_type), ctypes.c_int(NVML_VOLATILE_ECC),
+                ctypes.pointer(count)):
+            return count.value
+        return 0
+
+    def query_device(self, handle):
+        """ return NvidiaGpuStatus or None if gpu util is not available, this
+        is the same as nvidia.parse_smi_xml_result """
+        minor = ctypes.c_uint()
+        self.call("nvmlDeviceGetMinorNumber", handle, ctypes.pointer(minor))
+
+        uuid = ctypes.create_string_buffer(NVML_DEVICE_UUID_BUFFER_SIZE)
+        self.call("nvmlDeviceGetUUID", handle, uuid,
+                ctypes.c_uint(NVML_DEVICE_UUID_BUFFER_SIZE))
+
+        utilization = NvmlUtilization()
+        if not self.call_optional("nvmlDeviceGetUtilizationRates", handle,
+                ctypes.pointer(utilization)):
+            return None
+
+        memory = NvmlMemory()
+        if not self.call_optional("nvmlDeviceGetMemoryInfo", handle,
+                ctypes.pointer(memory)) or memory.total == 0:
+            return None
+
+        # nvidia-smi lists both compute and graphics processes
+        pids = []
+        for fn_name in ["nvmlDeviceGetComputeRunningProcesses",
+                "nvmlDeviceGetGraphicsRunningProcesses"]:
+            for pid in self.get_pids(handle, fn_name):
+                if pid not in pids:
+                    pids.append(pid)
+
+        ecc_errors = nvidia.EccError(
+                single=self.get_ecc_count(handle, NVML_MEMORY_ERROR_TYPE_CORRECTED),
+                double=self.get_ecc_count(handle, NVML_MEMORY_ERROR_TYPE_UNCORRECTED))
+
+        temperature = None
+        temp = ctypes.c_uint()
+        if self.call_optional("nvmlDeviceGetTemperature", handle,
+                ctypes.c_int(NVML_TEMPERATURE_GPU), ctypes.pointer(temp)):
+            temperature = float(temp.value)
+
+        return nvidia.NvidiaGpuStatus(
+                float(utilization.gpu),
+                memory.used / memory.total * 100,
+                pids,
+                ecc_errors,
+                str(minor.value),
+                uuid.value.decode("utf-8"),
+                temperature)
+
+    def query(self):
+        """ return a map, key is minor_number and gpu uuid, value is NvidiaGpuStatus """
+        if self.handles is None:
+            self.init()
+
+        result = {}
+        for handle in self.handles:
+            status = self.query_device(handle)
+            if status is not None:
+                result[status.minor] = result[status.uuid] = status
+        return result
+
+
+def nvml_query(nvml, histogram):
+    """ same as nvidia.nvidia_smi, return None on error """
+    try:
+        with histogram.time():
+            return nvml.query()
+    except Exception:
+        logger.exception("query gpu status from nvml error")
+        nvml.shutdown()
+
+    return None
@@ -16,10 +16,11 @@
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
 import subprocess
 import logging
 
-import utils
+from pai_exporter_runtime import utils
 
 logger = logging.getLogger(__name__)
 
@@ -62,3 +63,87 @@ def get_process_info(histogram, timeout):
         logger.exception("exec ps ax error")
 
     return []
+
+
+class ProcReader(object):
+    """ read process info from /proc directly instead of calling ps. Only
+    processes we are interested in are returned, cmdline of them is cached
+    by pid and start time since it will not change during process life time.
+    Not thread safe """
+    def __init__(self, proc_root="/proc"):
+        self.proc_root = proc_root
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.cmds = {} # key is (pid, starttime), value is cmd
+
+    def read_cmd(self, pid, comm):
+        """ return cmd in the same format as `ps --format cmd` """
+        with open(os.path.join(self.proc_root, pid, "cmdline"), "rb") as f:
+            cmdline = f.read()
+
+        cmd = cmdline.rstrip(b"\0").decode("utf-8", "replace")
+        # ps join args and show control characters with space, parse_result
+        # collapses consecutive spaces
+        cmd = " ".join("".join(c if c >= " " else " " for c in cmd).split())
+
+        if len(cmd) == 0:
+            # kernel thread or zombie process, or cmdline has only blanks
+            return "[" + comm + "]"
+        return cmd
+
+    def read_process(self, pid, rss_threshold, alive):
+        """ return ProcessInfo if process is in D state or rss is larger than
+        rss_threshold, None otherwise. (pid, starttime) is added to alive """
+        with open(os.path.join(self.proc_root, pid, "stat"), "rb") as f:
+            stat = f.read().decode("utf-8", "replace")
+
+        # comm is in parentheses and may contain spaces or parentheses
+        comm_start = stat.find("(")
+        comm_end = stat.rfind(")")
+        comm = stat[comm_start + 1:comm_end]
+        fields = stat[comm_end + 2:].split()
+
+        # fields are counted from 3 in proc(5)
+        state = fields[0]
+        starttime = fields[19]
+        rss = int(fields[21]) * self.page_size
+
+        key = (pid, starttime)
+        alive.add(key)
+
+        if state != "D" and rss <= rss_threshold:
+            return None
+
+        cmd = self.cmds.get(key)
+        if cmd is None:
+            cmd = self.cmds[key] = self.read_cmd(pid, comm)
+
+        return ProcessInfo(pid, state, rss, cmd)
+
+    def get_process_info(self, histogram, rss_threshold):
+        """ return list of ProcessInfo of processes in D state or with rss
+        larger than rss_threshold, None on error """
+        try:
+            with histogram.time():
+                result = []
+                alive = set()
+
+                with os.scandir(self.proc_root) as it:
+                    for entry in it:
+                        if not entry.name.isdigit():
+                            continue
+                        try:
+                            info = self.read_process(entry.name, rss_threshold, alive)
+                        except (OSError, IndexError, ValueError):
+                            continue # process exited
+                        if info is not None:
+                            result.append(info)
+
+                for key in list(self.cmds.keys()):
+                    if key not in alive:
+                        self.cmds.pop(key)
+
+                return result
+        except Exception:
+            logger.exception("failed to read process info from %s", self.proc_root)
+
+        return None
@@ -15,9 +15,14 @@
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+import sys
 import logging
 import unittest
 
+# code shared with other exporters, it is copied into image by build
+sys.path.append(os.path.abspath("../../pai-exporter-runtime/src/"))
+
 class TestBase(unittest.TestCase):
     """
     Test Base class for job-exporter
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+""" Compare parse_smi_xml_result with parse_smi_xml_result_stream on synthetic
+nvidia-smi output. Run from this directory:
+
+    python3 bench_nvidia.py --gpus 16 --processes 200
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.append(os.path.abspath("../src/"))
+# code shared with other exporters, it is copied into image by build
+sys.path.append(os.path.abspath("../../pai-exporter-runtime/src/"))
+
+import nvidia
+
+PROCESS_TEMPLATE = """            <process_info>
+                <pid>%d</pid>
+                <type>C</type>
+                <process_name>python</process_name>
+                <used_memory>100 MiB</used_memory>
+            </process_info>
+"""
+
+
+def gen_smi_output(gpu_count, process_count):
+    """ duplicate gpu element in sample output gpu_count times, every gpu has
+    process_count processes """
+    with open("data/nvidia_smi_sample.xml") as f:
+        sample = f.read()
+
+    start = sample.index("<gpu ")
+    end = sample.index("</gpu>") + len("</gpu>")
+    gpu = sample[start:end]
+
+    processes = "".join(PROCESS_TEMPLATE % (10000 + i) for i in range(process_count))
+    gpu = re.sub(r"<processes>.*</processes>",
+            "<processes>\n" + processes + "        </processes>", gpu, flags=re.S)
+
+    gpus = []
+    for i in range(gpu_count):
+        g = gpu.replace("<minor_number>0</minor_number>", "<minor_number>%d</minor_number>" % i)
+        g = re.sub(r"<uuid>[^<]*</uuid>", "<uuid>GPU-%08d</uuid>" % i, g)
+        gpus.append(g)
+
+    return sample[:start] + "\n    ".join(gpus) + sample[sample.rindex("</gpu>") + len("</gpu>"):]
+
+
+def main(args):
+    smi = gen_smi_output(args.gpus, args.processes)
+
+    if nvidia.parse_smi_xml_result(smi) != nvidia.parse_smi_xml_result_stream(smi):
+        sys.stderr.write("parsers return different result\n")
+        sys.exit(1)
+
+    print("%d gpus, %d processes per gpu, %d bytes" % (args.gpus, args.processes, len(smi)))
+    for name in ["parse_smi_xml_result", "parse_smi_xml_result_stream"]:
+        fn = getattr(nvidia, name)
+        costs = timeit.repeat(lambda: fn(smi), number=args.number, repeat=5)
+        print("%-30s %.3f ms" % (name, min(costs) / args.number * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gpus", type=int, default=16)
+    parser.add_argument("--processes", type=int, default=200)
+    parser.add_argument("--number", type=int, default=10, help="parse times in one repeat")
+    main(parser.parse_args())
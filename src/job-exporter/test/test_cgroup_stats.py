@@ -0,0 +1,174 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import base
+
+sys.path.append(os.path.abspath("../src/"))
+
+import cgroup_stats
+from prometheus_client import Histogram
+
+ID1 = "a" * 64
+ID2 = "b" * 64
+
+histogram = Histogram("test_cgroup_stats_latency_seconds", "test")
+
+class FakeClient(object):
+    def __init__(self, containers):
+        self.containers = containers
+
+    def get(self, path, histogram=None, timeout=None):
+        assert path == "/containers/json"
+        if self.containers is None:
+            raise RuntimeError("docker is down")
+        return [{"Id": c_id, "Names": ["/" + name]} for c_id, name in self.containers]
+
+
+def write_file(path, content):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+class TestCgroupStats(base.TestBase):
+    """
+    Test cgroup_stats.py
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cgroup_root = os.path.join(self.dir, "cgroup")
+        self.proc_root = os.path.join(self.dir, "proc")
+        write_file(os.path.join(self.proc_root, "meminfo"),
+                "MemTotal:       1048576 kB\nMemFree:          524288 kB\n")
+        write_file(os.path.join(self.proc_root, "100", "net", "dev"),
+"""Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:    1000      10    0    0    0     0          0         0     1000      10    0    0    0     0       0          0
+  eth0:    2048      20    0    0    0     0          0         0     4096      40    0    0    0     0       0          0
+""")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_v1(self, rel_path, cpu):
+        root = self.cgroup_root
+        write_file(os.path.join(root, "cpuacct", rel_path, "cpuacct.usage"), str(cpu))
+        write_file(os.path.join(root, "memory", rel_path, "memory.usage_in_bytes"), "4096000")
+        write_file(os.path.join(root, "memory", rel_path, "memory.limit_in_bytes"),
+                "9223372036854771712")
+        write_file(os.path.join(root, "memory", rel_path, "memory.stat"),
+                "cache 100\ntotal_inactive_file 96000\n")
+        write_file(os.path.join(root, "memory", rel_path, "cgroup.procs"), "100\n101\n")
+        write_file(os.path.join(root, "blkio", rel_path, "blkio.io_service_bytes_recursive"),
+                "8:0 Read 0\n8:0 Write 0\n8:0 Total 0\nTotal 0\n")
+        write_file(os.path.join(root, "blkio", rel_path, "blkio.throttle.io_service_bytes"),
+                "8:0 Read 100\n8:0 Write 200\n8:16 Read 1\n8:16 Write 2\nTotal 303\n")
+
+    def make_v2(self, rel_path, cpu):
+        root = self.cgroup_root
+        write_file(os.path.join(root, "cgroup.controllers"), "cpu io memory\n")
+        write_file(os.path.join(root, rel_path, "cpu.stat"),
+                "usage_usec %d\nuser_usec 0\nsystem_usec 0\n" % cpu)
+        write_file(os.path.join(root, rel_path, "memory.current"), "4096000")
+        write_file(os.path.join(root, rel_path, "memory.max"), "1024000000")
+        write_file(os.path.join(root, rel_path, "memory.stat"),
+                "anon 100\ninactive_file 96000\n")
+        write_file(os.path.join(root, rel_path, "cgroup.procs"), "100\n")
+        write_file(os.path.join(root, rel_path, "io.stat"),
+                "8:0 rbytes=100 wbytes=200 rios=1 wios=2\n8:16 rbytes=1 wbytes=2 rios=1 wios=1\n")
+
+    def test_parse_blkio(self):
+        self.assertEqual((101, 202), cgroup_stats.parse_blkio_service_bytes(
+            "8:0 Read 100\n8:0 Write 200\n8:16 Read 1\n8:16 Write 2\nTotal 303\n"))
+
+    def test_v1(self):
+        self.make_v1(os.path.join("docker", ID1), 10 ** 9)
+        self.make_v1(os.path.join("kubepods", "besteffort", "podxxx", ID2), 0)
+
+        client = FakeClient([(ID1, "c1"), (ID2, "k8s_c2")])
+        reader = cgroup_stats.CgroupStatsReader(client, self.cgroup_root, self.proc_root)
+        self.assertFalse(reader.unified)
+
+        result = reader.stats(histogram, None, 1)
+        self.assertEqual({ID1[:12], ID2[:12]}, set(result.keys()))
+
+        c1 = result[ID1[:12]]
+        self.assertEqual(ID1[:12], c1["id"])
+        self.assertEqual("c1", c1["name"])
+        self.assertEqual(0.0, c1["CPUPerc"]) # first sample
+        self.assertEqual({"usage": 4000000, "limit": 1024 * 1024 * 1024},
+                c1["MemUsage_Limit"])
+        self.assertAlmostEqual(4000000 / (1024 * 1024 * 1024) * 100, c1["MemPerc"])
+        self.assertEqual({"in": 101, "out": 202}, c1["BlockIO"])
+        self.assertEqual({"in": 2048, "out": 4096}, c1["NetIO"])
+
+        # simulate 2 cores fully used in one second
+        self.make_v1(os.path.join("docker", ID1), 3 * 10 ** 9)
+        last_cpu, last_time = reader.last_cpu[ID1]
+        reader.last_cpu[ID1] = (last_cpu, last_time - 1)
+
+        result = reader.stats(histogram, None, 1)
+        self.assertAlmostEqual(200.0, result[ID1[:12]]["CPUPerc"], delta=1)
+
+    def test_v2(self):
+        self.make_v2(os.path.join("system.slice", "docker-%s.scope" % ID1), 1000)
+
+        client = FakeClient([(ID1, "c1")])
+        reader = cgroup_stats.CgroupStatsReader(client, self.cgroup_root, self.proc_root)
+        self.assertTrue(reader.unified)
+
+        c1 = reader.stats(histogram, None, 1)[ID1[:12]]
+        self.assertEqual({"usage": 4000000, "limit": 1024000000}, c1["MemUsage_Limit"])
+        self.assertEqual({"in": 101, "out": 202}, c1["BlockIO"])
+        self.assertEqual({"in": 2048, "out": 4096}, c1["NetIO"])
+
+    def test_exited_and_new_container(self):
+        self.make_v1(os.path.join("docker", ID1), 10 ** 9)
+
+        client = FakeClient([(ID1, "c1")])
+        reader = cgroup_stats.CgroupStatsReader(client, self.cgroup_root, self.proc_root)
+        reader.stats(histogram, None, 1)
+        self.assertIn(ID1, reader.last_cpu)
+
+        # container exited and a new container started, new container should
+        # be found by walking cgroup hierarchy again
+        shutil.rmtree(os.path.join(self.cgroup_root, "cpuacct", "docker", ID1))
+        self.make_v1(os.path.join("docker", ID2), 10 ** 9)
+        client.containers = [(ID1, "c1"), (ID2, "c2")]
+
+        result = reader.stats(histogram, None, 1)
+        self.assertEqual([ID2[:12]], list(result.keys()))
+
+        client.containers = [(ID2, "c2")]
+        reader.stats(histogram, None, 1)
+        self.assertNotIn(ID1, reader.last_cpu)
+
+    def test_docker_down(self):
+        reader = cgroup_stats.CgroupStatsReader(FakeClient(None),
+                self.cgroup_root, self.proc_root)
+        self.assertIsNone(reader.stats(histogram, None, 1))
+
+if __name__ == '__main__':
+    unittest.main()
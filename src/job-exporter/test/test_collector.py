@@ -21,6 +21,8 @@
 import datetime
 import time
 import logging
+import threading
+from unittest import mock
 
 import base
 
@@ -72,6 +74,76 @@ def test_infer_service_name(self):
             "k8s_kube-scheduler_kube-scheduler-10.151.40.4_kube-system_f1164d931979939cf0601155df9c748a_6"))
 
 
+    def test_process_containers_concurrently(self):
+        release = threading.Event()
+
+        class FakeInspectCache(object):
+            def retain(self, container_ids):
+                pass
+
+        class SlowContainerCollector(ContainerCollector):
+            def process_one_container(self, container_id, stats, gpu_infos, all_conns, gauges,
+                    net_usage=None):
+                if container_id == "slow":
+                    release.wait(10)
+                elif container_id == "error":
+                    raise RuntimeError("failed")
+                gauges.add_value("service_cpu_percent", {"name": container_id},
+                        stats["CPUPerc"])
+
+        t = str(time.time()).replace(".", "_")
+        decay_time = datetime.timedelta(seconds=1)
+        with mock.patch("network.try_to_get_right_interface", return_value="lo"):
+            _, c = collector.instantiate_collector(
+                    "test_container_collector" + t,
+                    0.5,
+                    decay_time,
+                    SlowContainerCollector,
+                    collector.AtomicRef(decay_time),
+                    collector.AtomicRef(decay_time),
+                    "lo",
+                    FakeInspectCache(),
+                    None,
+                    4,
+                    0.5)
+
+        def get_values(metrics):
+            result = {}
+            for metric in metrics:
+                for sample in metric.samples:
+                    result[(metric.name, tuple(sample[1].values()))] = sample[2]
+            return result
+
+        stats = {"fast": {"name": "fast", "CPUPerc": 1},
+                "slow": {"name": "slow", "CPUPerc": 2},
+                "error": {"name": "error", "CPUPerc": 3}}
+
+        # slow container missed deadline and has no previous values
+        values = get_values(c.collect_container_metrics(stats, None, {}))
+        self.assertEqual(1, values[("service_cpu_percent", ("fast",))])
+        self.assertEqual(1, values[("container_metrics_stale", ("slow",))])
+        self.assertNotIn(("service_cpu_percent", ("slow",)), values)
+        self.assertNotIn(("service_cpu_percent", ("error",)), values)
+
+        # late result is used in next iteration, while slow container is not
+        # processed again
+        release.set()
+        for _ in range(20):
+            if len(c.in_flight) == 0:
+                break
+            time.sleep(0.1)
+
+        release.clear()
+        stats["fast"]["CPUPerc"] = 4
+        stats["slow"]["CPUPerc"] = 5
+        values = get_values(c.collect_container_metrics(stats, None, {}))
+        self.assertEqual(4, values[("service_cpu_percent", ("fast",))])
+        self.assertEqual(2, values[("service_cpu_percent", ("slow",))])
+        self.assertEqual(1, values[("container_metrics_stale", ("slow",))])
+
+        release.set()
+
+
 class TestDockerCollector(base.TestBase):
     """
     Test DockerCollector in collector.py
@@ -0,0 +1,100 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+import base
+
+sys.path.append(os.path.abspath("../src/"))
+
+import container_logs
+
+FULL_ID = "6c39b5b0f3c1" + "a" * 52
+
+def log_line(msg):
+    return json.dumps({"log": msg + "\n", "stream": "stdout",
+        "time": "2018-11-12T03:04:05.123456789Z"}) + "\n"
+
+class TestContainerLogs(base.TestBase):
+    """
+    Test container_logs.py
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, "containers", FULL_ID))
+        self.path = os.path.join(self.root, "containers", FULL_ID, FULL_ID + "-json.log")
+        self.detector = container_logs.LogMarkerDetector(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def append(self, data):
+        with open(self.path, "a") as f:
+            f.write(data)
+
+    def test_incremental(self):
+        self.assertIsNone(self.detector.is_marked("6c39b5b0f3c1"))
+
+        self.append(log_line("training") * 10)
+        self.assertFalse(self.detector.is_marked("6c39b5b0f3c1"))
+        offset = self.detector.states["6c39b5b0f3c1"].offset
+        self.assertEqual(os.path.getsize(self.path), offset)
+
+        # partial line is left for next time
+        line = log_line("USER COMMAND END")
+        self.append(line[:10])
+        self.assertFalse(self.detector.is_marked("6c39b5b0f3c1"))
+        self.assertEqual(offset, self.detector.states["6c39b5b0f3c1"].offset)
+
+        self.append(line[10:])
+        self.assertTrue(self.detector.is_marked("6c39b5b0f3c1"))
+
+        # found container is never read again
+        os.remove(self.path)
+        self.assertTrue(self.detector.is_marked("6c39b5b0f3c1"))
+
+        self.detector.retain({})
+        self.assertEqual(0, len(self.detector.states))
+
+    def test_rotate(self):
+        self.append(log_line("training") * 10)
+        self.assertFalse(self.detector.is_marked("6c39b5b0f3c1"))
+
+        os.rename(self.path, self.path + ".1")
+        self.append(log_line("USER COMMAND END"))
+        self.assertTrue(self.detector.is_marked("6c39b5b0f3c1"))
+
+    def test_initial_window(self):
+        self.append(log_line("USER COMMAND END"))
+        self.append(log_line("x" * 100) * 1000)
+        self.assertFalse(self.detector.is_marked("6c39b5b0f3c1"))
+
+        self.detector.states.clear()
+        window = container_logs.LogMarkerDetector.initial_window
+        container_logs.LogMarkerDetector.initial_window = 1024 * 1024
+        try:
+            self.assertTrue(self.detector.is_marked("6c39b5b0f3c1"))
+        finally:
+            container_logs.LogMarkerDetector.initial_window = window
+
+if __name__ == '__main__':
+    unittest.main()
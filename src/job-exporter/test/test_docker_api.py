@@ -0,0 +1,150 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import socketserver
+import http.server
+
+import base
+
+sys.path.append(os.path.abspath("../src/"))
+
+import docker_api
+
+class FakeDockerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+
+        if self.path.startswith("/events"):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for event in self.server.events:
+                chunk = (json.dumps(event) + "\n").encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+            self.close_connection = True
+            return
+
+        if self.path == "/containers/abc/json":
+            status, body = 200, json.dumps({"Id": "abc", "State": {"Pid": 1}})
+        else:
+            status, body = 404, json.dumps({"message": "No such container"})
+
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, FakeDockerHandler)
+        self.paths = []
+        self.events = []
+        self.connections = 0
+
+    def get_request(self):
+        self.connections += 1
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects client_address to be a tuple
+        return request, ("local", 0)
+
+
+class TestDockerApi(base.TestBase):
+    """
+    Test docker_api.py
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.dir, "docker.sock")
+        self.server = FakeDockerServer(self.socket_path)
+        t = threading.Thread(target=self.server.serve_forever, daemon=True)
+        t.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_inspect_reuse_connection(self):
+        client = docker_api.DockerClient(self.socket_path)
+
+        for _ in range(3):
+            obj = client.inspect_container("abc", timeout=1)
+            self.assertEqual(1, obj["State"]["Pid"])
+
+        self.assertEqual(["/containers/abc/json"] * 3, self.server.paths)
+        self.assertEqual(1, self.server.connections)
+
+    def test_inspect_not_exist(self):
+        client = docker_api.DockerClient(self.socket_path)
+
+        with self.assertRaises(docker_api.DockerApiError) as context:
+            client.inspect_container("not_exist", timeout=1)
+        self.assertEqual(404, context.exception.status)
+
+        # connection is still usable after error
+        self.assertEqual("abc", client.inspect_container("abc", timeout=1)["Id"])
+        self.assertEqual(1, self.server.connections)
+
+    def test_events(self):
+        self.server.events = [
+                {"status": "start", "id": "abc"},
+                {"status": "die", "id": "def"},
+                ]
+
+        client = docker_api.DockerClient(self.socket_path)
+        events = list(client.events(docker_api.EventWatcher.filters))
+
+        self.assertEqual(self.server.events, events)
+        self.assertTrue(self.server.paths[0].startswith("/events?filters="))
+
+    def test_watcher_dispatch(self):
+        watcher = docker_api.EventWatcher(None)
+
+        events = []
+        resets = []
+        watcher.add_listener(events.append, lambda: resets.append(1))
+
+        watcher.set_connected(True)
+        self.assertTrue(watcher.is_connected())
+        watcher.dispatch({"id": "abc"})
+        watcher.set_connected(False)
+        self.assertFalse(watcher.is_connected())
+
+        self.assertEqual([{"id": "abc"}], events)
+        self.assertEqual(2, len(resets))
+
+if __name__ == '__main__':
+    unittest.main()
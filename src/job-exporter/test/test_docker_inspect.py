@@ -17,12 +17,14 @@
 
 import sys
 import os
+import json
 import unittest
 
 import base
 
 sys.path.append(os.path.abspath("../src/"))
 
+import docker_inspect
 from docker_inspect import parse_docker_inspect, InspectResult
 
 class TestDockerInspect(base.TestBase):
@@ -91,5 +93,80 @@ def test_adapt_dlts_jobs(self):
                 3533)
         self.assertEqual(target_inspect_info, inspect_info)
 
+class FakeClient(object):
+    def __init__(self, obj):
+        self.obj = obj
+        self.count = 0
+        self.on_request = None
+
+    def inspect_container(self, container_id, histogram=None, timeout=None):
+        self.count += 1
+        if self.on_request is not None:
+            self.on_request()
+        return self.obj
+
+class FakeWatcher(object):
+    def __init__(self):
+        self.connected = True
+        self.listeners = []
+
+    def add_listener(self, on_event, on_reset):
+        self.listeners.append((on_event, on_reset))
+
+    def is_connected(self):
+        return self.connected
+
+class TestInspectCache(base.TestBase):
+    """
+    Test InspectCache in docker_inspect.py
+    """
+    def setUp(self):
+        with open("data/docker_inspect_sample.json", "r") as f:
+            obj = json.load(f)[0]
+
+        self.client = FakeClient(obj)
+        self.watcher = FakeWatcher()
+        self.cache = docker_inspect.InspectCache(self.client, self.watcher)
+        self.on_event, self.on_reset = self.watcher.listeners[0]
+
+    def inspect(self, container_id):
+        return self.cache.inspect(container_id, None, None, 1)
+
+    def test_cache_hit(self):
+        self.assertEqual(95539, self.inspect("c6a9f1e9d6f0").pid)
+        self.assertEqual(95539, self.inspect("c6a9f1e9d6f0").pid)
+        self.assertEqual(1, self.client.count)
+
+    def test_invalidate_by_event(self):
+        self.inspect("c6a9f1e9d6f0")
+        self.inspect("0123456789ab")
+        self.assertEqual(2, len(self.cache))
+
+        self.on_event({"status": "die", "id": "c6a9f1e9d6f0" + "0" * 52})
+        self.assertEqual(1, len(self.cache))
+
+        self.inspect("c6a9f1e9d6f0")
+        self.assertEqual(3, self.client.count)
+
+        self.on_reset()
+        self.assertEqual(0, len(self.cache))
+
+    def test_not_cache_when_event_arrives_during_request(self):
+        self.client.on_request = lambda: self.on_event({"id": "c6a9f1e9d6f0"})
+        self.inspect("c6a9f1e9d6f0")
+        self.assertEqual(0, len(self.cache))
+
+    def test_not_cache_when_disconnected(self):
+        self.watcher.connected = False
+        self.inspect("c6a9f1e9d6f0")
+        self.inspect("c6a9f1e9d6f0")
+        self.assertEqual(2, self.client.count)
+
+    def test_retain(self):
+        self.inspect("c6a9f1e9d6f0")
+        self.inspect("0123456789ab")
+        self.cache.retain({"0123456789ab": {}})
+        self.assertEqual(1, len(self.cache))
+
 if __name__ == '__main__':
     unittest.main()
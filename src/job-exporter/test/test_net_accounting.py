@@ -0,0 +1,125 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import base
+
+sys.path.append(os.path.abspath("../src/"))
+
+import net_accounting
+
+SS_TEMPLATE = """Recv-Q Send-Q Local Address:Port  Peer Address:Port Process
+0      0          10.0.0.1:40012    10.0.0.2:48271 timer:(keepalive,18sec,0) ino:100 sk:1 cgroup:/ <->
+\t ts sack cubic wscale:10,10 rto:204 rtt:0.105/0.021 mss:65483 bytes_sent:%d bytes_acked:%d bytes_received:%d segs_out:973
+0      0          10.0.0.1:22       10.0.0.3:5555 ino:200 sk:2 <->
+\t ts sack cubic wscale:10,10 rto:204 bytes_acked:%d bytes_received:%d segs_out:972
+0      0          10.0.0.1:80       10.0.0.4:6666 ino:0 sk:3 <->
+\t ts sack cubic wscale:10,10 rto:204 bytes_acked:1 bytes_received:1 segs_out:972
+"""
+
+NET_DEV_TEMPLATE = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:    1000      10    0    0    0     0          0         0     1000      10    0    0    0     0       0          0
+  eth0:    %d      20    0    0    0     0          0         0     %d      40    0    0    0     0       0          0
+"""
+
+class FakeNetAccounting(net_accounting.NetAccounting):
+    def __init__(self, proc_root):
+        net_accounting.NetAccounting.__init__(self, proc_root)
+        self.ss_output = None
+
+    def ss(self, histogram, timeout):
+        return self.ss_output
+
+
+class TestNetAccounting(base.TestBase):
+    """
+    Test net_accounting.py
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_process(self, pid, netns, pidns, inodes):
+        path = os.path.join(self.dir, str(pid))
+        os.makedirs(os.path.join(path, "ns"))
+        os.makedirs(os.path.join(path, "fd"))
+        os.makedirs(os.path.join(path, "net"))
+        os.symlink("net:[%d]" % netns, os.path.join(path, "ns", "net"))
+        os.symlink("pid:[%d]" % pidns, os.path.join(path, "ns", "pid"))
+        os.symlink("/dev/null", os.path.join(path, "fd", "0"))
+        for i, inode in enumerate(inodes):
+            os.symlink("socket:[%d]" % inode, os.path.join(path, "fd", str(i + 1)))
+
+    def write_net_dev(self, pid, rx, tx):
+        with open(os.path.join(self.dir, str(pid), "net", "dev"), "w") as f:
+            f.write(NET_DEV_TEMPLATE % (rx, tx))
+
+    def test_parse_ss(self):
+        result = net_accounting.parse_ss(SS_TEMPLATE % (11, 10, 20, 30, 40))
+        self.assertEqual({100: (20, 10), 200: (40, 30)}, result)
+
+    def test_sample(self):
+        self.make_process(1, 1, 1, [])
+        self.make_process(10, 1, 2, [100]) # container in host network
+        self.make_process(11, 1, 2, [])
+        self.make_process(20, 3, 4, [200]) # container has its own network ns
+        self.make_process(21, 3, 4, [])
+        self.write_net_dev(20, 1000, 2000)
+
+        engine = FakeNetAccounting(self.dir)
+
+        engine.ss_output = SS_TEMPLATE % (0, 0, 0, 0, 0)
+        usage = engine.sample(None, 1)
+        self.assertEqual((0, 0), usage.container_usage(10))
+        self.assertEqual((0, 0), usage.container_usage(20))
+
+        engine.ss_output = SS_TEMPLATE % (1000, 1000, 2000, 300, 400)
+        self.write_net_dev(20, 3000, 6000)
+        engine.last_time -= 2 # pretend last sample is 2 seconds ago
+
+        usage = engine.sample(None, 1)
+        in_byte, out_byte = usage.container_usage(10)
+        self.assertAlmostEqual(1000, in_byte, delta=10)
+        self.assertAlmostEqual(500, out_byte, delta=10)
+
+        # use interface counters instead of sockets
+        in_byte, out_byte = usage.container_usage(21)
+        self.assertAlmostEqual(1000, in_byte, delta=10)
+        self.assertAlmostEqual(2000, out_byte, delta=10)
+
+        # process in host pid namespace gets node wide consumption
+        in_byte, out_byte = usage.container_usage(1)
+        self.assertAlmostEqual(1200, in_byte, delta=10)
+        self.assertAlmostEqual(650, out_byte, delta=10)
+
+        self.assertEqual((0, 0), usage.container_usage(12345))
+
+    def test_ss_failed(self):
+        self.make_process(1, 1, 1, [])
+        engine = FakeNetAccounting(self.dir)
+        self.assertIsNone(engine.sample(None, 1)) # output is None
+
+if __name__ == '__main__':
+    unittest.main()
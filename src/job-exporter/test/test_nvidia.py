@@ -67,6 +67,30 @@ def test_exporter_will_not_report_unsupported_gpu(self):
 
         self.assertEqual({}, nvidia_smi_parse_result)
 
+    def test_stream_parser_same_as_dom_parser(self):
+        for sample_path in ["data/nvidia_smi_sample.xml",
+                "data/nvidia_smi_sample_ecc_unsupported.xml",
+                "data/nvidia_smi_outdated_gpu.xml"]:
+            with open(sample_path, "r") as f:
+                nvidia_smi_result = f.read()
+
+            self.assertEqual(nvidia.parse_smi_xml_result(nvidia_smi_result),
+                    nvidia.parse_smi_xml_result_stream(nvidia_smi_result))
+
+    def test_stream_parser_ecc(self):
+        with open("data/nvidia_smi_sample.xml", "r") as f:
+            nvidia_smi_result = f.read()
+
+        # volatile single, volatile double, aggregate single, aggregate double
+        for count in ["3", "1", "100", "100"]:
+            nvidia_smi_result = nvidia_smi_result.replace("<total>N/A</total>",
+                    "<total>%s</total>" % count, 1)
+
+        result = nvidia.parse_smi_xml_result_stream(nvidia_smi_result)
+
+        self.assertEqual(nvidia.EccError(single=3, double=1), result["0"].ecc_errors)
+        self.assertEqual(nvidia.parse_smi_xml_result(nvidia_smi_result), result)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,193 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import unittest
+
+import base
+
+sys.path.append(os.path.abspath("../src/"))
+
+import nvidia
+import nvml
+from prometheus_client import Histogram
+
+histogram = Histogram("test_nvml_latency_seconds", "test")
+
+class FakeDevice(object):
+    def __init__(self, minor, uuid, util, used, total, compute_pids,
+            graphics_pids=None, ecc=None, temperature=None):
+        self.minor = minor
+        self.uuid = uuid
+        self.util = util
+        self.used = used
+        self.total = total
+        self.compute_pids = compute_pids
+        self.graphics_pids = graphics_pids or []
+        self.ecc = ecc # None means not supported
+        self.temperature = temperature
+
+
+class FakeNvmlLib(object):
+    """ mimic libnvidia-ml.so, handle is index of device plus one since
+    c_void_p(0) is NULL """
+    def __init__(self, devices):
+        self.devices = devices
+        self.init_count = 0
+        self.shutdown_count = 0
+        self.fail = None # name of function to fail with unknown error
+
+    def ret(self, name, code=nvml.NVML_SUCCESS):
+        if self.fail == name:
+            return 999
+        return code
+
+    def device(self, handle):
+        return self.devices[handle.value - 1]
+
+    def nvmlErrorString(self, ret):
+        return b"fake error"
+
+    def nvmlInit_v2(self):
+        self.init_count += 1
+        return self.ret("nvmlInit_v2")
+
+    def nvmlShutdown(self):
+        self.shutdown_count += 1
+        return nvml.NVML_SUCCESS
+
+    def nvmlDeviceGetCount_v2(self, count):
+        count.contents.value = len(self.devices)
+        return self.ret("nvmlDeviceGetCount_v2")
+
+    def nvmlDeviceGetHandleByIndex_v2(self, index, handle):
+        handle.contents.value = index.value + 1
+        return nvml.NVML_SUCCESS
+
+    def nvmlDeviceGetMinorNumber(self, handle, minor):
+        minor.contents.value = self.device(handle).minor
+        return nvml.NVML_SUCCESS
+
+    def nvmlDeviceGetUUID(self, handle, buf, length):
+        buf.value = self.device(handle).uuid.encode("utf-8")
+        return nvml.NVML_SUCCESS
+
+    def nvmlDeviceGetUtilizationRates(self, handle, utilization):
+        d = self.device(handle)
+        if d.util is None:
+            return nvml.NVML_ERROR_NOT_SUPPORTED
+        utilization.contents.gpu = d.util
+        return self.ret("nvmlDeviceGetUtilizationRates")
+
+    def nvmlDeviceGetMemoryInfo(self, handle, memory):
+        d = self.device(handle)
+        memory.contents.used = d.used
+        memory.contents.total = d.total
+        memory.contents.free = d.total - d.used
+        return nvml.NVML_SUCCESS
+
+    def get_processes(self, pids, count, infos):
+        if count.contents.value < len(pids):
+            count.contents.value = len(pids)
+            return nvml.NVML_ERROR_INSUFFICIENT_SIZE
+        count.contents.value = len(pids)
+        for i, pid in enumerate(pids):
+            infos[i].pid = pid
+        return nvml.NVML_SUCCESS
+
+    def nvmlDeviceGetComputeRunningProcesses(self, handle, count, infos):
+        return self.get_processes(self.device(handle).compute_pids, count, infos)
+
+    def nvmlDeviceGetGraphicsRunningProcesses(self, handle, count, infos):
+        return self.get_processes(self.device(handle).graphics_pids, count, infos)
+
+    def nvmlDeviceGetTotalEccErrors(self, handle, error_type, counter_type, count):
+        d = self.device(handle)
+        if d.ecc is None:
+            return nvml.NVML_ERROR_NOT_SUPPORTED
+        count.contents.value = d.ecc[error_type.value]
+        return nvml.NVML_SUCCESS
+
+    def nvmlDeviceGetTemperature(self, handle, sensor, temp):
+        d = self.device(handle)
+        if d.temperature is None:
+            return nvml.NVML_ERROR_NOT_SUPPORTED
+        temp.contents.value = d.temperature
+        return nvml.NVML_SUCCESS
+
+
+class TestNvml(base.TestBase):
+    """
+    Test nvml.py
+    """
+    def test_query_same_as_smi(self):
+        # same as data/nvidia_smi_sample.xml
+        lib = FakeNvmlLib([
+            FakeDevice(0, "GPU-e511a7b2-f9d5-ba47-9b98-853732ca6c1b", 100,
+                4 * 2 ** 30, 16 * 2 ** 30, [1357, 2384], [3093], ecc=[0, 0], temperature=60),
+            FakeDevice(1, "GPU-28daffaf-8abe-aaf8-c298-4bd13aecb5e6", 98,
+                8 * 2 ** 30, 16 * 2 ** 30, [3093], [3093], temperature=59),
+            ])
+
+        handle = nvml.Nvml(lambda: lib)
+        result = nvml.nvml_query(handle, histogram)
+
+        with open("data/nvidia_smi_sample.xml") as f:
+            expected = nvidia.parse_smi_xml_result(f.read())
+
+        self.assertEqual(expected, result)
+
+    def test_unsupported(self):
+        lib = FakeNvmlLib([
+            FakeDevice(0, "GPU-0", None, 0, 100, []),
+            FakeDevice(1, "GPU-1", 10, 50, 100, [], ecc=[3, 1]),
+            ])
+
+        result = nvml.nvml_query(nvml.Nvml(lambda: lib), histogram)
+
+        one = nvidia.NvidiaGpuStatus(10.0, 50.0, [], nvidia.EccError(single=3, double=1),
+                "1", "GPU-1", None)
+        self.assertEqual({"1": one, "GPU-1": one}, result)
+
+    def test_persistent_handle(self):
+        lib = FakeNvmlLib([FakeDevice(0, "GPU-0", 10, 50, 100, [])])
+        handle = nvml.Nvml(lambda: lib)
+
+        for _ in range(3):
+            self.assertIsNotNone(nvml.nvml_query(handle, histogram))
+        self.assertEqual(1, lib.init_count)
+
+        # re-initialize after error
+        lib.fail = "nvmlDeviceGetUtilizationRates"
+        self.assertIsNone(nvml.nvml_query(handle, histogram))
+        self.assertEqual(1, lib.shutdown_count)
+
+        lib.fail = None
+        self.assertIsNotNone(nvml.nvml_query(handle, histogram))
+        self.assertEqual(2, lib.init_count)
+
+    def test_library_not_found(self):
+        def loader():
+            raise OSError("not found")
+
+        handle = nvml.Nvml(loader)
+        self.assertIsNone(nvml.nvml_query(handle, histogram))
+        self.assertEqual(False, handle.initialized)
+
+if __name__ == '__main__':
+    unittest.main()
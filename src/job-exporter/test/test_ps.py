@@ -17,6 +17,8 @@
 
 import os
 import sys
+import shutil
+import tempfile
 import unittest
 
 import base
@@ -25,6 +27,14 @@
 
 import ps
 
+from prometheus_client import Histogram
+
+def gen_stat(pid, comm, state, starttime, rss_pages):
+    fields = [state, "1", str(pid), str(pid), "0", "-1", "4194560", "0", "0", "0",
+            "0", "0", "0", "0", "0", "20", "0", "1", "0", str(starttime),
+            "1000000", str(rss_pages)] + ["0"] * 30
+    return "%d (%s) %s\n" % (pid, comm, " ".join(fields))
+
 class TestPS(base.TestBase):
     """
     Test ps.py
@@ -42,5 +52,61 @@ def test_parse_ps_result(self):
         self.assertEqual("/var/drivers/nvidia/current/bin/nvidia-smi -q -x",
                 parse_result[0].cmd)
 
+    def write_proc(self, pid, comm, state, starttime, rss_pages, cmdline):
+        pid_dir = os.path.join(self.proc_root, str(pid))
+        if not os.path.isdir(pid_dir):
+            os.mkdir(pid_dir)
+        with open(os.path.join(pid_dir, "stat"), "w") as f:
+            f.write(gen_stat(pid, comm, state, starttime, rss_pages))
+        with open(os.path.join(pid_dir, "cmdline"), "wb") as f:
+            f.write(cmdline)
+
+    def test_proc_reader(self):
+        self.proc_root = tempfile.mkdtemp()
+        try:
+            histogram = Histogram("test_proc_reader_latency_seconds", "test")
+            reader = ps.ProcReader(self.proc_root)
+            page = reader.page_size
+            big = 600 * 1024 * 1024 // page
+            threshold = 500 * 1024 * 1024
+
+            self.write_proc(4, "nvidia-smi", "D", 100, 2,
+                    b"/var/drivers/nvidia/current/bin/nvidia-smi\0-q\0-x\0")
+            self.write_proc(5, "kworker/0:1", "D", 101, 0, b"")
+            self.write_proc(6, "python (main)", "S", 102, big,
+                    b"python\0train.py\0")
+            self.write_proc(7, "bash", "S", 103, 10, b"bash\0")
+            self.write_proc(8, "blank", "D", 104, 0, b" \x01\0\0")
+            os.mkdir(os.path.join(self.proc_root, "self"))
+
+            infos = sorted(reader.get_process_info(histogram, threshold),
+                    key=lambda info: info.pid)
+            self.assertEqual(["4", "5", "6", "8"], [info.pid for info in infos])
+            self.assertEqual("/var/drivers/nvidia/current/bin/nvidia-smi -q -x",
+                    infos[0].cmd)
+            self.assertEqual(2 * page, infos[0].rss)
+            self.assertEqual("[kworker/0:1]", infos[1].cmd)
+            self.assertEqual("S", infos[2].state)
+            self.assertEqual("python train.py", infos[2].cmd)
+            self.assertEqual("[blank]", infos[3].cmd)
+
+            # cmdline is cached by pid and start time
+            self.write_proc(6, "python (main)", "S", 102, big, b"changed\0")
+            infos = reader.get_process_info(histogram, threshold)
+            self.assertIn("python train.py", [info.cmd for info in infos])
+
+            # pid reused by new process
+            self.write_proc(6, "python (main)", "S", 200, big, b"changed\0")
+            infos = reader.get_process_info(histogram, threshold)
+            self.assertIn("changed", [info.cmd for info in infos])
+            self.assertNotIn(("6", "102"), reader.cmds)
+
+            shutil.rmtree(os.path.join(self.proc_root, "6"))
+            reader.get_process_info(histogram, threshold)
+            self.assertEqual({("4", "100"), ("5", "101"), ("8", "104")},
+                    set(reader.cmds.keys()))
+        finally:
+            shutil.rmtree(self.proc_root)
+
 if __name__ == '__main__':
     unittest.main()
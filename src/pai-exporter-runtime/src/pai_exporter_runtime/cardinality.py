@@ -0,0 +1,218 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import logging
+import threading
+import zlib
+
+from prometheus_client import Counter
+from prometheus_client.core import Metric
+
+from twisted.web.resource import Resource
+
+logger = logging.getLogger(__name__)
+
+# Every distinct label set of a metric is a series in prometheus, and every
+# series costs memory in prometheus head block for hours even if it only
+# appeared once. CardinalityLimiter rewrites metrics produced by collectors
+# before they are exposed:
+#
+# * labels not in allowlist of a metric are dropped, series that become the
+#   same after dropping are merged by summing their values,
+# * values of high cardinality labels can be hashed into a fixed number of
+#   buckets,
+# * number of series of all metrics is limited by a budget, series beyond
+#   the budget are dropped and counted in metric_series_dropped_total.
+#
+# Config is a json object like:
+#
+#   {"budget": 100000,
+#    "metrics": {
+#       "pai_container_count": {"allow": ["service_name", "namespace", "state"]},
+#       "pai_pod_count": {"hash": {"name": 64}}}}
+
+series_dropped_counter = Counter("metric_series_dropped_total",
+        "number of series dropped because series budget is exceeded",
+        ["name"])
+
+# these labels are part of histogram and summary, never dropped or hashed
+RESERVED_LABELS = {"le", "quantile"}
+
+
+class LabelRule(object):
+    def __init__(self, allow=None, hash=None):
+        """ allow is list of label names to keep, None means keeping all.
+        hash is map from label name to number of buckets its value is hashed to """
+        self.allow = None if allow is None else set(allow) | RESERVED_LABELS
+        self.hash = hash or {}
+
+    def apply(self, labels):
+        result = {}
+        for k, v in labels.items():
+            if self.allow is not None and k not in self.allow:
+                continue
+            buckets = self.hash.get(k)
+            if buckets is not None and k not in RESERVED_LABELS:
+                v = "bucket-%d" % (zlib.crc32(v.encode("utf-8")) % buckets)
+            result[k] = v
+        return result
+
+
+class MetricStat(object):
+    """ cardinality of a metric in its latest exposition """
+    def __init__(self):
+        self.raw_series = 0 # before applying rule and budget
+        self.series = 0 # actually exposed
+        self.dropped = 0
+        self.label_values = {} # label name -> number of distinct values before rule
+
+
+class CardinalityLimiter(object):
+    """ thread safe. Each metric name is expected to be produced by only one
+    collector, so budget left for a metric is the budget minus series other
+    metrics exposed last time """
+    def __init__(self, rules=None, budget=0):
+        """ rules is map from metric name to LabelRule, budget <= 0 means no limit """
+        self.rules = rules or {}
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.stats = {} # metric name -> MetricStat
+
+    @staticmethod
+    def from_config(config):
+        rules = {}
+        for name, rule in (config.get("metrics") or {}).items():
+            rules[name] = LabelRule(rule.get("allow"), rule.get("hash"))
+        return CardinalityLimiter(rules, int(config.get("budget") or 0))
+
+    @staticmethod
+    def from_file(path):
+        with open(path) as f:
+            return CardinalityLimiter.from_config(json.load(f))
+
+    def rewrite(self, metric, stat):
+        """ return list of (sample name, labels, value) after applying rule """
+        rule = self.rules.get(metric.name)
+        label_values = {}
+        merged = {} # key is (sample name, sorted labels)
+
+        for sample in metric.samples:
+            name, labels, value = sample[0], sample[1], sample[2]
+
+            for k, v in labels.items():
+                label_values.setdefault(k, set()).add(v)
+
+            if rule is not None:
+                labels = rule.apply(labels)
+            key = (name, tuple(sorted(labels.items())))
+            if key in merged:
+                merged[key][2] += value
+            else:
+                merged[key] = [name, labels, value]
+
+        stat.raw_series = len(metric.samples)
+        stat.label_values = {k: len(v) for k, v in label_values.items()}
+        return list(merged.values())
+
+    @staticmethod
+    def cut(samples, left):
+        """ return first samples fitting in left. Samples with the same labels
+        except reserved ones (buckets, _sum and _count of a histogram) are kept
+        or dropped together, a partial histogram is worse than none """
+        groups = {}
+        for sample in samples:
+            key = tuple(sorted((k, v) for k, v in sample[1].items()
+                if k not in RESERVED_LABELS))
+            groups.setdefault(key, []).append(sample)
+
+        result = []
+        for group in groups.values():
+            if len(result) + len(group) > left:
+                break
+            result.extend(group)
+        return result
+
+    def limit(self, metrics):
+        """ return list of metrics rewritten by rules and limited by budget """
+        result = []
+
+        with self.lock:
+            names = set(metric.name for metric in metrics)
+            if self.budget > 0:
+                left = self.budget - sum(stat.series
+                        for name, stat in self.stats.items() if name not in names)
+            else:
+                left = None
+
+            for metric in metrics:
+                stat = self.stats[metric.name] = MetricStat()
+                samples = self.rewrite(metric, stat)
+
+                if left is not None and len(samples) > left:
+                    kept = self.cut(samples, max(0, left))
+                    stat.dropped = len(samples) - len(kept)
+                    samples = kept
+                    series_dropped_counter.labels(metric.name).inc(stat.dropped)
+
+                new_metric = Metric(metric.name, metric.documentation, metric.type)
+                for name, labels, value in samples:
+                    new_metric.add_sample(name, labels, value)
+
+                stat.series = len(new_metric.samples)
+                if left is not None:
+                    left -= stat.series
+                result.append(new_metric)
+
+        return result
+
+    def report(self, top=20):
+        """ return top metrics contributing most series before rules applied """
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda x: x[1].raw_series, reverse=True)
+            return {"budget": self.budget,
+                    "series": sum(stat.series for _, stat in stats),
+                    "metrics": [{"name": name,
+                        "raw_series": stat.raw_series,
+                        "series": stat.series,
+                        "dropped": stat.dropped,
+                        "label_values": stat.label_values}
+                        for name, stat in stats[:top]]}
+
+
+class CardinalityResource(Resource):
+    """ serve report of limiter in json, `?top=N` controls number of metrics
+    listed """
+    isLeaf = True
+
+    def __init__(self, limiter):
+        Resource.__init__(self)
+        self.limiter = limiter
+
+    def render_GET(self, request):
+        top = 20
+        if b"top" in request.args:
+            try:
+                top = int(request.args[b"top"][0])
+            except ValueError:
+                top = -1
+            if top < 0:
+                request.setResponseCode(400)
+                return b"top must be a non-negative integer"
+
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps(self.limiter.report(top)).encode("utf-8")
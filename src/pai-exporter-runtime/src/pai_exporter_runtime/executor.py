@@ -0,0 +1,70 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import concurrent.futures
+import logging
+
+import requests
+
+from pai_exporter_runtime import utils
+
+logger = logging.getLogger(__name__)
+
+
+def create_session(ca_path=None, headers=None, pool_maxsize=8):
+    """ requests to one server should share one session, so connections are
+    kept alive and reused instead of doing tcp and tls handshake for every
+    request. pool_maxsize is number of connections kept for concurrent use """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    if ca_path is not None:
+        session.verify = ca_path
+    if headers is not None:
+        session.headers.update(headers)
+
+    return session
+
+
+class Executor(object):
+    """ run blocking calls, like executing commands or requesting http apis,
+    in a bounded pool of threads. Http requests share the connections of
+    session. thread safe """
+    def __init__(self, name, max_workers=8, session=None):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                thread_name_prefix=name + "_worker")
+        self.session = session
+
+    def submit(self, fn, *args, **kwargs):
+        return self.pool.submit(fn, *args, **kwargs)
+
+    def exec_cmd(self, *args, **kwargs):
+        """ see utils.exec_cmd, return a future of its output """
+        return self.submit(utils.exec_cmd, *args, **kwargs)
+
+    def get(self, url, histogram=None, **kwargs):
+        """ return a future of response of GET url """
+        return self.submit(self.request_with_histogram, url, histogram, **kwargs)
+
+    def request_with_histogram(self, url, histogram, **kwargs):
+        if histogram is None:
+            return self.session.get(url, **kwargs)
+        with histogram.time():
+            return self.session.get(url, **kwargs)
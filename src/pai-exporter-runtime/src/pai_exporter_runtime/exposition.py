@@ -0,0 +1,217 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import datetime
+import gzip
+import hashlib
+import logging
+import threading
+import time
+
+from prometheus_client import exposition
+from prometheus_client.core import REGISTRY
+
+from twisted.web.server import Site
+from twisted.web.resource import Resource
+from twisted.internet import reactor
+
+from pai_exporter_runtime import profile
+
+logger = logging.getLogger(__name__)
+
+# Instead of collecting and serializing all metrics on every scrape, we render
+# exposition text once when a collector finishes an iteration, and serve the
+# same bytes to all scrapers until something changes. Collectors put their
+# metrics into pai_exporter_runtime.ref.AtomicRef, which are sources of the
+# cache.
+#
+# Output of every collector is rendered separately and reused until that
+# collector produces new metrics, so finishing an iteration of one collector
+# only costs serializing its own metrics and self metrics in REGISTRY.
+
+
+class MetricsList(object):
+    """ adapt a list of metrics to what generate_latest expects """
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        return self.metrics
+
+
+class Snapshot(object):
+    def __init__(self, body, created):
+        self.body = body
+        self.created = created
+        digest = hashlib.md5(body).hexdigest()
+        self.etag = '"%s"' % digest
+        # a strong etag identifies one representation, gzipped body has its own
+        self.gzip_etag = '"%s-gzip"' % digest
+        self.compressed = None
+        self.lock = threading.Lock()
+
+    def gzipped(self):
+        with self.lock:
+            if self.compressed is None:
+                self.compressed = gzip.compress(self.body)
+            return self.compressed
+
+
+class ExpositionCache(object):
+    """ thread safe """
+    def __init__(self, max_age, registry=REGISTRY, now_fn=time.time, limiter=None):
+        self.max_age = max_age
+        self.registry = registry
+        self.now_fn = now_fn
+        # cardinality.CardinalityLimiter applied to
+        # metrics of collectors, None means exposing them as is
+        self.limiter = limiter
+
+        self.lock = threading.Lock()
+        self.sources = [] # list of [atomic_ref, last data, rendered blob]
+        self.snapshot = None
+
+    def add_source(self, atomic_ref):
+        """ atomic_ref is the ref a collector sets its metrics to, snapshot
+        will be rebuilt every time new metrics are set """
+        with self.lock:
+            self.sources.append([atomic_ref, None, b""])
+        atomic_ref.add_listener(self.on_update)
+
+    def on_update(self, data, now):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception("failed to rebuild exposition snapshot")
+
+    def render_source(self, source, now):
+        ref, last_data, blob = source
+        data = ref.get(now)
+        if data is last_data:
+            return blob
+
+        if data is None:
+            blob = b""
+        else:
+            metrics = list(data)
+            if self.limiter is not None:
+                metrics = self.limiter.limit(metrics)
+            blob = exposition.generate_latest(MetricsList(metrics))
+
+        source[1], source[2] = data, blob
+        return blob
+
+    def rebuild(self):
+        with self.lock:
+            return self.rebuild_locked()
+
+    def rebuild_locked(self):
+        now = datetime.datetime.now()
+        blobs = [self.render_source(source, now) for source in self.sources]
+        blobs.append(exposition.generate_latest(self.registry))
+        self.snapshot = Snapshot(b"".join(blobs), self.now_fn())
+        return self.snapshot
+
+    def get(self):
+        """ return latest Snapshot, snapshot is rebuilt if it is older than
+        max_age so decayed metrics will not be served forever. Concurrent
+        scrapes finding snapshot expired wait for one rebuild and share it """
+        with self.lock:
+            snapshot = self.snapshot
+            if snapshot is None or self.now_fn() - snapshot.created > self.max_age:
+                snapshot = self.rebuild_locked()
+            return snapshot
+
+
+def accepts_gzip(accept_encoding):
+    """ return True if Accept-Encoding header value allows gzip, honoring
+    q-values so that `gzip;q=0` refuses it """
+    gzip_q = star_q = None
+    for item in (accept_encoding or "").split(","):
+        parts = item.split(";")
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            k, _, v = param.partition("=")
+            if k.strip().lower() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if coding == "gzip":
+            gzip_q = q
+        elif coding == "*":
+            star_q = q
+
+    if gzip_q is None:
+        gzip_q = star_q
+    return gzip_q is not None and gzip_q > 0
+
+
+class SnapshotResource(Resource):
+    """ serve pre-rendered metrics, also let scheduler learn when prometheus
+    scrapes if there is one """
+    isLeaf = True
+
+    def __init__(self, cache, collector_scheduler=None):
+        Resource.__init__(self)
+        self.cache = cache
+        self.collector_scheduler = collector_scheduler
+
+    def render_GET(self, request):
+        if self.collector_scheduler is not None:
+            self.collector_scheduler.observe_scrape()
+        snapshot = self.cache.get()
+
+        gzipped = accepts_gzip(request.getHeader("Accept-Encoding"))
+        etag = snapshot.gzip_etag if gzipped else snapshot.etag
+
+        request.setHeader("Content-Type", exposition.CONTENT_TYPE_LATEST)
+        request.setHeader("ETag", etag)
+        request.setHeader("Vary", "Accept-Encoding")
+
+        if etag in (t.strip() for t in (request.getHeader("If-None-Match") or "").split(",")):
+            request.setResponseCode(304)
+            return b""
+
+        if gzipped:
+            request.setHeader("Content-Encoding", "gzip")
+            return snapshot.gzipped()
+        return snapshot.body
+
+
+class HealthResource(Resource):
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/html; charset=utf-8")
+        return "<html>Ok</html>".encode("utf-8")
+
+
+def serve(port, cache, collector_scheduler=None, children=None):
+    """ serve /metrics from cache, /healthz and /debug/profile, children is a
+    map from path to extra resources. Blocks until reactor stops """
+    debug = Resource()
+    debug.putChild(b"profile", profile.ProfileResource())
+
+    root = Resource()
+    root.putChild(b"metrics", SnapshotResource(cache, collector_scheduler))
+    root.putChild(b"healthz", HealthResource())
+    root.putChild(b"debug", debug)
+    for path, resource in (children or {}).items():
+        root.putChild(path, resource)
+
+    reactor.listenTCP(int(port), Site(root))
+    reactor.run()
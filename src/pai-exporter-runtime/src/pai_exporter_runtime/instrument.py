@@ -0,0 +1,140 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import contextlib
+import logging
+import resource
+import sys
+import threading
+import time
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Every exporter reports iterations of its collectors the same way, so one
+# set of alerts and dashboards works for all of them:
+#
+# * collector_iteration_count_total{name} counts started iterations,
+# * collector_iteration_latency_seconds{name} is latency of iterations,
+# * collector_error_count_total{name} counts failed iterations,
+# * collector_staleness_seconds{name} is seconds since last successful
+#   iteration,
+# * collector_iteration_cpu_seconds{name} is cpu time used by the thread
+#   running the latest iteration, missing if the platform cannot tell,
+# * collector_iteration_allocated_blocks{name} is number of memory blocks
+#   allocated during the latest iteration and not freed at its end. It is
+#   counted process wide, so it is approximate if collectors run at the same
+#   time, python does not count allocations per thread.
+#
+# the last three are exposed by IterationTracker itself.
+
+iteration_counter = Counter("collector_iteration_count", "total number of iteration",
+        ["name"])
+
+iteration_histogram = Histogram("collector_iteration_latency_seconds",
+        "latency for execute one interation of collector (seconds)", ["name"],
+        buckets=(.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0,
+            7.5, 10.0, 12.5, 15.0, 17.5, 20.0, float("inf")))
+
+error_counter = Counter("collector_error_count", "total number of failed iteration",
+        ["name"])
+
+
+def thread_time():
+    """ return cpu seconds used by current thread, None if not supported """
+    if hasattr(time, "thread_time"): # python 3.7+
+        return time.thread_time()
+    try:
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+    except (AttributeError, ValueError, OSError):
+        # RUSAGE_THREAD is linux only
+        return None
+    return usage.ru_utime + usage.ru_stime
+
+
+class IterationTracker(object):
+    """ record iterations of collectors, register it in prometheus_client
+    REGISTRY to expose staleness of collectors. thread safe """
+    def __init__(self, now_fn=time.time):
+        self.now_fn = now_fn
+        self.lock = threading.Lock()
+        self.last_success = {} # key is collector name, value is time
+        self.usages = {} # key is collector name, value is (cpu, blocks)
+
+    def observe(self, name, latency, ok=True, cpu=None, blocks=None):
+        iteration_counter.labels(name).inc()
+        iteration_histogram.labels(name).observe(latency)
+        with self.lock:
+            if ok:
+                self.last_success[name] = self.now_fn()
+            if cpu is not None or blocks is not None:
+                self.usages[name] = (cpu, blocks)
+        if not ok:
+            error_counter.labels(name).inc()
+
+    @contextlib.contextmanager
+    def iteration(self, name):
+        """ time the body as one iteration of collector name, exception
+        raised in the body is counted as error and re-raised """
+        start, cpu, blocks = time.time(), thread_time(), sys.getallocatedblocks()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            if cpu is not None:
+                cpu = thread_time() - cpu
+            self.observe(name, time.time() - start, ok, cpu,
+                    sys.getallocatedblocks() - blocks)
+
+    def staleness(self):
+        """ return map with collector name as key and seconds since its last
+        successful iteration as value, collectors never succeeded are ignored """
+        with self.lock:
+            now = self.now_fn()
+            return {name: now - t for name, t in self.last_success.items()}
+
+    def collect(self):
+        gauge = GaugeMetricFamily("collector_staleness_seconds",
+                "seconds since last successful iteration of collector",
+                labels=["name"])
+        for name, staleness in self.staleness().items():
+            gauge.add_metric([name], staleness)
+        yield gauge
+
+        cpu_gauge = GaugeMetricFamily("collector_iteration_cpu_seconds",
+                "cpu seconds used by latest iteration of collector",
+                labels=["name"])
+        blocks_gauge = GaugeMetricFamily("collector_iteration_allocated_blocks",
+                "memory blocks allocated and not freed by latest iteration of collector",
+                labels=["name"])
+        with self.lock:
+            usages = list(self.usages.items())
+        for name, (cpu, blocks) in usages:
+            if cpu is not None:
+                cpu_gauge.add_metric([name], cpu)
+            if blocks is not None:
+                blocks_gauge.add_metric([name], blocks)
+        yield cpu_gauge
+        yield blocks_gauge
+
+
+# exporters share one tracker per process like prometheus_client REGISTRY
+TRACKER = IterationTracker()
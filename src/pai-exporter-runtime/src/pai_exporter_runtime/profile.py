@@ -0,0 +1,162 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import collections
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+from twisted.internet import threads
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+logger = logging.getLogger(__name__)
+
+# A sampling profiler for finding out which collector or parser burns cpu.
+# Every interval, stacks of all threads are taken from sys._current_frames().
+# In cpu mode, a thread is only sampled if its cpu clock advanced since last
+# sample, so threads sleeping or waiting for subprocesses or sockets are not
+# counted. Result is in collapsed format, one stack per line with frames
+# separated by ";" followed by sample count, which flamegraph.pl and
+# speedscope accept:
+#
+#   gpu_collector;collect (collector.py:220);nvidia_smi (nvidia.py:280) 12
+
+
+def thread_cpu_time(ident):
+    """ return cpu seconds used by thread, None if not supported """
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+def format_frame(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+            frame.f_lineno)
+
+
+class SamplingProfiler(object):
+    """ not thread safe, use one profiler in one thread """
+    def __init__(self, interval=0.01, mode="cpu"):
+        self.interval = interval
+        self.mode = mode
+        self.stacks = collections.Counter()
+        self.cpu_times = {} # key is thread ident, value is cpu time of last sample
+        self.samples = 0
+
+    def on_cpu(self, ident):
+        if self.mode != "cpu":
+            return True
+
+        cpu = thread_cpu_time(ident)
+        if cpu is None:
+            return True # can not tell, count it
+        last = self.cpu_times.get(ident)
+        self.cpu_times[ident] = cpu
+        return last is not None and cpu > last
+
+    def sample(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        self.samples += 1
+
+        for ident, frame in sys._current_frames().items():
+            if ident == me or not self.on_cpu(ident):
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(format_frame(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+            self.stacks[";".join(stack)] += 1
+
+    def run(self, seconds):
+        deadline = time.time() + seconds
+        while True:
+            self.sample()
+            now = time.time()
+            if now >= deadline:
+                break
+            time.sleep(min(self.interval, deadline - now))
+        return self
+
+    def collapsed(self):
+        return "".join("%s %d\n" % (stack, count)
+                for stack, count in sorted(self.stacks.items()))
+
+
+class ProfileResource(Resource):
+    """ `/debug/profile?seconds=N&mode=cpu|wall` profiles all threads for N
+    seconds and returns collapsed stacks in text. Only one profile runs at a
+    time """
+    isLeaf = True
+
+    max_seconds = 60
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.lock = threading.Lock()
+
+    def render_GET(self, request):
+        try:
+            seconds = float(request.args.get(b"seconds", [b"10"])[0])
+        except ValueError:
+            seconds = float("nan")
+        # a NaN deadline never passes, and would hold the lock forever
+        if not math.isfinite(seconds) or seconds <= 0:
+            request.setResponseCode(400)
+            return b"seconds must be a positive number\n"
+        seconds = min(seconds, ProfileResource.max_seconds)
+
+        mode = request.args.get(b"mode", [b"cpu"])[0].decode("utf-8", "replace")
+        if mode not in ("cpu", "wall"):
+            request.setResponseCode(400)
+            return b"mode must be cpu or wall\n"
+
+        if not self.lock.acquire(blocking=False):
+            request.setResponseCode(409)
+            return b"another profile is running\n"
+
+        request.setHeader("Content-Type", "text/plain; charset=utf-8")
+
+        def run():
+            try:
+                return SamplingProfiler(mode=mode).run(seconds).collapsed()
+            finally:
+                self.lock.release()
+
+        def done(result):
+            request.write(result.encode("utf-8"))
+            request.finish()
+
+        def failed(failure):
+            logger.error("failed to profile: %s", failure.getTraceback())
+            request.setResponseCode(500)
+            request.finish()
+
+        # sample in a thread pool, reactor keeps serving scrapes meanwhile
+        d = threads.deferToThread(run)
+        d.addCallbacks(done, failed)
+        return NOT_DONE_YET
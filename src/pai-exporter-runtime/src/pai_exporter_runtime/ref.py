@@ -0,0 +1,54 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import datetime
+import threading
+
+
+class AtomicRef(object):
+    """ a thread safe way to store and get object,
+    should not modify data get from this ref,
+    each get and set method should provide a time obj,
+    so this ref decide whether the data is out of date or not,
+    return None on expired """
+    def __init__(self, decay_time):
+        self.data = None
+        self.date_in_produced = datetime.datetime.now()
+        self.decay_time = decay_time
+        self.lock = threading.RLock()
+        self.listeners = []
+
+    def add_listener(self, fn):
+        """ fn(data, now) will be called in the thread calling set after data
+        has been set """
+        with self.lock:
+            self.listeners.append(fn)
+
+    def set(self, data, now):
+        with self.lock:
+            self.data, self.date_in_produced = data, now
+            listeners = list(self.listeners)
+
+        for fn in listeners:
+            fn(data, now)
+
+    def get(self, now):
+        with self.lock:
+            if self.date_in_produced + self.decay_time < now:
+                return None
+            return self.data
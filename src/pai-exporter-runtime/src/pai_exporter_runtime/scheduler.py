@@ -0,0 +1,156 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import collections
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Scheduler decides when every collector should start an iteration, so metrics
+# are produced right before prometheus scrapes them instead of at some random
+# point in the scrape interval.
+#
+# Scrapes are expected to happen at `phase + k * interval`, phase is learned
+# from observed scrapes. Every scrape time is a deadline, collector starts at
+# deadline minus its estimated latency (95th percentile of recent iterations).
+# If another collector depends on it, it has to finish before the dependent
+# starts. Dependent collector also waits for its dependencies to finish
+# for the same deadline, but never waits past the deadline.
+
+
+class CollectorState(object):
+    def __init__(self, name):
+        self.name = name
+        self.depends_on = []
+        self.latencies = collections.deque(maxlen=20)
+        self.last_deadline = 0 # deadline of latest started iteration
+        self.finished_deadline = 0 # deadline of latest finished iteration
+
+
+class Scheduler(object):
+    """ thread safe """
+    # start a little earlier than estimated, to absorb jitter
+    margin = 0.5
+
+    def __init__(self, interval, now_fn=time.time):
+        self.interval = interval
+        self.now_fn = now_fn
+        self.cond = threading.Condition()
+        self.collectors = {}
+        self.scrape_phases = collections.deque(maxlen=8)
+        self.phase = 0.0
+
+    def register(self, name):
+        with self.cond:
+            if name not in self.collectors:
+                self.collectors[name] = CollectorState(name)
+
+    def add_dependency(self, name, depends_on):
+        """ name will start after depends_on finished for the same deadline """
+        with self.cond:
+            self.register(name)
+            self.register(depends_on)
+            self.collectors[name].depends_on.append(depends_on)
+            self.cond.notify_all()
+
+    def observe_scrape(self, t=None):
+        """ should be called on every scrape """
+        if t is None:
+            t = self.now_fn()
+
+        with self.cond:
+            self.scrape_phases.append(t % self.interval)
+            phase = self.choose_phase()
+            if abs(phase - self.phase) > self.margin:
+                logger.info("scrape phase changed from %.3f to %.3f", self.phase, phase)
+                self.phase = phase
+                self.cond.notify_all()
+
+    def choose_phase(self):
+        """ with multiple scrapers, choose phase minimizing total age of metrics
+        seen by all of them """
+        best, best_age = 0.0, None
+        for p in self.scrape_phases:
+            age = sum((q - p) % self.interval for q in self.scrape_phases)
+            if best_age is None or age < best_age:
+                best, best_age = p, age
+        return best
+
+    def estimated_latency(self, name):
+        latencies = sorted(self.collectors[name].latencies)
+        if len(latencies) == 0:
+            return 0
+        return latencies[min(len(latencies) - 1, int(math.ceil(len(latencies) * 0.95)) - 1)]
+
+    def finish_by(self, name, deadline, visiting=()):
+        """ latest time collector should finish to meet the deadline """
+        result = deadline
+        for state in self.collectors.values():
+            if name in state.depends_on and state.name not in visiting:
+                result = min(result, self.start_at(state.name, deadline,
+                    visiting + (name,)))
+        return result
+
+    def start_at(self, name, deadline, visiting=()):
+        return self.finish_by(name, deadline, visiting) - \
+                self.estimated_latency(name) - self.margin
+
+    def next_deadline(self, after):
+        """ return first scrape time later than after """
+        k = math.floor((after - self.phase) / self.interval) + 1
+        return self.phase + k * self.interval
+
+    def wait_turn(self, name):
+        """ block until collector should start next iteration, return the
+        deadline of this iteration """
+        with self.cond:
+            self.register(name)
+            state = self.collectors[name]
+
+            while True:
+                now = self.now_fn()
+                deadline = self.next_deadline(max(now, state.last_deadline))
+                if len(state.latencies) == 0:
+                    break # run immediately to learn latency
+                start = self.start_at(name, deadline)
+                if start <= now:
+                    break
+                self.cond.wait(start - now)
+
+            while True:
+                now = self.now_fn()
+                pending = [dep for dep in state.depends_on
+                        if self.collectors[dep].finished_deadline < deadline]
+                if len(pending) == 0:
+                    break
+                if now >= deadline:
+                    logger.warning("%s starts without waiting %s", name, pending)
+                    break
+                self.cond.wait(deadline - now)
+
+            state.last_deadline = deadline
+            return deadline
+
+    def finish(self, name, deadline, latency):
+        with self.cond:
+            state = self.collectors[name]
+            state.latencies.append(latency)
+            state.finished_deadline = max(state.finished_deadline, deadline)
+            self.cond.notify_all()
@@ -1,4 +1,3 @@
-#!/usr/bin/env python3
 # Copyright (c) Microsoft Corporation
 # All rights reserved.
 #
@@ -16,9 +15,10 @@
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import subprocess
 
 import logging
+import re
+import subprocess
 
 logger = logging.getLogger(__name__)
 
@@ -50,3 +50,18 @@ def walk_json_field_safe(obj, *fields):
         return obj
     except:
         return None
+
+
+# suffixes of sizes printed by docker and nvidia-smi (kB, MiB) and quantities
+# of k8s (M, Gi), trailing "b" is optional
+UNITS = {"": 1,
+        "k": 10 ** 3, "m": 10 ** 6, "g": 10 ** 9, "t": 10 ** 12,
+        "ki": 2 ** 10, "mi": 2 ** 20, "gi": 2 ** 30, "ti": 2 ** 40}
+
+SIZE_PATTERN = re.compile(r"([0-9.]+)\s*([kmgt]i?)?b?", re.IGNORECASE)
+
+
+def convert_to_byte(data):
+    match = SIZE_PATTERN.search(data)
+    number = float(match.group(1))
+    return number * UNITS[(match.group(2) or "").lower()]
@@ -0,0 +1,140 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import json
+import unittest
+
+from twisted.web.test.requesthelper import DummyRequest
+
+sys.path.append(os.path.abspath("../src/"))
+
+from pai_exporter_runtime import cardinality
+from prometheus_client.core import GaugeMetricFamily, HistogramMetricFamily
+
+def gen_pod_gauge(count):
+    gauge = GaugeMetricFamily("pai_pod_count", "count of pai pod",
+            labels=["service_name", "name", "phase"])
+    for i in range(count):
+        gauge.add_metric(["job", "pod-%d" % i, "running" if i % 2 else "pending"], 1)
+    return gauge
+
+def to_dict(metric):
+    return {tuple(sorted(s[1].items())): s[2] for s in metric.samples}
+
+class TestCardinality(unittest.TestCase):
+    """
+    Test cardinality.py
+    """
+    def test_no_rule(self):
+        limiter = cardinality.CardinalityLimiter()
+        gauge = gen_pod_gauge(10)
+        result = limiter.limit([gauge])
+        self.assertEqual(1, len(result))
+        self.assertEqual("pai_pod_count", result[0].name)
+        self.assertEqual(to_dict(gauge), to_dict(result[0]))
+
+    def test_allow_and_hash(self):
+        limiter = cardinality.CardinalityLimiter.from_config({"metrics": {
+            "pai_pod_count": {"allow": ["service_name", "phase"]},
+            "other": {"hash": {"name": 4}}}})
+
+        result = limiter.limit([gen_pod_gauge(10)])
+        self.assertEqual({(("phase", "pending"), ("service_name", "job")): 5,
+            (("phase", "running"), ("service_name", "job")): 5}, to_dict(result[0]))
+
+        gauge = gen_pod_gauge(100)
+        gauge.name = "other"
+        result = limiter.limit([gauge])
+        names = set(s[1]["name"] for s in result[0].samples)
+        self.assertTrue(names <= {"bucket-0", "bucket-1", "bucket-2", "bucket-3"})
+        self.assertEqual(100, sum(s[2] for s in result[0].samples))
+
+        # hash is stable
+        self.assertEqual(to_dict(result[0]), to_dict(limiter.limit([gauge])[0]))
+
+    def test_histogram_labels_kept(self):
+        limiter = cardinality.CardinalityLimiter.from_config({"metrics": {
+            "latency": {"allow": []}}})
+        histogram = HistogramMetricFamily("latency", "test", labels=["host"])
+        histogram.add_metric(["a"], [("1.0", 1), ("+Inf", 2)], 3)
+        histogram.add_metric(["b"], [("1.0", 2), ("+Inf", 3)], 4)
+
+        result = limiter.limit([histogram])[0]
+        samples = {(s[0], s[1].get("le")): s[2] for s in result.samples}
+        self.assertEqual(3, samples[("latency_bucket", "1.0")])
+        self.assertEqual(5, samples[("latency_bucket", "+Inf")])
+        self.assertEqual(5, samples[("latency_count", None)])
+
+    def test_budget(self):
+        limiter = cardinality.CardinalityLimiter(budget=15)
+        counter = cardinality.series_dropped_counter.labels("pai_pod_count")
+        before = counter._value.get()
+
+        other = gen_pod_gauge(10)
+        other.name = "other"
+        self.assertEqual(10, len(limiter.limit([other])[0].samples))
+
+        # only 5 left for pai_pod_count
+        result = limiter.limit([gen_pod_gauge(10)])
+        self.assertEqual(5, len(result[0].samples))
+        self.assertEqual(5, counter._value.get() - before)
+
+        # budget used by a metric is released when it is exposed again
+        self.assertEqual(1, len(limiter.limit([gen_pod_gauge(1)])[0].samples))
+        self.assertEqual(10, len(limiter.limit([other])[0].samples))
+
+        report = limiter.report(top=1)
+        self.assertEqual(15, report["budget"])
+        self.assertEqual(11, report["series"])
+        self.assertEqual(1, len(report["metrics"]))
+        self.assertEqual("other", report["metrics"][0]["name"])
+        self.assertEqual({"service_name": 1, "name": 10, "phase": 2},
+                report["metrics"][0]["label_values"])
+        json.dumps(report)
+
+    def test_budget_keeps_histogram_whole(self):
+        limiter = cardinality.CardinalityLimiter(budget=6)
+        histogram = HistogramMetricFamily("latency", "test", labels=["host"])
+        histogram.add_metric(["a"], [("1.0", 1), ("+Inf", 2)], 3)
+        histogram.add_metric(["b"], [("1.0", 2), ("+Inf", 3)], 4)
+
+        # each host has 4 samples, only host a fits
+        result = limiter.limit([histogram])[0]
+        self.assertEqual(4, len(result.samples))
+        self.assertEqual({"a"}, set(s[1]["host"] for s in result.samples))
+        self.assertEqual(4, limiter.stats["latency"].dropped)
+
+    def test_resource(self):
+        limiter = cardinality.CardinalityLimiter()
+        limiter.limit([gen_pod_gauge(10)])
+        resource = cardinality.CardinalityResource(limiter)
+
+        request = DummyRequest([b""])
+        request.args = {b"top": [b"1"]}
+        report = json.loads(resource.render_GET(request))
+        self.assertEqual(1, len(report["metrics"]))
+
+        for top in [b"abc", b"-1", b""]:
+            request = DummyRequest([b""])
+            request.args = {b"top": [top]}
+            resource.render_GET(request)
+            self.assertEqual(400, request.responseCode)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import gzip
+import datetime
+import threading
+import time
+import unittest
+
+from twisted.web.test.requesthelper import DummyRequest
+
+sys.path.append(os.path.abspath("../src/"))
+
+from pai_exporter_runtime import cardinality, exposition, ref
+from prometheus_client import CollectorRegistry, Counter
+from prometheus_client.core import GaugeMetricFamily
+
+def gen_gauge(name, val):
+    gauge = GaugeMetricFamily(name, "test", labels=["name"])
+    gauge.add_metric(["a"], val)
+    return gauge
+
+class TestSnapshot(unittest.TestCase):
+    """
+    Test exposition.py
+    """
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.counter = Counter("test_self_metric", "test", registry=self.registry)
+        self.now = [100]
+        self.cache = exposition.ExpositionCache(30, self.registry, lambda: self.now[0])
+
+        decay_time = datetime.timedelta(seconds=60)
+        self.ref1 = ref.AtomicRef(decay_time)
+        self.ref2 = ref.AtomicRef(decay_time)
+        self.cache.add_source(self.ref1)
+        self.cache.add_source(self.ref2)
+
+    def test_rebuild_on_update(self):
+        now = datetime.datetime.now()
+        self.ref1.set([gen_gauge("metric_one", 1)], now)
+        first = self.cache.get()
+        self.assertIn(b'metric_one{name="a"} 1.0', first.body)
+        self.assertIn(b"test_self_metric", first.body)
+
+        # snapshot is reused until something changes
+        self.assertIs(first, self.cache.get())
+
+        blob = self.cache.sources[0][2]
+        self.ref2.set({"x": gen_gauge("metric_two", 2)}.values(), now)
+        second = self.cache.get()
+        self.assertIsNot(first, second)
+        self.assertIn(b'metric_one{name="a"} 1.0', second.body)
+        self.assertIn(b'metric_two{name="a"} 2.0', second.body)
+        self.assertIs(blob, self.cache.sources[0][2]) # not rendered again
+
+    def test_etag_and_gzip(self):
+        now = datetime.datetime.now()
+        self.ref1.set([gen_gauge("metric_one", 1)], now)
+        first = self.cache.get()
+        self.assertEqual(first.body, gzip.decompress(first.gzipped()))
+
+        self.ref1.set([gen_gauge("metric_one", 1)], now)
+        self.assertEqual(first.etag, self.cache.get().etag)
+
+        self.ref1.set([gen_gauge("metric_one", 2)], now)
+        self.assertNotEqual(first.etag, self.cache.get().etag)
+
+    def test_accepts_gzip(self):
+        for header in ["gzip", "deflate, gzip", "gzip;q=0.5", "*", "br, *;q=0.1"]:
+            self.assertTrue(exposition.accepts_gzip(header), header)
+        for header in [None, "", "identity", "gzip;q=0", "gzip; q=0.0, deflate",
+                "*;q=0", "*, gzip;q=0", "gzip;q=abc"]:
+            self.assertFalse(exposition.accepts_gzip(header), header)
+
+    def test_resource_encoding(self):
+        self.ref1.set([gen_gauge("metric_one", 1)], datetime.datetime.now())
+        resource = exposition.SnapshotResource(self.cache)
+
+        request = DummyRequest([b""])
+        request.requestHeaders.setRawHeaders(b"Accept-Encoding", [b"gzip;q=0"])
+        self.assertEqual(self.cache.get().body, resource.render_GET(request))
+        self.assertFalse(request.responseHeaders.hasHeader(b"Content-Encoding"))
+        self.assertEqual([b"Accept-Encoding"],
+                request.responseHeaders.getRawHeaders(b"Vary"))
+
+        request = DummyRequest([b""])
+        request.requestHeaders.setRawHeaders(b"Accept-Encoding", [b"gzip"])
+        body = resource.render_GET(request)
+        self.assertEqual(self.cache.get().body, gzip.decompress(body))
+        self.assertEqual([b"gzip"],
+                request.responseHeaders.getRawHeaders(b"Content-Encoding"))
+
+    def test_resource_etag(self):
+        self.ref1.set([gen_gauge("metric_one", 1)], datetime.datetime.now())
+        resource = exposition.SnapshotResource(self.cache)
+        snapshot = self.cache.get()
+        self.assertNotEqual(snapshot.etag, snapshot.gzip_etag)
+
+        def get(accept_encoding, if_none_match):
+            request = DummyRequest([b""])
+            request.requestHeaders.setRawHeaders(b"Accept-Encoding", [accept_encoding])
+            request.requestHeaders.setRawHeaders(b"If-None-Match", [if_none_match])
+            body = resource.render_GET(request)
+            etag = request.responseHeaders.getRawHeaders(b"ETag")[0].decode("utf-8")
+            return request.responseCode, etag, body
+
+        # etag of one representation does not validate the other one
+        code, etag, body = get(b"gzip", snapshot.etag.encode("utf-8"))
+        self.assertNotEqual(304, code)
+        self.assertEqual(snapshot.gzip_etag, etag)
+        self.assertEqual(snapshot.body, gzip.decompress(body))
+
+        code, etag, body = get(b"identity", snapshot.gzip_etag.encode("utf-8"))
+        self.assertNotEqual(304, code)
+        self.assertEqual(snapshot.etag, etag)
+        self.assertEqual(snapshot.body, body)
+
+        code, etag, body = get(b"gzip", ('"x", ' + snapshot.gzip_etag).encode("utf-8"))
+        self.assertEqual(304, code)
+        self.assertEqual(b"", body)
+
+    def test_expire(self):
+        self.ref1.set([gen_gauge("metric_one", 1)],
+                datetime.datetime.now() - datetime.timedelta(seconds=120))
+        self.assertNotIn(b"metric_one", self.cache.get().body) # decayed
+
+        first = self.cache.get()
+        self.counter.inc()
+        self.assertIs(first, self.cache.get())
+
+        self.now[0] += 31
+        second = self.cache.get()
+        self.assertIsNot(first, second)
+        self.assertRegex(second.body.decode("utf-8"), r"test_self_metric(_total)? 1.0")
+
+    def test_limiter(self):
+        self.cache.limiter = cardinality.CardinalityLimiter.from_config({
+            "budget": 1, "metrics": {"metric_one": {"allow": []}}})
+
+        now = datetime.datetime.now()
+        self.ref1.set([gen_gauge("metric_one", 1)], now)
+        self.ref2.set([gen_gauge("metric_two", 2)], now)
+        body = self.cache.get().body
+        self.assertIn(b"metric_one 1.0", body)
+        self.assertNotIn(b"metric_two{", body) # out of budget
+
+    def test_coalesce(self):
+        self.ref1.set([gen_gauge("metric_one", 1)], datetime.datetime.now())
+        self.now[0] += 31
+
+        renders = []
+        render = self.cache.rebuild_locked
+        def counting_render():
+            renders.append(1)
+            time.sleep(0.1)
+            return render()
+        self.cache.rebuild_locked = counting_render
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get()))
+                for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+
+        self.assertEqual(1, len(renders))
+        self.assertEqual(1, len(set(map(id, results))))
+
+if __name__ == '__main__':
+    unittest.main()
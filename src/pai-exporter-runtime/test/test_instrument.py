@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.abspath("../src/"))
+
+from pai_exporter_runtime import instrument
+
+class TestInstrument(unittest.TestCase):
+    """
+    Test instrument.py
+    """
+    def test_staleness(self):
+        now = [100]
+        tracker = instrument.IterationTracker(now_fn=lambda: now[0])
+
+        with tracker.iteration("gpu"):
+            pass
+        with self.assertRaises(ValueError):
+            with tracker.iteration("container"):
+                raise ValueError("boom")
+        tracker.observe("zombie", 1, ok=False)
+        now[0] = 110
+
+        metrics = list(tracker.collect())
+        self.assertEqual(3, len(metrics))
+        self.assertEqual(1, len(metrics[0].samples))
+        self.assertEqual({"name": "gpu"}, metrics[0].samples[0][1])
+        self.assertEqual(10, metrics[0].samples[0][2])
+
+        self.assertEqual(1, instrument.error_counter.labels("container")._value.get())
+        self.assertEqual(1, instrument.error_counter.labels("zombie")._value.get())
+        self.assertEqual(1, instrument.iteration_counter.labels("gpu")._value.get())
+
+    def test_usage(self):
+        tracker = instrument.IterationTracker()
+
+        with tracker.iteration("busy"):
+            kept = [list(range(10)) for _ in range(10000)]
+            deadline = instrument.thread_time() + 0.05
+            while instrument.thread_time() < deadline:
+                pass
+
+        metrics = {m.name: m for m in tracker.collect()}
+        samples = metrics["collector_iteration_cpu_seconds"].samples
+        self.assertEqual({"name": "busy"}, samples[0][1])
+        self.assertGreaterEqual(samples[0][2], 0.05)
+
+        samples = metrics["collector_iteration_allocated_blocks"].samples
+        self.assertGreaterEqual(samples[0][2], 10000)
+
+    def test_usage_without_cpu_clock(self):
+        tracker = instrument.IterationTracker()
+        with mock.patch.object(instrument, "thread_time", return_value=None):
+            with tracker.iteration("busy"):
+                pass
+
+        metrics = {m.name: m for m in tracker.collect()}
+        self.assertEqual([], metrics["collector_iteration_cpu_seconds"].samples)
+        self.assertEqual(1, len(metrics["collector_iteration_allocated_blocks"].samples))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+from twisted.web.test.requesthelper import DummyRequest
+
+sys.path.append(os.path.abspath("../src/"))
+
+from pai_exporter_runtime import profile
+
+def burn(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+class TestProfile(unittest.TestCase):
+    """
+    Test profile.py
+    """
+    def test_cpu_profile(self):
+        stop = threading.Event()
+        busy = threading.Thread(target=burn, args=(stop,), name="busy_collector")
+        idle = threading.Thread(target=stop.wait, name="idle_collector")
+        busy.start()
+        idle.start()
+
+        # cpu clock of a waiting thread may still advance a little after it starts, so clocks are
+        # stubbed to tell busy thread from idle one
+        clocks = {}
+        def thread_cpu_time(ident):
+            if ident == busy.ident:
+                clocks[ident] = clocks.get(ident, 0) + 0.01
+            return clocks.get(ident, 0)
+
+        try:
+            with mock.patch.object(profile, "thread_cpu_time", side_effect=thread_cpu_time):
+                result = profile.SamplingProfiler(interval=0.005).run(0.1).collapsed()
+        finally:
+            stop.set()
+            busy.join()
+            idle.join()
+
+        lines = result.splitlines()
+        self.assertTrue(any(line.startswith("busy_collector;") and "burn (test_profile.py:" in line
+            for line in lines))
+        self.assertFalse(any(line.startswith("idle_collector;") for line in lines))
+        for line in lines:
+            self.assertGreater(int(line.rsplit(" ", 1)[1]), 0)
+
+    def test_wall_profile(self):
+        stop = threading.Event()
+        idle = threading.Thread(target=stop.wait, name="idle_collector")
+        idle.start()
+        try:
+            result = profile.SamplingProfiler(mode="wall").run(0).collapsed()
+        finally:
+            stop.set()
+            idle.join()
+
+        self.assertIn("idle_collector;", result)
+
+    def test_resource_bad_args(self):
+        resource = profile.ProfileResource()
+        for args in [{b"seconds": [b"nan"]}, {b"seconds": [b"inf"]}, {b"seconds": [b"abc"]},
+                {b"seconds": [b"0"]}, {b"seconds": [b"-1"]}, {b"mode": [b"io"]}]:
+            request = DummyRequest([b""])
+            request.args = args
+            self.assertIn(b"must be", resource.render_GET(request))
+            self.assertEqual(400, request.responseCode)
+        # no profile is left running
+        self.assertTrue(resource.lock.acquire(blocking=False))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.append(os.path.abspath("../src/"))
+
+from pai_exporter_runtime import scheduler
+
+class TestScheduler(unittest.TestCase):
+    """
+    Test scheduler.py
+    """
+    def test_next_deadline(self):
+        s = scheduler.Scheduler(30, now_fn=lambda: 1000)
+        self.assertEqual(1020, s.next_deadline(1000))
+
+        s.observe_scrape(1005)
+        self.assertEqual(15, s.phase)
+        self.assertEqual(1005, s.next_deadline(1000))
+        self.assertEqual(1035, s.next_deadline(1005))
+
+    def test_choose_phase(self):
+        s = scheduler.Scheduler(30)
+        # two scrapers at phase 10 and 12, producing metrics right before 10
+        # makes metrics seen by both of them fresh
+        for t in [10, 12, 40, 42, 70, 72]:
+            s.observe_scrape(t)
+        self.assertEqual(10, s.phase)
+
+    def test_start_at(self):
+        s = scheduler.Scheduler(30)
+        s.margin = 0
+        s.add_dependency("container", "gpu")
+        s.add_dependency("zombie", "container")
+
+        for latency in [1] * 19 + [100]:
+            s.finish("gpu", 0, latency)
+        for _ in range(5):
+            s.finish("container", 0, 5)
+            s.finish("zombie", 0, 2)
+
+        self.assertEqual(1, s.estimated_latency("gpu")) # ignore outlier
+        # zombie should finish before deadline, container before zombie starts,
+        # and gpu before container starts
+        self.assertEqual(98, s.start_at("zombie", 100))
+        self.assertEqual(93, s.start_at("container", 100))
+        self.assertEqual(92, s.start_at("gpu", 100))
+
+    def test_dependency_order(self):
+        s = scheduler.Scheduler(1)
+        s.margin = 0.05
+        s.add_dependency("container", "gpu")
+
+        order = []
+
+        def run(name, latency):
+            for _ in range(3):
+                deadline = s.wait_turn(name)
+                order.append((name, deadline))
+                time.sleep(latency)
+                s.finish(name, deadline, latency)
+
+        threads = [threading.Thread(target=run, args=("container", 0.1), daemon=True),
+                threading.Thread(target=run, args=("gpu", 0.2), daemon=True)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+
+        self.assertEqual(6, len(order))
+        for i in range(0, 6, 2):
+            self.assertEqual("gpu", order[i][0])
+            self.assertEqual("container", order[i + 1][0])
+            self.assertEqual(order[i][1], order[i + 1][1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,13 +20,11 @@
 import unittest
 import subprocess
 
-import base
-
 sys.path.append(os.path.abspath("../src/"))
 
-import utils
+from pai_exporter_runtime import utils
 
-class TestUtils(base.TestBase):
+class TestUtils(unittest.TestCase):
     """
     Test utils.py
     """
@@ -48,5 +46,13 @@ def test_exec_cmd_with_non_0_return_value(self):
         with self.assertRaises(subprocess.CalledProcessError) as context:
             utils.exec_cmd(["false"])
 
+    def test_convert_to_byte(self):
+        self.assertEqual(380.4 * 2 ** 20, utils.convert_to_byte("380.4MiB"))
+        self.assertEqual(380.4 * 10 ** 6, utils.convert_to_byte("380.4MB"))
+        self.assertEqual(1024 * 2 ** 20, utils.convert_to_byte("1024 MiB"))
+        self.assertEqual(10 * 2 ** 30, utils.convert_to_byte("10Gi"))
+        self.assertEqual(2 * 10 ** 12, utils.convert_to_byte("2T"))
+        self.assertEqual(0, utils.convert_to_byte("0B"))
+
 if __name__ == '__main__':
     unittest.main()
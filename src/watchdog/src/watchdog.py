@@ -17,6 +17,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import argparse
+import codecs
 import urllib.parse
 import os
 import json
@@ -25,21 +26,19 @@
 import logging
 import time
 import threading
-import signal
-import faulthandler
-import gc
-import re
+import datetime
 import collections
 
 import yaml
-import prometheus_client
 from prometheus_client import Counter, Summary, Histogram
 from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, Summary, REGISTRY
-from prometheus_client.twisted import MetricsResource
 
-from twisted.web.server import Site
 from twisted.web.resource import Resource
-from twisted.internet import reactor
+
+from pai_exporter_runtime import bootstrap, cardinality, exposition, instrument
+from pai_exporter_runtime.executor import create_session
+from pai_exporter_runtime.ref import AtomicRef
+from pai_exporter_runtime.utils import walk_json_field_safe
 
 logger = logging.getLogger(__name__)
 
@@ -94,72 +93,285 @@ def gen_k8s_node_gpu_total():
 
 ##### watchdog will generate above metrics
 
-def walk_json_field_safe(obj, *fields):
-    """ for example a=[{"a": {"b": 2}}]
-    walk_json_field_safe(a, 0, "a", "b") will get 2
-    walk_json_field_safe(a, 0, "not_exist") will get None
-    """
-    try:
-        for f in fields:
-            obj = obj[f]
-        return obj
-    except:
-        return None
+class MetricsRecorder(object):
+    """ record samples added, so parsed result of an object can be cached and
+    added to new gauges in later iterations """
+    __slots__ = ["samples"]
 
-def convert_to_byte(data):
-    data = data.lower()
-    number = float(re.findall(r"[0-9.]+", data)[0])
-    if "t" in data:
-        return number * 10 ** 12
-    elif "g" in data:
-        return number * 10 ** 9
-    elif "m" in data:
-        return number * 10 ** 6
-    elif "k" in data:
-        return number * 10 ** 3
-    elif "ti" in data:
-        return number * 2 ** 40
-    elif "gi" in data:
-        return number * 2 ** 30
-    elif "mi" in data:
-        return number * 2 ** 20
-    elif "ki" in data:
-        return number * 2 ** 10
-    else:
-        return number
-
-class AtomicRef(object):
-    """ a thread safe way to store and get object, should not modify data get from this ref """
     def __init__(self):
-        self.data = None
-        self.lock = threading.RLock()
+        self.samples = []
+
+    def add_metric(self, labels, value):
+        self.samples.append((labels, value))
+
+    def add_to(self, gauge):
+        for labels, value in self.samples:
+            gauge.add_metric(labels, value)
+
+
+class ListDecoder(object):
+    """ decode list response of k8s api incrementally from chunks of bytes,
+    items are yielded one by one so that the whole list is never held in
+    memory, other top level fields like metadata are stored in fields """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.fields = {}
+
+    def fill(self):
+        """ append next chunk to buffer, return False if no more chunk """
+        for chunk in self.chunks:
+            if len(chunk) == 0:
+                continue
+            self.buf = self.buf[self.pos:] + self.utf8.decode(chunk)
+            self.pos = 0
+            return True
+        return False
+
+    def skip_space(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("unexpected end of list response")
+
+    def expect(self, chars):
+        c = self.skip_space()
+        if c not in chars:
+            raise ValueError("expect one of %s in list response, got %s" % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.skip_space()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # value is incomplete, or is invalid if there is no more data
+                if not self.fill():
+                    raise
+                continue
+            # a number may be truncated at the end of buffer, e.g. 3.25 in
+            # chunks "3." and "25" is decoded as 3
+            if isinstance(obj, (int, float)) and \
+                    (end == len(self.buf) or self.buf[end] in "0123456789.eE+-") and \
+                    self.fill():
+                continue
+            self.pos = end
+            return obj
+
+    def items(self):
+        self.expect("{")
+        if self.skip_space() == "}":
+            return
+
+        while True:
+            key = self.value()
+            self.expect(":")
+            if key == "items" and self.skip_space() == "[":
+                self.pos += 1
+                if self.skip_space() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self.value()
+                        if self.expect(",]") == "]":
+                            break
+            else:
+                self.fields[key] = self.value()
+
+            if self.expect(",}") == "}":
+                return
+
+
+class ResourceGone(Exception):
+    """ resourceVersion we are watching from is too old, need to relist """
+    pass
+
 
-    def get_and_set(self, new_data):
-        data = None
+class Informer(object):
+    """ keep a local cache of k8s objects of one kind. List all objects once,
+    then apply deltas from watch api, only relist if watch returns 410 Gone.
+    Only result of parse_fn is cached instead of the raw object, and an object
+    is parsed again only if its resourceVersion changed """
+    watch_timeout = 300 # ask api server to close watch after this seconds
+    retry_interval = 5
+
+    # list objects page by page, and decode every page as a stream, so memory
+    # used by listing is bounded by page size instead of cluster size
+    page_size = 500
+    chunk_size = 64 * 1024
+
+    def __init__(self, name, url, histogram, parse_fn, session, listener=None):
+        self.name = name
+        self.url = url
+        self.histogram = histogram
+        self.parse_fn = parse_fn
+        self.session = session
+        # called with (key, old parsed, new parsed) when an object changed,
+        # old or new parsed is None if object is added or deleted
+        self.listener = listener
+
+        self.lock = threading.Lock()
+        self.cache = {} # key is object key, value is (resourceVersion, parsed)
+        self.resource_version = None
+        self.synced = False # True once listed, old cache is served while relisting
+
+    @staticmethod
+    def object_key(obj):
+        metadata = obj["metadata"]
+        return metadata.get("uid") or "{}/{}".format(metadata.get("namespace"),
+                metadata["name"])
+
+    def parse(self, obj):
+        return catch_exception(self.parse_fn,
+                "catch exception when parsing %s item" % self.name,
+                None,
+                obj)
+
+    def list_page(self, cache, old_cache, continue_token):
+        """ add items in one page to cache, return metadata of the page """
+        params = {"limit": Informer.page_size}
+        if continue_token is not None:
+            params["continue"] = continue_token
+
+        with self.session.get(self.url, params=params, stream=True) as resp:
+            if resp.status_code == 410:
+                # continue token expired
+                raise ResourceGone(resp.text)
+            resp.raise_for_status()
+
+            decoder = ListDecoder(resp.iter_content(chunk_size=Informer.chunk_size))
+            for item in decoder.items():
+                key = Informer.object_key(item)
+                version = walk_json_field_safe(item, "metadata", "resourceVersion")
+                old = old_cache.get(key)
+                if old is not None and version is not None and old[0] == version:
+                    cache[key] = old
+                else:
+                    cache[key] = (version, self.parse(item))
+
+        return decoder.fields.get("metadata") or {}
+
+    def relist(self):
         with self.lock:
-            data, self.data = self.data, new_data
-        return data
+            old_cache = self.cache
+
+        cache = {}
+        resource_version = None
+        continue_token = None
+
+        with self.histogram.time():
+            while True:
+                metadata = self.list_page(cache, old_cache, continue_token)
+                if resource_version is None:
+                    # all pages are from the snapshot of first page
+                    resource_version = metadata["resourceVersion"]
+                continue_token = metadata.get("continue")
+                if not continue_token:
+                    break
 
-    def get(self):
         with self.lock:
-            return self.data
+            self.cache = cache
+            self.resource_version = resource_version
+            self.synced = True
+
+        if self.listener is not None:
+            for key, (_, parsed) in cache.items():
+                old = old_cache.get(key)
+                if old is None or old[1] is not parsed:
+                    self.notify(key, old and old[1], parsed)
+            for key, (_, parsed) in old_cache.items():
+                if key not in cache:
+                    self.notify(key, parsed, None)
+
+    def notify(self, key, old, new):
+        if self.listener is not None and (old is not None or new is not None):
+            catch_exception(self.listener,
+                    "catch exception when notifying change of %s %s" % (self.name, key),
+                    None,
+                    key, old, new)
+
+    def apply_event(self, event):
+        event_type = event["type"]
+        obj = event["object"]
+
+        if event_type == "ERROR":
+            if obj.get("code") == 410:
+                raise ResourceGone(obj.get("message"))
+            raise RuntimeError("watch %s returns error %s" % (self.name, json.dumps(obj)))
+
+        version = walk_json_field_safe(obj, "metadata", "resourceVersion")
+
+        key = Informer.object_key(obj)
+
+        if event_type in {"ADDED", "MODIFIED"}:
+            parsed = self.parse(obj)
+            with self.lock:
+                old = self.cache.get(key)
+                self.cache[key] = (version, parsed)
+                self.resource_version = version
+            self.notify(key, old and old[1], parsed)
+        elif event_type == "DELETED":
+            with self.lock:
+                old = self.cache.pop(key, None)
+                self.resource_version = version
+            self.notify(key, old and old[1], None)
+        elif event_type == "BOOKMARK":
+            with self.lock:
+                self.resource_version = version
+        else:
+            logger.warning("unknown event type %s when watching %s", event_type, self.name)
 
+    def watch(self):
+        params = {"watch": "true", "resourceVersion": self.resource_version,
+                "timeoutSeconds": Informer.watch_timeout}
 
-class CustomCollector(object):
-    def __init__(self, atomic_ref):
-        self.atomic_ref = atomic_ref
+        with self.session.get(self.url, params=params, stream=True,
+                timeout=(10, Informer.watch_timeout + 30)) as resp:
+            if resp.status_code == 410:
+                raise ResourceGone(resp.text)
+            resp.raise_for_status()
 
-    def collect(self):
-        data = self.atomic_ref.get()
+            for line in resp.iter_lines():
+                if line:
+                    self.apply_event(json.loads(line.decode("utf-8")))
 
-        if data is not None:
-            for datum in data:
-                yield datum
-        else:
-            # https://stackoverflow.com/a/6266586
-            # yield nothing
-            return
-            yield
+    def run(self):
+        need_relist = True
+        while True:
+            try:
+                if need_relist:
+                    self.relist()
+                    need_relist = False
+                self.watch()
+            except ResourceGone as e:
+                logger.info("watching %s from %s is gone, will relist: %s",
+                        self.name, self.resource_version, e)
+                need_relist = True
+            except Exception:
+                # cache is still valid, watch again from where we stopped
+                error_counter.labels(type="informer").inc()
+                logger.exception("informer of %s failed, will retry", self.name)
+                time.sleep(Informer.retry_interval)
+
+    def start(self):
+        t = threading.Thread(target=self.run, name="%s-informer" % self.name)
+        t.daemon = True
+        t.start()
+
+    def values(self):
+        """ return list of parsed objects, or None if never synced with api server """
+        with self.lock:
+            if not self.synced:
+                return None
+            return [parsed for _, parsed in self.cache.values() if parsed is not None]
 
 
 def catch_exception(fn, msg, default, *args, **kwargs):
@@ -260,6 +472,67 @@ def parse_pod_item(pod, pai_pod_gauge, pai_container_gauge, pods_info):
                 namespace, container_state, host_ip, str(ready).lower()], 1)
 
 
+class PodEntry(object):
+    """ parsed result of a pod, cached by informer """
+    __slots__ = ["pod_samples", "container_samples", "host_ip", "pod_info"]
+
+    def __init__(self):
+        self.pod_samples = MetricsRecorder()
+        self.container_samples = MetricsRecorder()
+        self.host_ip = None
+        self.pod_info = None
+
+
+def parse_pod_entry(pod):
+    entry = PodEntry()
+    pods_info = collections.defaultdict(list)
+    # keep what has been parsed even if exception raised, same as process_pods_status
+    catch_exception(parse_pod_item,
+            "catch exception when parsing pod item",
+            None,
+            pod,
+            entry.pod_samples, entry.container_samples, pods_info)
+    for host_ip, infos in pods_info.items():
+        entry.host_ip, entry.pod_info = host_ip, infos[0]
+    return entry
+
+
+class GpuAllocation(object):
+    """ index of gpu allocated to pods, updated when pods change, so gpu used
+    on a node can be got without going through all pods. Thread safe """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pods = {} # key is pod key, value is (host_ip, PodInfo)
+        self.nodes = collections.defaultdict(int) # key is host_ip, value is used gpu
+
+    def on_pod_change(self, key, old, new):
+        """ listener of pod informer, old and new are PodEntry or None """
+        with self.lock:
+            prev = self.pods.pop(key, None)
+            if prev is not None:
+                host_ip, pod_info = prev
+                self.nodes[host_ip] -= pod_info.gpu
+                if self.nodes[host_ip] <= 0:
+                    self.nodes.pop(host_ip)
+
+            if new is not None and new.pod_info is not None:
+                self.pods[key] = (new.host_ip, new.pod_info)
+                if new.pod_info.gpu > 0:
+                    self.nodes[new.host_ip] += new.pod_info.gpu
+
+    def used(self, host_ip):
+        with self.lock:
+            return self.nodes.get(host_ip, 0)
+
+    def snapshot(self):
+        """ return copy of index as node -> used gpu map and list of
+        (pod name, host_ip, gpu), pods using no gpu are omitted """
+        with self.lock:
+            pods = [(pod_info.name, host_ip, pod_info.gpu)
+                    for host_ip, pod_info in self.pods.values() if pod_info.gpu > 0]
+            return dict(self.nodes), pods
+
+
 def process_pods_status(pods_object, pai_pod_gauge, pai_container_gauge,
         pods_info):
     def _map_fn(item):
@@ -273,11 +546,11 @@ def _map_fn(item):
     list(map(_map_fn, pods_object["items"]))
 
 
-def collect_healthz(gauge, histogram, scheme, address, port, url, ca_path, headers):
+def collect_healthz(gauge, histogram, scheme, address, port, url, session):
     with histogram.time():
         error = "ok"
         try:
-            error = requests.get("{}://{}:{}{}".format(scheme, address, port, url), headers = headers, verify = ca_path).text
+            error = session.get("{}://{}:{}{}".format(scheme, address, port, url)).text
         except Exception as e:
             error_counter.labels(type="healthz").inc()
             error = str(e)
@@ -286,19 +559,28 @@ def collect_healthz(gauge, histogram, scheme, address, port, url, ca_path, heade
         gauge.add_metric([error, address], 1)
 
 
-def collect_k8s_component(api_server_scheme, api_server_ip, api_server_port, ca_path, headers):
+def collect_k8s_component(api_server_scheme, api_server_ip, api_server_port, session):
     k8s_gauge = gen_k8s_api_gauge()
 
     collect_healthz(k8s_gauge, api_healthz_histogram,
-            api_server_scheme, api_server_ip, api_server_port, "/healthz", ca_path, headers)
+            api_server_scheme, api_server_ip, api_server_port, "/healthz", session)
 
     return [k8s_gauge]
 
 
-def parse_node_item(node, pai_node_gauge,
-        node_gpu_avail, node_gpu_total, node_gpu_reserved,
-        pods_info):
+class NodeStatus(object):
+    """ parsed result of a node, gpu usage of node is not included since it
+    depends on pods """
+    def __init__(self, ip):
+        self.ip = ip
+        self.disk_pressure = self.memory_pressure = self.out_of_disk = self.ready = "unknown"
+        self.unschedulable = False
+        self.has_status = False
+        self.total_gpu = 0
+        self.has_total_gpu = False
+
 
+def parse_node_status(node):
     ip = None
 
     addresses = walk_json_field_safe(node, "status", "addresses")
@@ -310,10 +592,11 @@ def parse_node_item(node, pai_node_gauge,
     if ip is None:
         ip = node["metadata"]["name"]
 
-    disk_pressure = memory_pressure = out_of_disk = ready = unschedulable = "unknown"
+    result = NodeStatus(ip)
 
     if node.get("status") is not None:
         status = node["status"]
+        result.has_status = True
 
         conditions = walk_json_field_safe(status, "conditions")
         if conditions is not None:
@@ -322,63 +605,86 @@ def parse_node_item(node, pai_node_gauge,
                 node_status = cond["status"].lower()
 
                 if cond_t == "DiskPressure":
-                    disk_pressure = node_status
+                    result.disk_pressure = node_status
                 elif cond_t == "MemoryPressure":
-                    memory_pressure = node_status
+                    result.memory_pressure = node_status
                 elif cond_t == "OutOfDisk":
-                    out_of_disk = node_status
+                    result.out_of_disk = node_status
                 elif cond_t == "Ready":
-                    ready = node_status
+                    result.ready = node_status
                 else:
                     error_counter.labels(type="unknown_node_cond").inc()
                     logger.error("unexpected condition %s in node %s", cond_t, ip)
 
         # https://github.com/kubernetes/community/blob/master/contributors/design-proposals/node/node-allocatable.md
         # [Allocatable] = [Node Capacity] - [Kube-Reserved] - [System-Reserved] - [Hard-Eviction-Threshold]
-        total_gpu = 0
-
         allocatable = walk_json_field_safe(status, "allocatable")
         if allocatable is not None:
             gpu1 = int(walk_json_field_safe(allocatable, "alpha.kubernetes.io/nvidia-gpu") or "0")
             gpu2 = int(walk_json_field_safe(allocatable, "nvidia.com/gpu") or "0")
 
-            total_gpu = max(gpu1, gpu2)
-            node_gpu_total.add_metric([ip], total_gpu)
+            result.total_gpu = max(gpu1, gpu2)
+            result.has_total_gpu = True
         else:
             capacity = walk_json_field_safe(status, "capacity")
             if capacity is not None:
                 gpu1 = int(walk_json_field_safe(capacity, "alpha.kubernetes.io/nvidia-gpu") or "0")
                 gpu2 = int(walk_json_field_safe(capacity, "nvidia.com/gpu") or "0")
-                total_gpu = max(gpu1. gpu2)
 
-                node_gpu_total.add_metric([ip], total_gpu)
+                result.total_gpu = max(gpu1, gpu2)
+                result.has_total_gpu = True
+    else:
+        logger.warning("unexpected structure of node %s: %s", ip, json.dumps(node))
 
-        # Because k8s api's node api do not record how much resource left for
-        # allocation, so we have to compute it ourselves.
-        used_gpu = 0
+    result.unschedulable = walk_json_field_safe(node, "spec", "unschedulable") is True
 
-        if pods_info.get(ip) is not None:
-            for pod in pods_info[ip]:
-                used_gpu += pod.gpu
+    return result
 
-        # if a node is marked as unschedulable, the available gpu will be 0
-        # and reserved gpu will be `total - used`
-        if walk_json_field_safe(node, "spec", "unschedulable") != True:
-            node_gpu_avail.add_metric([ip], max(0, total_gpu - used_gpu))
-            node_gpu_reserved.add_metric([ip], 0)
-        else:
-            node_gpu_avail.add_metric([ip], 0)
-            node_gpu_reserved.add_metric([ip], max(0, total_gpu - used_gpu))
-    else:
-        logger.warning("unexpected structure of node %s: %s", ip, json.dumps(node))
 
-    unschedulable_s = walk_json_field_safe(node, "spec", "unschedulable")
-    if unschedulable_s is True:
-        unschedulable = "true"
-    else:
-        unschedulable = "false"
+def node_gpu_free(node_status, used_gpu):
+    """ return (available, reserved) gpu of node. If a node is marked as
+    unschedulable, the available gpu will be 0 and reserved gpu will be
+    `total - used` """
+    free = max(0, node_status.total_gpu - used_gpu)
+    if node_status.unschedulable:
+        return 0, free
+    return free, 0
+
+
+def add_node_metrics(node_status, pai_node_gauge,
+        node_gpu_avail, node_gpu_total, node_gpu_reserved,
+        used_gpu):
+    """ used_gpu is gpu allocated to pods on this node, because k8s api's node
+    api do not record how much resource left for allocation, so we have to
+    compute it ourselves """
+    ip = node_status.ip
+
+    if node_status.has_status:
+        if node_status.has_total_gpu:
+            node_gpu_total.add_metric([ip], node_status.total_gpu)
+
+        available, reserved = node_gpu_free(node_status, used_gpu)
+        node_gpu_avail.add_metric([ip], available)
+        node_gpu_reserved.add_metric([ip], reserved)
 
-    pai_node_gauge.add_metric([ip, disk_pressure, memory_pressure, out_of_disk, ready, unschedulable], 1)
+    pai_node_gauge.add_metric([ip, node_status.disk_pressure,
+        node_status.memory_pressure, node_status.out_of_disk, node_status.ready,
+        str(node_status.unschedulable).lower()], 1)
+
+
+def parse_node_item(node, pai_node_gauge,
+        node_gpu_avail, node_gpu_total, node_gpu_reserved,
+        pods_info):
+    node_status = parse_node_status(node)
+
+    used_gpu = 0
+    if pods_info.get(node_status.ip) is not None:
+        for pod in pods_info[node_status.ip]:
+            used_gpu += pod.gpu
+
+    add_node_metrics(node_status, pai_node_gauge,
+            node_gpu_avail, node_gpu_total, node_gpu_reserved,
+            used_gpu)
 
 
 def process_nodes_status(nodes_object, pods_info):
@@ -404,31 +710,44 @@ def _map_fn(item):
             node_gpu_avail, node_gpu_total, node_gpu_reserved]
 
 
-def process_pods(k8s_api_addr, ca_path, headers, pods_info):
-    list_pods_url = "{}/api/v1/pods".format(k8s_api_addr)
-
+def process_pods(pod_informer):
     pai_pod_gauge = gen_pai_pod_gauge()
     pai_container_gauge = gen_pai_container_gauge()
 
-    try:
-        pods_object = request_with_histogram(list_pods_url, list_pods_histogram,
-                ca_path, headers)
-        process_pods_status(pods_object, pai_pod_gauge, pai_container_gauge,
-                pods_info)
-    except Exception as e:
-        error_counter.labels(type="parse").inc()
-        logger.exception("failed to process pods from namespace %s", ns)
+    entries = pod_informer.values()
+    if entries is None:
+        logger.warning("pods have not been listed from api server yet")
+    else:
+        for entry in entries:
+            entry.pod_samples.add_to(pai_pod_gauge)
+            entry.container_samples.add_to(pai_container_gauge)
 
     return [pai_pod_gauge, pai_container_gauge]
 
 
-def process_nodes(k8s_api_addr, ca_path, headers, pods_info):
-    list_nodes_url = "{}/api/v1/nodes/".format(k8s_api_addr)
+def process_nodes(node_informer, allocation):
+    pai_node_gauge = gen_pai_node_gauge()
+    node_gpu_avail = gen_k8s_node_gpu_available()
+    node_gpu_reserved = gen_k8s_node_gpu_reserved()
+    node_gpu_total = gen_k8s_node_gpu_total()
 
-    nodes_object = request_with_histogram(list_nodes_url, list_nodes_histogram,
-            ca_path, headers)
+    statuses = node_informer.values()
+    if statuses is None:
+        logger.warning("nodes have not been listed from api server yet")
+    else:
+        for node_status in statuses:
+            catch_exception(add_node_metrics,
+                    "catch exception when generating node metrics",
+                    None,
+                    node_status,
+                    pai_node_gauge,
+                    node_gpu_avail,
+                    node_gpu_total,
+                    node_gpu_reserved,
+                    allocation.used(node_status.ip))
 
-    return process_nodes_status(nodes_object, pods_info)
+    return [pai_node_gauge,
+            node_gpu_avail, node_gpu_total, node_gpu_reserved]
 
 
 def load_machine_list(configFilePath):
@@ -436,11 +755,6 @@ def load_machine_list(configFilePath):
         return yaml.load(f)["hosts"]
 
 
-def request_with_histogram(url, histogram, ca_path, headers):
-    with histogram.time():
-        return requests.get(url, headers = headers, verify = ca_path).json()
-
-
 def try_remove_old_prom_file(path):
     """ try to remove old prom file, since old prom file are exposed by node-exporter,
     if we do not remove, node-exporter will still expose old metrics """
@@ -450,61 +764,88 @@ def try_remove_old_prom_file(path):
         except Exception as e:
             logger.warning("can not remove old prom file %s", path)
 
-def register_stack_trace_dump():
-    faulthandler.register(signal.SIGTRAP, all_threads=True, chain=False)
 
- # https://github.com/prometheus/client_python/issues/322#issuecomment-428189291
-def burninate_gc_collector():
-    for callback in gc.callbacks[:]:
-        if callback.__qualname__.startswith("GCCollector."):
-            gc.callbacks.remove(callback)
+class AllocationResource(Resource):
+    """ serve gpu allocation of nodes and pods in json, so tools do not need
+    to list all pods from k8s api themselves """
+    isLeaf = True
 
-    for name, collector in list(prometheus_client.REGISTRY._names_to_collectors.items()):
-        if name.startswith("python_gc_"):
-            try:
-                prometheus_client.REGISTRY.unregister(collector)
-            except KeyError:  # probably gone already
-                pass
+    def __init__(self, allocation, node_informer):
+        Resource.__init__(self)
+        self.allocation = allocation
+        self.node_informer = node_informer
+
+    def get_allocation(self):
+        nodes_used, pods = self.allocation.snapshot()
+
+        nodes = {}
+        for node_status in self.node_informer.values() or []:
+            used = nodes_used.get(node_status.ip, 0)
+            available, reserved = node_gpu_free(node_status, used)
+            nodes[node_status.ip] = {"total": node_status.total_gpu, "used": used,
+                    "available": available, "reserved": reserved,
+                    "unschedulable": node_status.unschedulable}
+
+        # pods on nodes unknown to us, e.g. unscheduled pods
+        for ip, used in nodes_used.items():
+            if ip not in nodes:
+                nodes[ip] = {"used": used}
+
+        return {"nodes": nodes,
+                "pods": [{"name": name, "host_ip": host_ip, "gpu": gpu}
+                    for name, host_ip, gpu in pods]}
 
-class HealthResource(Resource):
     def render_GET(self, request):
-        request.setHeader("Content-Type", "text/html; charset=utf-8")
-        return "<html>Ok</html>".encode("utf-8")
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps(self.get_allocation()).encode("utf-8")
 
 
 def main(args):
-    register_stack_trace_dump()
-    burninate_gc_collector()
+    bootstrap.register_stack_trace_dump()
+    bootstrap.burninate_gc_collector()
     log_dir = args.log
 
     try_remove_old_prom_file(log_dir + "/watchdog.prom")
 
-    atomic_ref = AtomicRef()
-
-    t = threading.Thread(target=loop, name="loop", args=(args, atomic_ref))
+    address = args.k8s_api
+    session = create_session(*load_credential(args.ca, args.bearer))
+
+    # pods and nodes are cached locally and kept up to date by watching k8s
+    # api, so every iteration only needs to parse objects changed since last one
+    allocation = GpuAllocation()
+    pod_informer = Informer("pod", "{}/api/v1/pods".format(address),
+            list_pods_histogram, parse_pod_entry, session,
+            listener=allocation.on_pod_change)
+    node_informer = Informer("node", "{}/api/v1/nodes".format(address),
+            list_nodes_histogram, parse_node_status, session)
+    pod_informer.start()
+    node_informer.start()
+
+    if args.cardinality_config is not None:
+        limiter = cardinality.CardinalityLimiter.from_file(args.cardinality_config)
+    else:
+        limiter = cardinality.CardinalityLimiter()
+    if args.series_budget is not None:
+        limiter.budget = args.series_budget
+
+    # metrics are rendered once every iteration and served to all scrapers
+    atomic_ref = AtomicRef(datetime.timedelta(seconds=float(args.interval) * 2))
+    exposition_cache = exposition.ExpositionCache(float(args.interval), limiter=limiter)
+    exposition_cache.add_source(atomic_ref)
+    REGISTRY.register(instrument.TRACKER)
+
+    t = threading.Thread(target=loop, name="loop",
+            args=(args, atomic_ref, session, pod_informer, node_informer, allocation))
     t.daemon = True
     t.start()
 
-    REGISTRY.register(CustomCollector(atomic_ref))
-
-    root = Resource()
-    root.putChild(b"metrics", MetricsResource())
-    root.putChild(b"healthz", HealthResource())
+    exposition.serve(args.port, exposition_cache, children={
+        b"allocation": AllocationResource(allocation, node_informer),
+        b"cardinality": cardinality.CardinalityResource(limiter)})
 
-    factory = Site(root)
-    reactor.listenTCP(int(args.port), factory)
-    reactor.run()
-
-
-def loop(args, atomic_ref):
-    address = args.k8s_api
-    parse_result = urllib.parse.urlparse(address)
-    api_server_scheme = parse_result.scheme
-    api_server_ip = parse_result.hostname
-    api_server_port = parse_result.port or 80
 
-    ca_path = args.ca
-    bearer_path = args.bearer
+def load_credential(ca_path, bearer_path):
+    """ return ca_path and headers used to request k8s api """
     if (ca_path is None and bearer_path is not None) or (ca_path is not None and bearer_path is None):
         logger.warning("please provide bearer_path and ca_path at the same time or not")
 
@@ -518,44 +859,33 @@ def loop(args, atomic_ref):
            bearer = bearer_file.read()
            headers = {'Authorization': "Bearer {}".format(bearer)}
 
+    return ca_path, headers
+
+
+def loop(args, atomic_ref, session, pod_informer, node_informer, allocation):
+    parse_result = urllib.parse.urlparse(args.k8s_api)
+    api_server_scheme = parse_result.scheme
+    api_server_ip = parse_result.hostname
+    api_server_port = parse_result.port or 80
+
     while True:
         result = []
         try:
-            pods_info = collections.defaultdict(lambda : [])
-
-            result.extend(process_pods(address, ca_path, headers, pods_info))
+            with instrument.TRACKER.iteration("watchdog"):
+                result.extend(process_pods(pod_informer))
 
-            result.extend(process_nodes(address, ca_path, headers, pods_info))
+                result.extend(process_nodes(node_informer, allocation))
 
-            result.extend(collect_k8s_component(api_server_scheme, api_server_ip, api_server_port, ca_path, headers))
+                result.extend(collect_k8s_component(api_server_scheme, api_server_ip, api_server_port, session))
         except Exception as e:
             error_counter.labels(type="unknown").inc()
             logger.exception("watchdog failed in one iteration")
 
-        atomic_ref.get_and_set(result)
+        atomic_ref.set(result, datetime.datetime.now())
 
         time.sleep(float(args.interval))
 
 
-def get_logging_level():
-    mapping = {
-            "DEBUG": logging.DEBUG,
-            "INFO": logging.INFO,
-            "WARNING": logging.WARNING
-            }
-
-    result = logging.INFO
-
-    if os.environ.get("LOGGING_LEVEL") is not None:
-        level = os.environ["LOGGING_LEVEL"]
-        result = mapping.get(level.upper())
-        if result is None:
-            sys.stderr.write("unknown logging level " + level + ", default to INFO\n")
-            result = logging.INFO
-
-    return result
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("k8s_api", help="kubernetes api uri eg. http://10.151.40.133:8080")
@@ -564,9 +894,10 @@ def get_logging_level():
     parser.add_argument("--port", "-p", help="port to expose metrics", default="9101")
     parser.add_argument("--ca", "-c", help="ca file path")
     parser.add_argument("--bearer", "-b", help="bearer token file path")
+    parser.add_argument("--cardinality-config", help="json file of label allowlists, hashed labels and series budget of metrics")
+    parser.add_argument("--series-budget", help="max number of series exposed, overrides budget in cardinality config, 0 means no limit", type=int)
     args = parser.parse_args()
 
-    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(filename)s:%(lineno)s - %(message)s",
-            level=get_logging_level())
+    bootstrap.config_logging()
 
     main(args)
@@ -0,0 +1,135 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+""" Compare peak memory of listing pods in one response and decoding it at
+once, with listing pods page by page and decoding every page as a stream, on
+a synthetic pod list. Run from this directory:
+
+    python3 bench_list_pods.py --pods 50000
+"""
+
+import argparse
+import collections
+import copy
+import json
+import logging
+import os
+import sys
+import tracemalloc
+from unittest import mock
+
+sys.path.append(os.path.abspath("../src/"))
+# code shared with other exporters, it is copied into image by build
+sys.path.append(os.path.abspath("../../pai-exporter-runtime/src/"))
+
+import watchdog
+
+# every pod in sample is logged as unknown pod
+logging.disable(logging.INFO)
+
+
+def gen_pods(start, end, padding):
+    """ duplicate first pod in sample output, every pod has an annotation of
+    padding bytes to make its size close to real pods """
+    with open("data/pods_list.json") as f:
+        sample = json.load(f)["items"][0]
+
+    for i in range(start, end):
+        pod = copy.deepcopy(sample)
+        pod["metadata"]["name"] = "pod-%d" % i
+        pod["metadata"]["uid"] = "uid-%d" % i
+        pod["metadata"]["resourceVersion"] = str(i)
+        pod["metadata"].setdefault("annotations", {})["padding"] = "x" * padding
+        pod["status"]["hostIP"] = "10.0.%d.%d" % (i // 250 % 250, i % 250)
+        yield pod
+
+
+def gen_body(start, end, args):
+    """ generate response body of pods in [start, end) without holding all
+    pods in memory, like what api server sends """
+    metadata = {"resourceVersion": "1"}
+    if end < args.pods:
+        metadata["continue"] = str(end)
+
+    head = json.dumps({"kind": "PodList", "metadata": metadata})[:-1]
+    items = b",".join(json.dumps(pod).encode("utf-8")
+            for pod in gen_pods(start, end, args.padding))
+    return head.encode("utf-8") + b', "items": [' + items + b"]}"
+
+
+def list_at_once(args):
+    body = gen_body(0, args.pods, args)
+
+    pods_object = json.loads(body.decode("utf-8"))
+    del body
+
+    pod_gauge = watchdog.gen_pai_pod_gauge()
+    container_gauge = watchdog.gen_pai_container_gauge()
+    pods_info = collections.defaultdict(lambda : [])
+    watchdog.process_pods_status(pods_object, pod_gauge, container_gauge, pods_info)
+    del pods_object
+
+    return pod_gauge, container_gauge, pods_info
+
+
+def list_by_page(args):
+    def get(url, params=None, **kwargs):
+        start = int(params.get("continue") or 0)
+        body = gen_body(start, min(args.pods, start + params["limit"]), args)
+
+        resp = mock.MagicMock()
+        resp.__enter__.return_value = resp
+        resp.status_code = 200
+        resp.iter_content.side_effect = lambda chunk_size: (body[i:i + chunk_size]
+                for i in range(0, len(body), chunk_size))
+        return resp
+
+    session = mock.Mock()
+    session.get.side_effect = get
+
+    informer = watchdog.Informer("pod", "http://localhost/api/v1/pods",
+            watchdog.list_pods_histogram, watchdog.parse_pod_entry, session)
+    informer.relist()
+    return informer
+
+
+def measure(fn, args):
+    tracemalloc.start()
+    result = fn(args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, peak
+
+
+def main(args):
+    watchdog.Informer.page_size = args.page_size
+
+    print("%d pods, %d bytes padding per pod, page size %d" %
+            (args.pods, args.padding, args.page_size))
+    for fn in [list_at_once, list_by_page]:
+        current, peak = measure(fn, args)
+        print("%-15s peak %8.1f MiB, retained %8.1f MiB" %
+                (fn.__name__, peak / 2 ** 20, current / 2 ** 20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pods", type=int, default=50000)
+    parser.add_argument("--padding", type=int, default=4000)
+    parser.add_argument("--page-size", type=int, default=500)
+    main(parser.parse_args())
@@ -23,15 +23,54 @@
 import logging
 import logging.config
 import collections
+from unittest import mock
 
 import prometheus_client
 
 sys.path.append(os.path.abspath("../src/"))
+# code shared with other exporters, it is copied into image by build
+sys.path.append(os.path.abspath("../../pai-exporter-runtime/src/"))
 
 import watchdog
 
 log = logging.getLogger(__name__)
 
+def gen_pod(name, host_ip, gpu, version):
+    pod = {"metadata": {"name": name, "namespace": "default", "uid": "uid-" + name,
+                "resourceVersion": version, "labels": {"app": "test"}},
+            "spec": {"containers": [{"name": "main",
+                "resources": {"limits": {"nvidia.com/gpu": str(gpu)}}}]},
+            "status": {"phase": "Running"}}
+    if host_ip is not None:
+        pod["status"]["hostIP"] = host_ip
+    return pod
+
+def gen_pod_entry(name, host_ip, gpu):
+    return watchdog.parse_pod_entry(gen_pod(name, host_ip, gpu, "1"))
+
+def gen_list_api(obj, chunk_size=7):
+    """ return a session whose get serves items in obj page by page, continue
+    token is the index of first item in next page """
+    def get(url, params=None, **kwargs):
+        start = int(params.get("continue") or 0)
+        end = start + params["limit"]
+        metadata = dict(obj["metadata"])
+        if end < len(obj["items"]):
+            metadata["continue"] = str(end)
+        body = json.dumps({"kind": obj.get("kind"), "metadata": metadata,
+            "items": obj["items"][start:end]}).encode("utf-8")
+
+        resp = mock.MagicMock()
+        resp.__enter__.return_value = resp
+        resp.status_code = 200
+        resp.iter_content.return_value = [body[i:i + chunk_size]
+                for i in range(0, len(body), chunk_size)]
+        return resp
+
+    session = mock.Mock()
+    session.get.side_effect = get
+    return session
+
 class TestJobExporter(unittest.TestCase):
     """
     Test job_exporter.py
@@ -167,5 +206,182 @@ def test_process_dlws_nodes_status_with_unscheduable(self):
         for gauge in gauges[1:]:
             self.assertEqual("192.168.255.1", gauge.samples[0].labels["host_ip"])
 
+    def test_informer(self):
+        obj = json.loads(self.get_data_test_input("data/pods_list.json"))
+        obj["metadata"]["resourceVersion"] = "100"
+        for i, item in enumerate(obj["items"]):
+            item["metadata"]["resourceVersion"] = str(i)
+
+        session = gen_list_api(obj)
+        allocation = watchdog.GpuAllocation()
+        informer = watchdog.Informer("pod", "http://localhost/api/v1/pods",
+                watchdog.list_pods_histogram, watchdog.parse_pod_entry, session,
+                listener=allocation.on_pod_change)
+        self.assertIsNone(informer.values())
+
+        with mock.patch("watchdog.Informer.page_size", 2):
+            informer.relist()
+            self.assertEqual((len(obj["items"]) + 1) // 2, session.get.call_count)
+
+        self.assertEqual("100", informer.resource_version)
+        self.assertEqual(len(obj["items"]), len(informer.values()))
+
+        pod_gauge, container_gauge = watchdog.process_pods(informer)
+
+        expected_pod_gauge = watchdog.gen_pai_pod_gauge()
+        expected_container_gauge = watchdog.gen_pai_container_gauge()
+        expected_pods_info = collections.defaultdict(lambda : [])
+        watchdog.process_pods_status(obj, expected_pod_gauge,
+                expected_container_gauge, expected_pods_info)
+
+        self.assertEqual(sorted(expected_pod_gauge.samples), sorted(pod_gauge.samples))
+        self.assertEqual(sorted(expected_container_gauge.samples),
+                sorted(container_gauge.samples))
+        self.assertEqual(sum(map(len, expected_pods_info.values())), len(allocation.pods))
+
+        # unchanged objects are not parsed again in relist
+        first = obj["items"][0]
+        with mock.patch("watchdog.parse_pod_item") as parse:
+            informer.relist()
+            self.assertEqual(0, parse.call_count)
+
+        informer.apply_event({"type": "DELETED", "object": first})
+        self.assertEqual(len(obj["items"]) - 1, len(informer.values()))
+        self.assertEqual(first["metadata"]["resourceVersion"], informer.resource_version)
+
+        informer.apply_event({"type": "ADDED", "object": first})
+        self.assertEqual(len(obj["items"]), len(informer.values()))
+
+        with self.assertRaises(watchdog.ResourceGone):
+            informer.apply_event({"type": "ERROR",
+                "object": {"kind": "Status", "code": 410, "message": "too old"}})
+
+    def test_informer_run(self):
+        class Stop(BaseException):
+            pass
+
+        informer = watchdog.Informer("pod", "http://localhost/api/v1/pods",
+                watchdog.list_pods_histogram, watchdog.parse_pod_entry, mock.Mock())
+
+        values = []
+        def relist():
+            # old cache is served while relisting
+            values.append(informer.values())
+            informer.cache = {"uid1": ("1", "pod1")}
+            informer.resource_version = "1"
+            informer.synced = True
+
+        def watch():
+            values.append(informer.values())
+            if len(values) == 2:
+                raise watchdog.ResourceGone("too old")
+            if len(values) == 4:
+                raise RuntimeError("connection reset")
+            raise Stop()
+
+        with mock.patch.object(informer, "relist", side_effect=relist) as mock_relist:
+            with mock.patch.object(informer, "watch", side_effect=watch):
+                with mock.patch("watchdog.Informer.retry_interval", 0):
+                    with self.assertRaises(Stop):
+                        informer.run()
+        # relist only after 410 Gone, transient errors watch again
+        self.assertEqual(2, mock_relist.call_count)
+        self.assertEqual([None] + [["pod1"]] * 4, values)
+
+    def test_node_informer(self):
+        obj = json.loads(self.get_data_test_input("data/dlws_nodes_list_with_unschedulable.json"))
+
+        informer = watchdog.Informer("node", "http://localhost/api/v1/nodes",
+                watchdog.list_nodes_histogram, watchdog.parse_node_status,
+                gen_list_api(obj))
+        informer.relist()
+
+        allocation = watchdog.GpuAllocation()
+        allocation.on_pod_change("uid1", None, gen_pod_entry("job1", "192.168.255.1", 2))
+        gauges = watchdog.process_nodes(informer, allocation)
+
+        pod_info = collections.defaultdict(lambda : [])
+        pod_info["192.168.255.1"].append(watchdog.PodInfo("job1", 2))
+        expected = watchdog.process_nodes_status(obj, pod_info)
+
+        for gauge, expected_gauge in zip(gauges, expected):
+            self.assertEqual(expected_gauge.samples, gauge.samples)
+        self.assertEqual(2, gauges[3].samples[0].value)
+
+    def test_gpu_allocation(self):
+        allocation = watchdog.GpuAllocation()
+        informer = watchdog.Informer("pod", "http://localhost/api/v1/pods",
+                watchdog.list_pods_histogram, watchdog.parse_pod_entry, None,
+                listener=allocation.on_pod_change)
+        obj = {"metadata": {"resourceVersion": "10"}, "items": [
+            gen_pod("job1", "192.168.255.1", 2, "1"),
+            gen_pod("job2", "192.168.255.1", 1, "2"),
+            gen_pod("job3", None, 4, "3"),
+            gen_pod("job4", "192.168.255.2", 0, "4"),
+            ]}
+        informer.session = gen_list_api(obj)
+        informer.relist()
+
+        self.assertEqual(3, allocation.used("192.168.255.1"))
+        self.assertEqual(4, allocation.used("unscheduled"))
+        self.assertEqual(0, allocation.used("192.168.255.2"))
+
+        informer.apply_event({"type": "MODIFIED",
+            "object": gen_pod("job3", "192.168.255.2", 4, "11")})
+        informer.apply_event({"type": "DELETED",
+            "object": gen_pod("job1", "192.168.255.1", 2, "12")})
+        self.assertEqual(1, allocation.used("192.168.255.1"))
+        self.assertEqual(4, allocation.used("192.168.255.2"))
+        self.assertEqual(0, allocation.used("unscheduled"))
+
+        # relist finds job2 deleted and job1 back
+        obj["items"] = [gen_pod("job1", "192.168.255.1", 2, "1"),
+                gen_pod("job3", "192.168.255.2", 4, "11")]
+        informer.session = gen_list_api(obj)
+        informer.relist()
+        self.assertEqual(2, allocation.used("192.168.255.1"))
+        self.assertEqual(4, allocation.used("192.168.255.2"))
+
+        nodes = json.loads(self.get_data_test_input("data/dlws_nodes_list.json"))
+        node_informer = watchdog.Informer("node", "http://localhost/api/v1/nodes",
+                watchdog.list_nodes_histogram, watchdog.parse_node_status,
+                gen_list_api(nodes))
+        node_informer.relist()
+
+        result = watchdog.AllocationResource(allocation, node_informer).get_allocation()
+        self.assertEqual({"total": 4, "used": 2, "available": 2, "reserved": 0,
+            "unschedulable": False}, result["nodes"]["192.168.255.1"])
+        self.assertEqual({"used": 4}, result["nodes"]["192.168.255.2"])
+        self.assertEqual([{"name": "job1", "host_ip": "192.168.255.1", "gpu": 2},
+            {"name": "job3", "host_ip": "192.168.255.2", "gpu": 4}],
+            sorted(result["pods"], key=lambda pod: pod["name"]))
+
+    def test_list_decoder(self):
+        body = '{"items": [{"a": 12345}, {"b": "\u4e2d\u6587"}, 3.25], "metadata": {"continue": "x"}}'
+        for chunk_size in [1, 2, 3, 100]:
+            data = body.encode("utf-8")
+            decoder = watchdog.ListDecoder(data[i:i + chunk_size]
+                    for i in range(0, len(data), chunk_size))
+            self.assertEqual([{"a": 12345}, {"b": "\u4e2d\u6587"}, 3.25],
+                    list(decoder.items()))
+            self.assertEqual({"metadata": {"continue": "x"}}, decoder.fields)
+
+        for body in [b'{"items": [], "metadata": {}}', b'{"items": null}', b'{}']:
+            self.assertEqual([], list(watchdog.ListDecoder([body]).items()))
+
+        with self.assertRaises(ValueError):
+            list(watchdog.ListDecoder([b'{"items": [{"a": 1}']).items())
+
+    def test_create_session(self):
+        session = watchdog.create_session(None, None)
+        self.assertTrue(session.verify)
+        self.assertNotIn("Authorization", session.headers)
+
+        session = watchdog.create_session("/ca.crt", {"Authorization": "Bearer abc"})
+        self.assertEqual("/ca.crt", session.verify)
+        self.assertEqual("Bearer abc", session.headers["Authorization"])
+        self.assertIs(session.get_adapter("https://10.0.0.1:6443"),
+                session.get_adapter("http://10.0.0.1:8080"))
+
 if __name__ == '__main__':
     unittest.main()
@@ -18,23 +18,22 @@
 
 import urllib.parse
 import argparse
-import signal
-import faulthandler
-import gc
+import datetime
+import hashlib
+import json
 import logging
-import os
 import sys
+import threading
+import time
 from collections import defaultdict
 
 from prometheus_client.core import GaugeMetricFamily, REGISTRY
-from prometheus_client import Histogram
-from prometheus_client.twisted import MetricsResource
+from prometheus_client import Counter, Histogram
 
-import requests
+import numpy
 
-from twisted.web.server import Site
-from twisted.web.resource import Resource
-from twisted.internet import reactor
+from pai_exporter_runtime import bootstrap, executor, exposition, instrument
+from pai_exporter_runtime.ref import AtomicRef
 
 logger = logging.getLogger(__name__)
 
@@ -46,48 +45,52 @@
 cluster_nodes_histogram = Histogram("yarn_api_cluster_nodes_latency_seconds",
         "Resource latency for requesting yarn api /ws/v1/cluster/nodes")
 
+unchanged_response_counter = Counter("yarn_api_unchanged_response",
+        "Count of responses from yarn api not parsed since they are the same as last one",
+        ["api"])
+
 def gen_active_node_count():
     return GaugeMetricFamily("yarn_nodes_active", "active node count in yarn")
 
 def gen_queue_cpu_available():
     return GaugeMetricFamily("yarn_queue_cpu_available", "available cpu in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_queue_cpu_cap():
     return GaugeMetricFamily("yarn_queue_cpu_total", "total cpu in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_queue_mem_available():
     return GaugeMetricFamily("yarn_queue_mem_available", "available mem in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_queue_mem_cap():
     return GaugeMetricFamily("yarn_queue_mem_total", "total mem in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_queue_gpu_available():
     return GaugeMetricFamily("yarn_queue_gpu_available", "available gpu in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_queue_gpu_cap():
     return GaugeMetricFamily("yarn_queue_gpu_total", "total gpu in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_queue_running_jobs():
     return GaugeMetricFamily("yarn_queue_running_job", "total running job count in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_queue_pending_jobs():
     return GaugeMetricFamily("yarn_queue_pending_job", "total pending job count in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_queue_running_containers():
     return GaugeMetricFamily("yarn_queue_running_container", "total running container count in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_queue_pending_containers():
     return GaugeMetricFamily("yarn_queue_pending_container", "total pending container count in queue",
-            labels=["queue"])
+            labels=["queue", "parent"])
 
 def gen_node_cpu_total():
     return GaugeMetricFamily("yarn_node_cpu_total", "total cpu core in node",
@@ -119,9 +122,56 @@ def gen_yarn_exporter_error():
 
 ##### yarn-exporter will generate above metrics
 
-def request_with_histogram(url, histogram, *args, **kwargs):
-    with histogram.time():
-        return requests.get(url, *args, **kwargs)
+class RequestError(Exception):
+    pass
+
+
+class Endpoint(object):
+    """ remember the last response of a RM api, so an unchanged response is
+    not parsed again. Conditional request is used if RM returns ETag or
+    Last-Modified, otherwise the body is compared by its digest """
+    def __init__(self, name, url, histogram, session):
+        self.name = name
+        self.url = url
+        self.histogram = histogram
+        self.session = session
+
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.obj = None
+
+    def get(self):
+        """ return parsed json and whether it changed since last call, raise
+        RequestError if RM answered with unexpected code """
+        headers = {}
+        if self.obj is not None:
+            if self.etag is not None:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified is not None:
+                headers["If-Modified-Since"] = self.last_modified
+
+        with self.histogram.time():
+            response = self.session.get(self.url, headers=headers, allow_redirects=True)
+            body = response.content
+
+        if response.status_code == 304 and self.obj is not None:
+            unchanged_response_counter.labels(self.name).inc()
+            return self.obj, False
+        if response.status_code != 200:
+            raise RequestError("requesting %s with code %d" % (self.url, response.status_code))
+
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+
+        digest = hashlib.sha1(body).digest()
+        if digest == self.digest:
+            unchanged_response_counter.labels(self.name).inc()
+            return self.obj, False
+
+        obj = json.loads(body.decode("utf-8"))
+        self.obj, self.digest = obj, digest
+        return obj, True
 
 class ResourceItem(object):
     def __init__(self, cpu=0, mem=0, gpu=0):
@@ -190,72 +240,259 @@ def __init__(self, total=0, active=0):
         self.active = active
 
 
+class QueueTree(object):
+    """ queues of capacity scheduler flattened in depth first order, so a
+    parent queue always comes before its children. Values of a parent queue
+    cover all its children, sum over parent="root" to get cluster wide value """
+    def __init__(self, scheduler_info):
+        self.root = scheduler_info.get("queueName", "root")
+        self.names = []
+        self.parents = [] # index of parent queue, -1 for top level queues
+        self.depths = []
+        self.partitions = {} # partition name -> index
+        self.partition_of = [] # index of default partition of queue
+        self.capacities = [] # absolute capacity in default partition, 0 ~ 1
+        self.used = [] # vCores, memory in bytes and GPUs used in default partition
+        self.counts = [] # running/pending jobs and containers, of leaf queue only
+
+        stack = [(queue, -1, 0) for queue in reversed(QueueTree.children(scheduler_info))]
+        while len(stack) > 0:
+            queue, parent, depth = stack.pop()
+            index = len(self.names)
+            self.add(queue, parent, depth)
+            children = QueueTree.children(queue)
+            stack.extend((child, index, depth + 1) for child in reversed(children))
+
+    @staticmethod
+    def children(queue):
+        queues = queue.get("queues")
+        if queues is None:
+            return []
+        return queues.get("queue") or []
+
+    def add(self, queue, parent, depth):
+        partition = queue.get("defaultNodeLabelExpression") or ""
+        if partition == "<DEFAULT_PARTITION>":
+            partition = ""
+
+        capacities = {item["partitionName"]: item for item in
+                queue.get("capacities", {}).get("queueCapacitiesByPartition", [])}
+        usages = {item["partitionName"]: item["used"] for item in
+                queue.get("resources", {}).get("resourceUsagesByPartition", [])}
+
+        capacity = capacities.get(partition, queue)["absoluteCapacity"] / 100.0
+        used = usages.get(partition, queue["resourcesUsed"])
+
+        if len(QueueTree.children(queue)) == 0:
+            counts = [queue["numActiveApplications"], queue["numPendingApplications"],
+                    queue["numContainers"], queue["pendingContainers"]]
+        else:
+            counts = [0, 0, 0, 0] # summed from children
+
+        self.names.append(queue["queueName"])
+        self.parents.append(parent)
+        self.depths.append(depth)
+        self.partition_of.append(self.partitions.setdefault(partition, len(self.partitions)))
+        self.capacities.append(capacity)
+        self.used.append([used["vCores"], used["memory"] * 1024 * 1024, used["GPUs"]])
+        self.counts.append(counts)
+
+    def labels(self):
+        """ return [queue, parent] label values of every queue """
+        return [[name, self.root if parent == -1 else self.names[parent]]
+                for name, parent in zip(self.names, self.parents)]
+
+    def compute(self, labeled_resource):
+        """ return arrays of total and available cpu/mem/gpu, and job/container
+        counts, with one row per queue """
+        resources = numpy.zeros((len(self.partitions), 3))
+        for partition, index in self.partitions.items():
+            resource = labeled_resource.get(partition)
+            if resource is not None:
+                resources[index] = [resource.cpu, resource.mem, resource.gpu]
+
+        capacities = numpy.array(self.capacities, dtype=numpy.float64)
+        partition_of = numpy.array(self.partition_of, dtype=numpy.intp)
+        total = resources[partition_of] * capacities[:, numpy.newaxis]
+        avail = total - numpy.array(self.used, dtype=numpy.float64).reshape(-1, 3)
+
+        counts = numpy.array(self.counts, dtype=numpy.float64).reshape(-1, 4)
+        parents = numpy.array(self.parents, dtype=numpy.intp)
+        depths = numpy.array(self.depths, dtype=numpy.intp)
+        # sum up from the deepest level, so a parent gets complete values of
+        # its children before adding itself to its own parent
+        for depth in range(depths.max(initial=0), 0, -1):
+            level = numpy.nonzero(depths == depth)[0]
+            numpy.add.at(counts, parents[level], counts[level])
+
+        return total.tolist(), avail.tolist(), counts.tolist()
+
+
 class YarnCollector(object):
-    def __init__(self, yarn_url):
-        self.nodes_url = urllib.parse.urljoin(yarn_url, "/ws/v1/cluster/nodes")
-        self.scheduler_url = urllib.parse.urljoin(yarn_url, "/ws/v1/cluster/scheduler")
+    """ RM is requested by a background thread every interval seconds, result
+    of latest refresh is set to atomic_ref and rendered once for all scrapers,
+    so scrapes never wait for RM. thread safe """
+    name = "yarn_collector"
+
+    # upper bound of delay between refreshes when RM keeps failing or is slow
+    max_backoff = 300
+
+    def __init__(self, yarn_url, interval=30, atomic_ref=None, session=None,
+            tracker=instrument.TRACKER):
+        if session is None:
+            session = executor.create_session(headers={"Accept-Encoding": "gzip"},
+                    pool_maxsize=2)
+        self.nodes = Endpoint("nodes",
+                urllib.parse.urljoin(yarn_url, "/ws/v1/cluster/nodes"),
+                cluster_nodes_histogram, session)
+        self.scheduler = Endpoint("scheduler",
+                urllib.parse.urljoin(yarn_url, "/ws/v1/cluster/scheduler"),
+                cluster_scheduler_histogram, session)
+        # nodes and scheduler are requested concurrently
+        self.executor = executor.Executor("yarn", max_workers=2, session=session)
+        self.last_result = None # metrics generated from unchanged responses
+        self.interval = interval
+        self.atomic_ref = atomic_ref
+        self.tracker = tracker
+
+        self.cond = threading.Condition()
+        self.refreshing = False
+        self.metrics = None # metrics of last good refresh
+        self.errors = [] # errors of latest refresh
+        self.failures = 0 # consecutive bad refreshes
 
     def collect(self):
-        error_counter = gen_yarn_exporter_error()
+        """ yield metrics of last good refresh and errors of latest refresh """
+        with self.cond:
+            metrics, errors = self.metrics, self.errors
+
+        for metric in metrics or []:
+            yield metric
 
-        response = None
+        error_counter = gen_yarn_exporter_error()
+        for error in errors:
+            error_counter.add_metric([error], 1)
+        yield error_counter
 
-        # nodes_url
+    def refresh(self):
+        """ request RM and update cached metrics, if another refresh is in
+        progress, wait for it instead of starting a new one. Return True if
+        RM answered without error """
+        with self.cond:
+            return self.refresh_locked()
+
+    def refresh_locked(self):
+        if self.refreshing:
+            while self.refreshing:
+                self.cond.wait()
+            return self.failures == 0
+
+        self.refreshing = True
+        self.cond.release()
+        # responses are parsed in executor threads, count cpu of the process
+        # since there is no other collector in yarn-exporter
+        start, cpu, blocks = time.time(), time.process_time(), sys.getallocatedblocks()
         try:
-            response = request_with_histogram(self.nodes_url, cluster_nodes_histogram,
-                    allow_redirects=True)
+            metrics, errors = self.fetch()
         except Exception as e:
-            error_counter.add_metric([str(e)], 1)
-            logger.exception(e)
+            logger.exception("failed to refresh yarn metrics")
+            metrics, errors = None, [str(e)]
+        finally:
+            self.cond.acquire()
+            self.refreshing = False
+            self.cond.notify_all()
+
+        self.errors = errors
+        if len(errors) == 0:
+            self.metrics = metrics
+            self.failures = 0
+        else:
+            self.failures += 1
+            if self.metrics is None and metrics is not None:
+                # better than nothing before the first good refresh
+                self.metrics = metrics
+        self.tracker.observe(YarnCollector.name, time.time() - start, self.failures == 0,
+                time.process_time() - cpu, sys.getallocatedblocks() - blocks)
+        return self.failures == 0
+
+    def next_delay(self, latency):
+        """ refresh every interval, back off exponentially when RM fails or
+        takes longer than interval to answer """
+        with self.cond:
+            failures = self.failures
+        if latency > self.interval:
+            failures += 1
+        if failures == 0:
+            return max(0, self.interval - latency)
+        return min(self.interval * 2 ** min(failures, 16), YarnCollector.max_backoff)
+
+    def run(self):
+        while True:
+            start = time.time()
+            self.refresh()
+            if self.atomic_ref is not None:
+                self.atomic_ref.set(list(self.collect()), datetime.datetime.now())
+            delay = self.next_delay(time.time() - start)
+            if delay > self.interval:
+                logger.warning("yarn refresh failed or slow, next refresh in %.1fs", delay)
+            time.sleep(delay)
+
+    def start(self):
+        t = threading.Thread(target=self.run, name="yarn_refresher", daemon=True)
+        t.start()
+        return t
+
+    def fetch(self):
+        """ request RM and return a tuple of metrics list and error messages """
+        errors = []
+
+        futures = [self.executor.submit(endpoint.get)
+                for endpoint in [self.nodes, self.scheduler]]
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(str(e))
+                if isinstance(e, RequestError):
+                    logger.warning(e)
+                else:
+                    logger.exception(e)
+                results.append((None, True))
+
+        (nodes_obj, nodes_changed), (scheduler_obj, scheduler_changed) = results
+        if not nodes_changed and not scheduler_changed and self.last_result is not None:
+            return self.last_result, errors
+
+        result = []
 
         node_count = NodeCount()
 
         labeled_resource = defaultdict(ResourceItem)
 
-        if response is not None:
-            if response.status_code != 200:
-                msg = "requesting %s with code %d" % (self.nodes_url, response.status_code)
-                logger.warning(msg)
-                error_counter.add_metric([msg], 1)
-            else:
-                try:
-                    metrics = YarnCollector.gen_nodes_metrics(response.json(),
-                            node_count, labeled_resource)
-                    for metric in metrics:
-                        yield metric
-                except Exception as e:
-                    error_counter.add_metric([str(e)], 1)
-                    logger.exception(e)
+        if nodes_obj is not None:
+            try:
+                result.extend(YarnCollector.gen_nodes_metrics(nodes_obj,
+                        node_count, labeled_resource))
+            except Exception as e:
+                errors.append(str(e))
+                logger.exception(e)
 
         nodes_active = gen_active_node_count()
         nodes_active.add_metric([], node_count.active)
-        yield nodes_active
+        result.append(nodes_active)
 
-        # scheduler_url
-        response = None
-        try:
-            response = request_with_histogram(self.scheduler_url, cluster_scheduler_histogram,
-                    allow_redirects=True)
-        except Exception as e:
-            error_counter.add_metric([str(e)], 1)
-            logger.exception(e)
-
-        if response is not None:
-            if response.status_code != 200:
-                msg = "requesting %s with code %d" % (self.scheduler_url, response.status_code)
-                logger.warning(msg)
-                error_counter.add_metric([msg], 1)
-            else:
-                try:
-                    metrics = YarnCollector.gen_scheduler_metrics(response.json(),
-                            labeled_resource)
-                    for metric in metrics:
-                        yield metric
-                except Exception as e:
-                    error_counter.add_metric([str(e)], 1)
-                    logger.exception(e)
+        if scheduler_obj is not None:
+            try:
+                result.extend(YarnCollector.gen_scheduler_metrics(scheduler_obj,
+                        labeled_resource))
+            except Exception as e:
+                errors.append(str(e))
+                logger.exception(e)
 
-        yield error_counter
+        self.last_result = result if len(errors) == 0 else None
+        return result, errors
 
     @staticmethod
     def gen_nodes_metrics(obj, node_count, labeled_resource):
@@ -316,7 +553,8 @@ def gen_scheduler_metrics(obj, labeled_resource):
         if obj["scheduler"] is None:
             return []
 
-        scheduler_info = obj["scheduler"]["schedulerInfo"]
+        tree = QueueTree(obj["scheduler"]["schedulerInfo"])
+        total, avail, counts = tree.compute(labeled_resource)
 
         cpu_cap = gen_queue_cpu_cap()
         cpu_avail = gen_queue_cpu_available()
@@ -330,39 +568,19 @@ def gen_scheduler_metrics(obj, labeled_resource):
         running_containers = gen_queue_running_containers()
         pending_containers = gen_queue_pending_containers()
 
-        for queue in scheduler_info["queues"]["queue"]:
-            queue_name = queue["queueName"]
-            queue_nodelabel = queue.get("defaultNodeLabelExpression", "")
-            if queue_nodelabel == "<DEFAULT_PARTITION>":
-                queue_nodelabel = ""
-
-            queue_capacity = queue
-            for label_capacity in queue["capacities"]["queueCapacitiesByPartition"]:
-                if label_capacity["partitionName"] == queue_nodelabel:
-                    queue_capacity =label_capacity
-                    break
-
-            queue_resource_used = queue["resourcesUsed"]
-            for label_used in queue["resources"]["resourceUsagesByPartition"]:
-                if label_used["partitionName"] == queue_nodelabel:
-                    queue_resource_used = label_used["used"]
-                    break
-
-            cap = queue_capacity["absoluteCapacity"] / 100.0
-            partition_resource = labeled_resource[queue_nodelabel]
+        for i, labels in enumerate(tree.labels()):
+            cpu_cap.add_metric(labels, total[i][0])
+            mem_cap.add_metric(labels, total[i][1])
+            gpu_cap.add_metric(labels, total[i][2])
 
-            cpu_cap.add_metric([queue_name], partition_resource.cpu * cap)
-            mem_cap.add_metric([queue_name], partition_resource.mem * cap)
-            gpu_cap.add_metric([queue_name], partition_resource.gpu * cap)
+            cpu_avail.add_metric(labels, avail[i][0])
+            mem_avail.add_metric(labels, avail[i][1])
+            gpu_avail.add_metric(labels, avail[i][2])
 
-            cpu_avail.add_metric([queue_name], partition_resource.cpu * cap - queue_resource_used["vCores"])
-            mem_avail.add_metric([queue_name], partition_resource.mem * cap - queue_resource_used["memory"] * 1024 * 1024)
-            gpu_avail.add_metric([queue_name], partition_resource.gpu * cap - queue_resource_used["GPUs"])
-
-            running_jobs.add_metric([queue_name], queue["numActiveApplications"])
-            pending_jobs.add_metric([queue_name], queue["numPendingApplications"])
-            running_containers.add_metric([queue_name], queue["numContainers"])
-            pending_containers.add_metric([queue_name], queue["pendingContainers"])
+            running_jobs.add_metric(labels, counts[i][0])
+            pending_jobs.add_metric(labels, counts[i][1])
+            running_containers.add_metric(labels, counts[i][2])
+            pending_containers.add_metric(labels, counts[i][3])
 
         return [cpu_cap, cpu_avail,
                 mem_cap, mem_avail,
@@ -370,40 +588,19 @@ def gen_scheduler_metrics(obj, labeled_resource):
                 running_jobs, pending_jobs,
                 running_containers, pending_containers]
 
-class HealthResource(Resource):
-    def render_GET(self, request):
-        request.setHeader("Content-Type", "text/html; charset=utf-8")
-        return "<html>Ok</html>".encode("utf-8")
-
-def register_stack_trace_dump():
-    faulthandler.register(signal.SIGTRAP, all_threads=True, chain=False)
-
- # https://github.com/prometheus/client_python/issues/322#issuecomment-428189291
-def burninate_gc_collector():
-    for callback in gc.callbacks[:]:
-        if callback.__qualname__.startswith("GCCollector."):
-            gc.callbacks.remove(callback)
-
-    for name, collector in list(REGISTRY._names_to_collectors.items()):
-        if name.startswith("python_gc_"):
-            try:
-                REGISTRY.unregister(collector)
-            except KeyError:  # probably gone already
-                pass
-
 def main(args):
-    register_stack_trace_dump()
-    burninate_gc_collector()
+    bootstrap.register_stack_trace_dump()
+    bootstrap.burninate_gc_collector()
 
-    REGISTRY.register(YarnCollector(args.yarn_url))
+    # metrics are rendered once every refresh and served to all scrapers
+    atomic_ref = AtomicRef(datetime.timedelta(seconds=YarnCollector.max_backoff * 2))
+    exposition_cache = exposition.ExpositionCache(args.interval)
+    exposition_cache.add_source(atomic_ref)
+    REGISTRY.register(instrument.TRACKER)
 
-    root = Resource()
-    root.putChild(b"metrics", MetricsResource())
-    root.putChild(b"healthz", HealthResource())
+    YarnCollector(args.yarn_url, args.interval, atomic_ref).start()
 
-    factory = Site(root)
-    reactor.listenTCP(int(args.port), factory)
-    reactor.run()
+    exposition.serve(args.port, exposition_cache)
 
 
 if __name__ == "__main__":
@@ -412,29 +609,11 @@ def main(args):
     parser.add_argument("--cluster-name", "-n", help="Yarn cluster name",
                         default="cluster_0")
     parser.add_argument("--port", "-p", help="Exporter listen port",default="9459")
+    parser.add_argument("--interval", "-i", help="interval second of refreshing metrics from yarn",
+                        type=int, default=30)
 
     args = parser.parse_args()
 
-    def get_logging_level():
-        mapping = {
-                "DEBUG": logging.DEBUG,
-                "INFO": logging.INFO,
-                "WARNING": logging.WARNING
-                }
-
-        result = logging.INFO
-
-        if os.environ.get("LOGGING_LEVEL") is not None:
-            level = os.environ["LOGGING_LEVEL"]
-            result = mapping.get(level.upper())
-            if result is None:
-                sys.stderr.write("unknown logging level " + level + \
-                        ", default to INFO\n")
-                result = logging.INFO
-
-        return result
-
-    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(threadName)s - %(filename)s:%(lineno)s - %(message)s",
-            level=get_logging_level())
+    bootstrap.config_logging()
 
     main(args)
@@ -20,14 +20,20 @@
 import unittest
 import logging
 import json
+import datetime
+import time
+import threading
+from unittest import mock
 
 import base
 from collections import defaultdict
 
 sys.path.append(os.path.abspath("../src/"))
+sys.path.append(os.path.abspath("../../pai-exporter-runtime/src/"))
 
 import yarn_exporter
 from yarn_exporter import YarnCollector
+from pai_exporter_runtime import instrument, ref
 
 logger = logging.getLogger(__name__)
 
@@ -175,6 +181,35 @@ def test_gen_metrics_with_label(self):
                 self.assertEqual(sample.value, 0.4)
 
 
+    def test_gen_nested_queue_metrics(self):
+        with open("data/scheduler_nested.json") as f:
+            obj = json.load(f)
+
+        labeled_resource = {"": yarn_exporter.ResourceItem(cpu=100, gpu=10, mem=100),
+                "gpu_vc": yarn_exporter.ResourceItem(cpu=20, gpu=8, mem=40)}
+
+        metrics = YarnCollector.gen_scheduler_metrics(obj, labeled_resource)
+
+        self.assertEqual(10, len(metrics))
+
+        def values(metric):
+            return {(s[1]["queue"], s[1]["parent"]): s[2] for s in metric.samples}
+
+        # queue gpu cap
+        self.assertEqual({("a", "root"): 5, ("a1", "a"): 3, ("a2", "a"): 4, ("b", "root"): 5},
+                values(metrics[4]))
+        # queue gpu available
+        self.assertEqual({("a", "root"): 4, ("a1", "a"): 2, ("a2", "a"): 2, ("b", "root"): 4},
+                values(metrics[5]))
+        # queue mem available
+        self.assertEqual(30 - 2048 * 1024 * 1024, values(metrics[3])[("a1", "a")])
+
+        # parent queue counts cover its children
+        self.assertEqual({("a", "root"): 6, ("a1", "a"): 1, ("a2", "a"): 5, ("b", "root"): 1},
+                values(metrics[6]))
+        self.assertEqual({("a", "root"): 12, ("a1", "a"): 4, ("a2", "a"): 8, ("b", "root"): 0},
+                values(metrics[9]))
+
     def test_gen_nodes_metrics_using_empty_nodes(self):
         with open("data/empty_nodes") as f:
             obj = json.load(f)
@@ -184,5 +219,170 @@ def test_gen_nodes_metrics_using_empty_nodes(self):
         node_count = yarn_exporter.NodeCount()
         metrics = YarnCollector.gen_nodes_metrics(obj, node_count, labeled_resource)
 
+class StubCollector(YarnCollector):
+    def __init__(self):
+        self.now = 100
+        super(StubCollector, self).__init__("http://localhost:8088", 30,
+                atomic_ref=ref.AtomicRef(datetime.timedelta(seconds=60)),
+                tracker=instrument.IterationTracker(now_fn=lambda: self.now))
+        self.fetch_count = 0
+        self.errors_to_return = []
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.proceed.set()
+
+    def fetch(self):
+        self.fetch_count += 1
+        self.started.set()
+        self.proceed.wait(10)
+        gauge = yarn_exporter.gen_active_node_count()
+        gauge.add_metric([], self.fetch_count)
+        return [gauge], list(self.errors_to_return)
+
+
+class TestYarnRefresher(base.TestBase):
+    """
+    Test background refreshing of YarnCollector
+    """
+
+    def collect(self, collector):
+        return {metric.name: metric for metric in collector.collect()}
+
+    def test_serve_cached(self):
+        collector = StubCollector()
+
+        self.assertTrue(collector.refresh())
+        metrics = self.collect(collector)
+        self.assertEqual(1, collector.fetch_count)
+        self.assertEqual(1, metrics["yarn_nodes_active"].samples[0][2])
+
+        collector.now = 110
+        metrics = self.collect(collector)
+        self.assertEqual(1, collector.fetch_count)
+        self.assertEqual({"yarn_collector": 10}, collector.tracker.staleness())
+
+        # keep last good result on failure
+        collector.errors_to_return = ["boom"]
+        self.assertFalse(collector.refresh())
+        metrics = self.collect(collector)
+        self.assertEqual(1, metrics["yarn_nodes_active"].samples[0][2])
+        self.assertEqual({"yarn_collector": 10}, collector.tracker.staleness())
+        self.assertEqual({"error": "boom"}, metrics["yarn_exporter_error_count"].samples[0][1])
+
+        collector.errors_to_return = []
+        self.assertTrue(collector.refresh())
+        metrics = self.collect(collector)
+        self.assertEqual(3, metrics["yarn_nodes_active"].samples[0][2])
+        self.assertEqual(0, len(metrics["yarn_exporter_error_count"].samples))
+        self.assertEqual({"yarn_collector": 0}, collector.tracker.staleness())
+
+    def test_coalesce(self):
+        collector = StubCollector()
+        collector.proceed.clear()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(collector.refresh()))
+                for _ in range(4)]
+        for t in threads:
+            t.start()
+        collector.started.wait(10)
+        time.sleep(0.1)
+        collector.proceed.set()
+        for t in threads:
+            t.join(10)
+
+        self.assertEqual(1, collector.fetch_count)
+        self.assertEqual([True] * 4, results)
+
+    def test_backoff(self):
+        collector = StubCollector()
+        self.assertEqual(25, collector.next_delay(5))
+        self.assertEqual(60, collector.next_delay(40)) # slow
+
+        collector.errors_to_return = ["boom"]
+        collector.refresh()
+        self.assertEqual(60, collector.next_delay(1))
+        collector.refresh()
+        self.assertEqual(120, collector.next_delay(1))
+        for _ in range(5):
+            collector.refresh()
+        self.assertEqual(YarnCollector.max_backoff, collector.next_delay(1))
+
+        collector.errors_to_return = []
+        collector.refresh()
+        self.assertEqual(29, collector.next_delay(1))
+
+def gen_response(path, status_code=200, headers=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    if path is None:
+        response.content = b""
+    else:
+        with open(path, "rb") as f:
+            response.content = f.read()
+    return response
+
+
+class TestEndpoint(base.TestBase):
+    """
+    Test conditional and concurrent requests to RM
+    """
+
+    def test_unchanged_body(self):
+        session = mock.Mock()
+        session.get.side_effect = [gen_response("data/nodes"), gen_response("data/nodes"),
+                gen_response("data/nodes_with_label.json")]
+        endpoint = yarn_exporter.Endpoint("nodes", "http://localhost:8088/ws/v1/cluster/nodes",
+                yarn_exporter.cluster_nodes_histogram, session)
+
+        obj, changed = endpoint.get()
+        self.assertTrue(changed)
+        self.assertEqual(1, len(obj["nodes"]["node"]))
+
+        self.assertEqual((obj, False), endpoint.get())
+
+        obj2, changed = endpoint.get()
+        self.assertTrue(changed)
+        self.assertIsNot(obj, obj2)
+
+    def test_conditional_request(self):
+        session = mock.Mock()
+        session.get.side_effect = [
+                gen_response("data/scheduler", headers={"ETag": '"v1"'}),
+                gen_response(None, status_code=304),
+                gen_response(None, status_code=500)]
+        endpoint = yarn_exporter.Endpoint("scheduler", "http://localhost:8088/ws/v1/cluster/scheduler",
+                yarn_exporter.cluster_scheduler_histogram, session)
+
+        obj, changed = endpoint.get()
+        self.assertTrue(changed)
+        self.assertEqual({}, session.get.call_args[1]["headers"])
+
+        self.assertEqual((obj, False), endpoint.get())
+        self.assertEqual({"If-None-Match": '"v1"'}, session.get.call_args[1]["headers"])
+
+        with self.assertRaises(yarn_exporter.RequestError):
+            endpoint.get()
+
+    def test_fetch_reuse_metrics(self):
+        def get(url, **kwargs):
+            if url.endswith("nodes"):
+                return gen_response("data/nodes")
+            return gen_response("data/scheduler")
+
+        session = mock.Mock()
+        session.get.side_effect = get
+        collector = YarnCollector("http://localhost:8088", session=session)
+
+        metrics, errors = collector.fetch()
+        self.assertEqual([], errors)
+        self.assertEqual(17, len(metrics))
+        self.assertEqual(2, session.get.call_count)
+
+        metrics2, errors = collector.fetch()
+        self.assertEqual([], errors)
+        self.assertIs(metrics, metrics2)
+
 if __name__ == '__main__':
     unittest.main()